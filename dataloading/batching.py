@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+
+import torch
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
+
+
+def batched_data_loader(dataset, batch_size, sampler=None, drop_last=False, **kwargs):
+    """
+    Creates DataLoader that fetches whole batches with dataset.get_batch instead of collating samples one by one.
+    Indices of a batch are produced by BatchSampler wrapping given sampler and automatic batching of DataLoader is
+    disabled, so the batch returned by the dataset is passed through as is.
+    """
+    if sampler is None:
+        sampler = SequentialSampler(dataset)
+    batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+    return DataLoader(dataset, batch_size=None, sampler=batch_sampler, **kwargs)
+
+
+class NormalizeBatch:
+    """
+    Normalizes batch of uint8 images to [0, 1] on the device the batch is on, same as Normalize and OusterNormalize
+    do for single image.
+    """
+
+    def __call__(self, images):
+        return images.float() / 255
+
+
+def to_device(batch, device):
+    """Moves all tensors of a batch, including tensors nested in dicts, lists and tuples, to the device."""
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, dict):
+        return {key: to_device(value, device) for key, value in batch.items()}
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(to_device(value, device) for value in batch)
+    return batch
+
+
+def record_stream(batch, stream):
+    """Marks CUDA tensors of a batch as used by the stream, so their memory is not reused before the stream is done."""
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            record_stream(value, stream)
+    elif isinstance(batch, (tuple, list)):
+        for value in batch:
+            record_stream(value, stream)
+
+
+class DevicePrefetcher:
+    """
+    Wraps any loader and stages the next batches on the device in a background thread while the current batch is
+    used, so receiving batches from dataloader workers and copying them to the device overlap with the training
+    step. On CUDA, batches are copied on a separate stream. stage_batch moves a batch to the device, by default all
+    tensors of the batch are moved.
+
+    Time spent on staging batches and time the training loop waited for staged batches are accumulated over all
+    iterations, overlap is the share of staging time hidden behind the training step.
+    """
+
+    def __init__(self, loader, device, stage_batch=None, queue_depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stage_batch = stage_batch if stage_batch else lambda batch: to_device(batch, self.device)
+        self.queue_depth = queue_depth
+        self.stage_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.n_batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def overlap(self):
+        if self.stage_seconds == 0:
+            return 0.0
+        return max(0.0, 1 - self.wait_seconds / self.stage_seconds)
+
+    def stage(self, batches, stop, stream):
+        try:
+            iterator = iter(self.loader)
+            while not stop.is_set():
+                start = time.perf_counter()
+                batch = next(iterator, None)
+                if batch is None:
+                    break
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self.stage_batch(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = self.stage_batch(batch)
+                self.stage_seconds += time.perf_counter() - start
+                self.put(batches, stop, (batch, event, None))
+        except Exception as error:
+            self.put(batches, stop, (None, None, error))
+        self.put(batches, stop, None)
+
+    @staticmethod
+    def put(batches, stop, item):
+        # consumer may stop iterating early, so blocking forever on full queue would leak the thread
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        batches = queue.Queue(maxsize=self.queue_depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.stage, args=(batches, stop, stream), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_seconds += time.perf_counter() - start
+                if item is None:
+                    break
+                batch, event, error = item
+                if error is not None:
+                    raise error
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    record_stream(batch, current_stream)
+                self.n_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
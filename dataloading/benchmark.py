@@ -0,0 +1,748 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Dataset, RandomSampler, WeightedRandomSampler
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
+from tqdm import tqdm
+
+from dataloading.batching import NormalizeBatch, batched_data_loader
+from dataloading.compact import ImagePaths, compact_frames
+from dataloading.fusion import NvidiaOusterDataset
+from dataloading.mixture import MixtureDataset
+from dataloading.build_shards import CROP_TRANSFORMS
+from dataloading.build_tar_shards import tar_shards_name
+from dataloading.check_augment import check_augment_equivalence
+from dataloading.columnar import PARQUET_SUFFIX, read_metadata, write_parquet
+from dataloading.samplers import AliasSampler, ChunkedShuffleSampler, folder_ids, stratified_weights
+from dataloading.temporal import TemporalDataset
+from dataloading.tar_shards import NvidiaTarShardDataset, tar_shards_path
+from dataloading.nvidia import NvidiaDataset, Normalize, AugmentationConfig, AugmentImage, BatchAugmentImage
+from dataloading.ouster import OusterDataset, OusterNormalize, OUSTER_CROP_SHARDS
+from dataloading.read_ahead import read_file
+from pilotnet import PilotnetControl
+from trainer import ControlTrainer
+
+
+def parse_arguments():
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        'benchmark',
+        choices=['getitem', 'shards', 'decode', 'metadata', 'batch', 'augment', 'ipc', 'sampler', 'tar', 'lidar',
+                 'alias', 'mixture', 'fusion', 'temporal', 'prefetch', 'memory', 'readahead', 'parquet'],
+        help='Benchmark to run.'
+    )
+
+    argparser.add_argument(
+        '--dataset-folder',
+        default="/home/romet/data2/datasets/rally-estonia/dataset-new-small/summer2021",
+        help='Root path to the dataset.'
+    )
+
+    argparser.add_argument(
+        '--dataset-name',
+        required=True,
+        action='append',
+        help='Drive to use for benchmarking, can be given multiple times.'
+    )
+
+    argparser.add_argument(
+        '--camera-name',
+        default="front_wide",
+        choices=['front_wide', 'left', 'right', 'all'],
+        help="Camera to read."
+    )
+
+    argparser.add_argument(
+        '--output-modality',
+        default="steering_angle",
+        choices=["steering_angle", "waypoints"],
+        help="Output modality of the dataset."
+    )
+
+    argparser.add_argument(
+        '--metadata-file',
+        default="nvidia_frames.csv",
+        help='Dataset metadata file.'
+    )
+
+    argparser.add_argument(
+        '--crop',
+        default="nvidia-crop-wide",
+        choices=list(CROP_TRANSFORMS.keys()),
+        help="Crop applied to images, also used to find shards built with build_shards.py."
+    )
+
+    argparser.add_argument(
+        '--batch-size',
+        type=int,
+        default=512,
+        help='Batch size used by batch benchmark.'
+    )
+
+    argparser.add_argument(
+        '--block-size',
+        type=int,
+        default=64,
+        help='Block size used by sampler benchmark.'
+    )
+
+    argparser.add_argument(
+        '--buffer-size',
+        type=int,
+        default=8192,
+        help='Shuffle buffer size used by sampler and tar benchmarks.'
+    )
+
+    argparser.add_argument(
+        '--temporal-frames',
+        type=int,
+        default=3,
+        help='Number of frames in a window used by temporal benchmark.'
+    )
+
+    argparser.add_argument(
+        '--temporal-stride',
+        type=int,
+        default=1,
+        help='Stride between frames of a window used by temporal benchmark.'
+    )
+
+    argparser.add_argument(
+        '--num-workers',
+        type=int,
+        default=4,
+        help='Number of dataloader workers used by prefetch benchmark, maximum number of workers of memory benchmark.'
+    )
+
+    argparser.add_argument(
+        '--read-ahead',
+        type=int,
+        default=8,
+        help='Number of reader threads used by readahead benchmark.'
+    )
+
+    argparser.add_argument(
+        '--read-latency-ms',
+        type=float,
+        default=0,
+        help='Latency added to every file read by readahead benchmark, simulates network filesystem.'
+    )
+
+    argparser.add_argument(
+        '--n-samples',
+        type=int,
+        default=10000,
+        help='Number of random samples fetched per measurement.'
+    )
+
+    return argparser.parse_args()
+
+
+def legacy_metadata(dataset, idx):
+    """Per sample metadata lookup as it was done before NvidiaDataset.create_index, kept for comparison."""
+    frame = dataset.frames.iloc[idx]
+    if dataset.camera_name == "left":
+        steering_angle = np.array(frame["steering_angle_left"])
+    elif dataset.camera_name == "right":
+        steering_angle = np.array(frame["steering_angle_right"])
+    else:
+        steering_angle = np.array(frame["steering_angle"])
+
+    data = {
+        'image_path': dataset.image_paths[idx],
+        'steering_angle': steering_angle,
+        'vehicle_speed': np.array(frame["vehicle_speed"]),
+        'autonomous': np.array(frame["autonomous"]),
+        'position_x': np.array(frame["position_x"]),
+        'position_y': np.array(frame["position_y"]),
+        'yaw': np.array(frame["yaw"]),
+        'turn_signal': np.array(frame["turn_signal"]),
+        'row_id': np.array(frame["row_id"]),
+    }
+    if dataset.output_modality == "waypoints":
+        waypoints = []
+        for i in np.arange(1, dataset.n_waypoints + 1):
+            waypoints.append(frame[f"wp{i}_{dataset.camera_name}_x"])
+            waypoints.append(frame[f"wp{i}_{dataset.camera_name}_y"])
+        data['waypoints'] = np.array(waypoints)
+    return data
+
+
+def indexed_metadata(dataset, idx):
+    data = {
+        'image_path': dataset.image_paths[idx],
+        'steering_angle': dataset.camera_steering_angles[idx],
+        'vehicle_speed': dataset.vehicle_speeds[idx],
+        'autonomous': dataset.autonomous[idx],
+        'position_x': dataset.positions_x[idx],
+        'position_y': dataset.positions_y[idx],
+        'yaw': dataset.yaws[idx],
+        'turn_signal': dataset.turn_signals[idx],
+        'row_id': dataset.row_ids[idx],
+    }
+    if dataset.output_modality == "waypoints":
+        data['waypoints'] = dataset.waypoints[idx].reshape(-1)
+    return data
+
+
+def samples_per_second(fetch, indices):
+    start = time.perf_counter()
+    for idx in indices:
+        fetch(idx)
+    return len(indices) / (time.perf_counter() - start)
+
+
+def benchmark_getitem(dataset, n_samples):
+    indices = np.random.randint(0, len(dataset), n_samples)
+
+    legacy = samples_per_second(lambda idx: legacy_metadata(dataset, idx), indices)
+    indexed = samples_per_second(lambda idx: indexed_metadata(dataset, idx), indices)
+    print(f"metadata only: pandas={legacy:.0f} samples/s, index={indexed:.0f} samples/s, "
+          f"speedup={indexed / legacy:.1f}x")
+
+    n_decode = min(n_samples, 1000)
+    legacy = samples_per_second(lambda idx: (legacy_metadata(dataset, idx), dataset.read_image(
+        dataset.image_paths[idx])), indices[:n_decode])
+    indexed = samples_per_second(lambda idx: (indexed_metadata(dataset, idx), dataset.read_image(
+        dataset.image_paths[idx])), indices[:n_decode])
+    print(f"with image:    pandas={legacy:.0f} samples/s, index={indexed:.0f} samples/s, "
+          f"speedup={indexed / legacy:.1f}x")
+
+
+def benchmark_shards(dataset_paths, args):
+    crop = CROP_TRANSFORMS[args.crop]()
+    file_ds = NvidiaDataset(dataset_paths, transforms.Compose([crop, Normalize()]), camera=args.camera_name,
+                            metadata_file=args.metadata_file)
+    shard_ds = NvidiaDataset(dataset_paths, camera=args.camera_name, metadata_file=args.metadata_file,
+                             shard_cache=args.crop)
+
+    indices = np.random.randint(0, len(file_ds), min(args.n_samples, 1000))
+    file_bytes = np.mean([os.path.getsize(file_ds.image_paths[idx]) for idx in indices])
+    shard_bytes = shard_ds.load_image(0).numel()
+    print(f"bytes per sample: files={file_bytes:.0f}, shards={shard_bytes}, ratio={file_bytes / shard_bytes:.1f}x")
+
+    files = samples_per_second(lambda idx: file_ds[idx], indices)
+    shards = samples_per_second(lambda idx: shard_ds[idx], indices)
+    print(f"decode and crop: files={files:.0f} samples/s, shards={shards:.0f} samples/s, speedup={shards / files:.1f}x")
+
+
+def benchmark_decode(dataset_paths, args):
+    crop = CROP_TRANSFORMS[args.crop]()
+    transform = transforms.Compose([crop, Normalize()])
+    separate_ds = NvidiaDataset(dataset_paths, transform, camera=args.camera_name, metadata_file=args.metadata_file,
+                                fused_decode=False)
+    fused_ds = NvidiaDataset(dataset_paths, transform, camera=args.camera_name, metadata_file=args.metadata_file,
+                             fused_decode=True)
+    print(f"fused decoder reduction: {fused_ds.fused_decoder.reduction}x")
+
+    indices = np.random.randint(0, len(separate_ds), min(args.n_samples, 1000))
+    separate = samples_per_second(lambda idx: separate_ds[idx], indices)
+    fused = samples_per_second(lambda idx: fused_ds[idx], indices)
+    print(f"decode and crop: separate={separate:.0f} samples/s, fused={fused:.0f} samples/s, "
+          f"speedup={fused / separate:.1f}x")
+
+
+def benchmark_metadata(dataset_paths, args):
+    def load_seconds(**kwargs):
+        start = time.perf_counter()
+        dataset = NvidiaDataset(dataset_paths, camera=args.camera_name, output_modality=args.output_modality,
+                                metadata_file=args.metadata_file, **kwargs)
+        load_time = time.perf_counter() - start
+        print(f"{len(dataset)} frames, metadata size {dataset.frames.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MB")
+        return load_time
+
+    sequential = load_seconds(metadata_workers=1)
+    parallel = load_seconds()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        load_seconds(metadata_cache_dir=cache_dir)
+        cached = load_seconds(metadata_cache_dir=cache_dir)
+    print(f"metadata loading: sequential={sequential:.2f}s, parallel={parallel:.2f}s, cached={cached:.2f}s, "
+          f"speedup={sequential / cached:.1f}x")
+
+
+def benchmark_batch(dataset_paths, args):
+    crop = CROP_TRANSFORMS[args.crop]()
+    dataset = NvidiaDataset(dataset_paths, transforms.Compose([crop, Normalize()]), camera=args.camera_name,
+                            output_modality=args.output_modality, metadata_file=args.metadata_file, n_branches=3)
+    n_batches = max(args.n_samples // args.batch_size, 1)
+    batches = [np.random.randint(0, len(dataset), args.batch_size) for _ in range(n_batches)]
+
+    samples = [[dataset[idx] for idx in batch] for batch in batches[:1]]
+    start = time.perf_counter()
+    default_collate(samples[0])
+    collate_time = time.perf_counter() - start
+
+    per_sample = samples_per_second(lambda batch: default_collate([dataset[idx] for idx in batch]), batches)
+    batched = samples_per_second(dataset.get_batch, batches)
+    print(f"default_collate of prefetched batch: {1000 * collate_time:.1f} ms")
+    print(f"batch fetch: per sample={per_sample * args.batch_size:.0f} samples/s, "
+          f"batched={batched * args.batch_size:.0f} samples/s, speedup={batched / per_sample:.2f}x")
+
+
+def augmentation_statistics(images, augmented):
+    """Mean over samples of per sample pixel mean, pixel standard deviation and mean absolute change."""
+    flat = augmented.reshape(len(augmented), -1).double()
+    change = (augmented - images).abs().reshape(len(augmented), -1).double()
+    return np.array([flat.mean(dim=1).mean(), flat.std(dim=1).mean(), change.mean(dim=1).mean()])
+
+
+def benchmark_augment(dataset_paths, args):
+    # fails if batched augmentation doesn't match per sample augmentation on synthetic images
+    check_augment_equivalence()
+
+    crop = CROP_TRANSFORMS[args.crop]()
+    dataset = NvidiaDataset(dataset_paths, transforms.Compose([crop, Normalize()]), camera=args.camera_name,
+                            metadata_file=args.metadata_file)
+    n_images = min(args.n_samples, 2000)
+    indices = np.random.randint(0, len(dataset), n_images)
+    images = dataset.get_batch(indices)[0]['image']
+
+    configs = {
+        'color': AugmentationConfig(color_prob=1.0),
+        'noise': AugmentationConfig(noise_prob=1.0),
+        'blur': AugmentationConfig(blur_prob=1.0),
+        'all': AugmentationConfig(color_prob=0.5, noise_prob=0.5, blur_prob=0.5),
+    }
+    for name, config in configs.items():
+        augment = AugmentImage(config)
+        batch_augment = BatchAugmentImage(config)
+
+        start = time.perf_counter()
+        per_sample = torch.stack([augment({'image': image.clone()})['image'].float() for image in images])
+        per_sample_time = time.perf_counter() - start
+        start = time.perf_counter()
+        batched = torch.cat([batch_augment(batch.clone()) for batch in images.split(args.batch_size)])
+        batched_time = time.perf_counter() - start
+
+        # per sample augmentation is random, so only statistics over samples can be compared
+        per_sample_stats = augmentation_statistics(images, per_sample)
+        batched_stats = augmentation_statistics(images, batched)
+        print(f"{name}: mean/std/abs change per sample={np.round(per_sample_stats, 4)}, "
+              f"batched={np.round(batched_stats, 4)}, "
+              f"per sample={n_images / per_sample_time:.0f} samples/s, "
+              f"batched={n_images / batched_time:.0f} samples/s, "
+              f"speedup={per_sample_time / batched_time:.1f}x")
+
+
+def batch_bytes(batch):
+    """Size of tensors in a batch, this is what dataloader workers send to the main process and what is pinned."""
+    if isinstance(batch, torch.Tensor):
+        return batch.numel() * batch.element_size()
+    if isinstance(batch, dict):
+        return sum(batch_bytes(value) for value in batch.values())
+    if isinstance(batch, (list, tuple)):
+        return sum(batch_bytes(value) for value in batch)
+    return 0
+
+
+def benchmark_ipc(dataset_paths, args):
+    crop = CROP_TRANSFORMS[args.crop]()
+    float_ds = NvidiaDataset(dataset_paths, transforms.Compose([crop, Normalize()]), camera=args.camera_name,
+                             output_modality=args.output_modality, metadata_file=args.metadata_file)
+    uint8_ds = NvidiaDataset(dataset_paths, transforms.Compose([crop]), camera=args.camera_name,
+                             output_modality=args.output_modality, metadata_file=args.metadata_file)
+
+    indices = np.random.randint(0, len(float_ds), args.batch_size)
+    float_batch = float_ds.get_batch(indices)
+    uint8_batch = uint8_ds.get_batch(indices)
+    max_diff = (NormalizeBatch()(uint8_batch[0]['image']) - float_batch[0]['image']).abs().max()
+    print(f"max difference of normalization on device: {max_diff:.2e}")
+
+    float_bytes = batch_bytes(float_batch)
+    uint8_bytes = batch_bytes(uint8_batch)
+    print(f"bytes per batch of {args.batch_size}: float32 images={float_bytes / 1024 ** 2:.1f} MB, "
+          f"uint8 images={uint8_bytes / 1024 ** 2:.1f} MB, ratio={float_bytes / uint8_bytes:.1f}x")
+
+
+def sampling_statistics(indices, groups, steering_angles, batch_size):
+    """Mean number of distinct drives and cameras per batch and mean steering angle std of batches."""
+    batches = [indices[i:i + batch_size] for i in range(0, len(indices) - batch_size + 1, batch_size)]
+    n_groups = np.mean([len(np.unique(groups[batch])) for batch in batches])
+    steering_std = np.mean([steering_angles[batch].std() for batch in batches])
+    group_counts = np.bincount(groups[indices], minlength=groups.max() + 1)
+    return n_groups, steering_std, group_counts / group_counts.sum()
+
+
+def benchmark_sampler(dataset_paths, args):
+    dataset = NvidiaDataset(dataset_paths, camera=args.camera_name, metadata_file=args.metadata_file)
+    groups = folder_ids(dataset.image_paths)
+    n_samples = min(args.n_samples, len(dataset))
+
+    iid_indices = np.array(list(RandomSampler(dataset, num_samples=n_samples, replacement=True)))
+    chunked_sampler = ChunkedShuffleSampler(groups, args.block_size, args.buffer_size, num_samples=n_samples)
+    chunked_indices = np.array(list(chunked_sampler))
+
+    iid_groups, iid_std, iid_counts = sampling_statistics(iid_indices, groups, dataset.steering_angles,
+                                                          args.batch_size)
+    chunked_groups, chunked_std, chunked_counts = sampling_statistics(chunked_indices, groups,
+                                                                      dataset.steering_angles, args.batch_size)
+    # how far sampled frequencies of drives and cameras are from each other
+    total_variation = 0.5 * np.abs(iid_counts - chunked_counts).sum()
+    print(f"drives and cameras per batch: iid={iid_groups:.1f}, chunked={chunked_groups:.1f}")
+    print(f"steering angle std in batch: iid={iid_std:.3f}, chunked={chunked_std:.3f}")
+    print(f"total variation distance of drive and camera frequencies: {total_variation:.3f}")
+
+    n_decode = min(n_samples, 1000)
+    iid = samples_per_second(dataset.load_image, iid_indices[:n_decode])
+    chunked = samples_per_second(dataset.load_image, chunked_indices[:n_decode])
+    print(f"image reading: iid={iid:.0f} samples/s, chunked={chunked:.0f} samples/s, speedup={chunked / iid:.2f}x")
+
+
+def benchmark_tar(dataset_paths, args):
+    transform = transforms.Compose([CROP_TRANSFORMS[args.crop](), Normalize()])
+    file_ds = NvidiaDataset(dataset_paths, transform, camera=args.camera_name, output_modality=args.output_modality,
+                            metadata_file=args.metadata_file)
+    name = tar_shards_name("nvidia-camera", args.camera_name, args.output_modality)
+    tar_ds = NvidiaTarShardDataset([tar_shards_path(path, name) for path in dataset_paths], transform,
+                                   output_modality=args.output_modality, shuffle_buffer=args.buffer_size)
+    n_samples = min(args.n_samples, len(file_ds))
+
+    indices = np.random.permutation(len(file_ds))[:n_samples]
+    files = samples_per_second(lambda idx: file_ds[idx], indices)
+
+    start = time.perf_counter()
+    for _, _ in zip(range(n_samples), tar_ds):
+        pass
+    tar = n_samples / (time.perf_counter() - start)
+    print(f"shuffled reading: files={files:.0f} samples/s, tar shards={tar:.0f} samples/s, speedup={tar / files:.1f}x")
+
+
+def benchmark_lidar(dataset_paths, args):
+    for channel in [None, "intensity"]:
+        file_ds = OusterDataset(dataset_paths, channel=channel)
+        shard_ds = OusterDataset(dataset_paths, transforms.Compose([OusterNormalize()]), channel=channel,
+                                 shard_cache=OUSTER_CROP_SHARDS)
+
+        indices = np.random.randint(0, len(file_ds), min(args.n_samples, 1000))
+        file_bytes = np.mean([os.path.getsize(file_ds.image_paths[idx]) for idx in indices])
+        shard_bytes = shard_ds.decode_image(0).numel()
+        files = samples_per_second(lambda idx: file_ds[idx], indices)
+        shards = samples_per_second(lambda idx: shard_ds[idx], indices)
+        print(f"channel={channel or 'all'}: bytes per sample files={file_bytes:.0f}, shards={shard_bytes}, "
+              f"files={files:.0f} samples/s, shards={shards:.0f} samples/s, speedup={shards / files:.1f}x")
+
+
+def benchmark_alias(dataset_paths, args):
+    dataset = NvidiaDataset(dataset_paths, camera=args.camera_name, metadata_file=args.metadata_file)
+
+    start = time.perf_counter()
+    weights = stratified_weights(dataset.frames, ['steering', 'camera', 'turn'])
+    alias_sampler = AliasSampler(weights, args.n_samples, batch_size=args.batch_size)
+    print(f"weights and alias table: {time.perf_counter() - start:.3f}s for {len(weights)} frames")
+
+    start = time.perf_counter()
+    multinomial_indices = np.array(list(WeightedRandomSampler(weights, args.n_samples, replacement=True)))
+    multinomial = args.n_samples / (time.perf_counter() - start)
+    start = time.perf_counter()
+    alias_indices = np.array(list(alias_sampler))
+    alias = args.n_samples / (time.perf_counter() - start)
+    print(f"sampling: multinomial={multinomial:.0f} samples/s, alias={alias:.0f} samples/s, "
+          f"speedup={alias / multinomial:.1f}x")
+
+    # both should be close to the weights, difference shrinks with more samples
+    probs = weights / weights.sum()
+    multinomial_tv = 0.5 * np.abs(np.bincount(multinomial_indices, minlength=len(weights)) / args.n_samples - probs)
+    alias_tv = 0.5 * np.abs(np.bincount(alias_indices, minlength=len(weights)) / args.n_samples - probs)
+    print(f"total variation distance from weights: multinomial={multinomial_tv.sum():.3f}, alias={alias_tv.sum():.3f}")
+
+
+def benchmark_mixture(dataset_paths, args):
+    # every drive is a separate source, mixing them is compared against concatenating their frames
+    sources = [NvidiaDataset([dataset_path], camera=args.camera_name, metadata_file=args.metadata_file)
+               for dataset_path in dataset_paths]
+
+    start = time.perf_counter()
+    merged_frames = pd.concat([source.frames for source in sources])
+    concat_time = time.perf_counter() - start
+    start = time.perf_counter()
+    mixture = MixtureDataset(sources)
+    mixture_time = time.perf_counter() - start
+
+    merged_megabytes = merged_frames.memory_usage(deep=True).sum() / 1024 ** 2
+    print(f"concatenated frames: {concat_time * 1000:.1f}ms, {merged_megabytes:.1f} MB")
+    print(f"mixture index: {mixture_time * 1000:.3f}ms, {mixture.offsets.nbytes} bytes for {len(mixture)} frames")
+
+    indices = np.random.randint(0, len(mixture), min(args.n_samples, 1000))
+    print(f"index lookup: {samples_per_second(mixture.locate, indices):.0f} samples/s")
+
+
+def benchmark_fusion(dataset_paths, args):
+    transform = transforms.Compose([CROP_TRANSFORMS[args.crop](), Normalize()])
+    camera_ds = NvidiaDataset(dataset_paths, transform, camera=args.camera_name, metadata_file=args.metadata_file)
+    fused_ds = NvidiaOusterDataset(dataset_paths, transform, camera=args.camera_name, metadata_file=args.metadata_file)
+    # lidar frame is shared by consecutive camera frames, so cached lidar frames are hit when reading in order
+    cached_ds = NvidiaOusterDataset(dataset_paths, transform, camera=args.camera_name, metadata_file=args.metadata_file,
+                                    lidar_frame_cache_bytes=256 * 1024 ** 2)
+
+    n_samples = min(args.n_samples, 1000, len(fused_ds))
+    indices = np.arange(n_samples)
+    camera = samples_per_second(lambda idx: camera_ds[idx], fused_ds.camera_indices[indices])
+    fused = samples_per_second(lambda idx: fused_ds[idx], indices)
+    cached = samples_per_second(lambda idx: cached_ds[idx], indices)
+    print(f"sequential reading: camera={camera:.0f} samples/s, camera and lidar={fused:.0f} samples/s, "
+          f"with lidar frame cache={cached:.0f} samples/s, relative cost={camera / cached:.2f}x")
+
+
+def benchmark_temporal(dataset_paths, args):
+    transform = transforms.Compose([CROP_TRANSFORMS[args.crop](), Normalize()])
+    dataset = NvidiaDataset(dataset_paths, transform, camera=args.camera_name, metadata_file=args.metadata_file)
+    temporal_ds = TemporalDataset(dataset, args.temporal_frames, args.temporal_stride)
+
+    decoded = []
+    load_image = dataset.load_image
+    dataset.load_image = lambda idx: decoded.append(idx) or load_image(idx)
+
+    def naive_window(idx):
+        # every frame of the window is decoded again, like with dataset returning windows of its own samples
+        window = temporal_ds.windows[idx]
+        images = torch.stack([dataset.load_image(frame_idx) for frame_idx in window.tolist()])
+        return dataset.create_sample(window[-1], images)
+
+    indices = np.arange(min(args.n_samples, 1000, len(temporal_ds)))
+    naive = samples_per_second(naive_window, indices)
+    naive_decoded = len(decoded)
+    decoded.clear()
+    buffered = samples_per_second(lambda idx: temporal_ds[idx], indices)
+    print(f"sequential windows of {args.temporal_frames} frames: naive={naive:.0f} windows/s, "
+          f"{naive_decoded / len(indices):.2f} decodes per window, buffered={buffered:.0f} windows/s, "
+          f"{len(decoded) / len(indices):.2f} decodes per window, speedup={buffered / naive:.1f}x")
+
+
+def benchmark_prefetch(dataset_paths, args):
+    dataset = NvidiaDataset(dataset_paths, transforms.Compose([CROP_TRANSFORMS[args.crop]()]),
+                            camera=args.camera_name, metadata_file=args.metadata_file)
+    sampler = RandomSampler(dataset, num_samples=min(args.n_samples, len(dataset)), replacement=True)
+    loader = batched_data_loader(dataset, args.batch_size, sampler=sampler, num_workers=args.num_workers,
+                                 pin_memory=torch.cuda.is_available(), persistent_workers=True)
+    trainer = ControlTrainer(n_conditional_branches=1)
+    model = PilotnetControl(3, 1).to(trainer.device)
+    optimizer = torch.optim.AdamW(model.parameters())
+    criterion = torch.nn.MSELoss()
+
+    # first epoch starts the workers
+    trainer.train_epoch(model, loader, optimizer, criterion, tqdm(disable=True), 0)
+    epoch_seconds = {}
+    for device_prefetch in [False, True]:
+        trainer.device_prefetch = device_prefetch
+        batches = trainer.prefetched(loader)
+        start = time.perf_counter()
+        trainer.train_epoch(model, batches, optimizer, criterion, tqdm(disable=True), 0)
+        epoch_seconds[device_prefetch] = time.perf_counter() - start
+
+    print(f"epoch of {len(loader)} batches on {trainer.device}: synchronous={epoch_seconds[False]:.2f}s, "
+          f"prefetched={epoch_seconds[True]:.2f}s, speedup={epoch_seconds[False] / epoch_seconds[True]:.2f}x")
+    print(f"prefetch overlap={batches.overlap():.1%}, staging={batches.stage_seconds:.2f}s, "
+          f"waited for batches={batches.wait_seconds:.2f}s")
+
+
+def private_memory_bytes():
+    """Private dirty memory of the current process, pages copied on write after fork are counted here."""
+    with open("/proc/self/smaps_rollup") as smaps:
+        for line in smaps:
+            if line.startswith("Private_Dirty:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class MetadataPass(Dataset):
+    """Every item reads image paths and metadata of all frames, like a worker does during an epoch, and returns
+    private memory added to the worker by reading them."""
+
+    def __init__(self, image_paths, metadata, n_items):
+        self.image_paths = image_paths
+        self.metadata = metadata
+        self.n_items = n_items
+
+    def __getitem__(self, item):
+        before = private_memory_bytes()
+        for idx in range(len(self.image_paths)):
+            self.image_paths[idx]
+            for values in self.metadata:
+                values[idx]
+        return private_memory_bytes() - before
+
+    def __len__(self):
+        return self.n_items
+
+
+def benchmark_memory(dataset_paths, args):
+    dataset = NvidiaDataset(dataset_paths, camera=args.camera_name, metadata_file=args.metadata_file)
+    frames = pd.concat([dataset.read_dataset(dataset_path, args.camera_name) for dataset_path in dataset_paths])
+    compact = compact_frames(frames)
+    print(f"frames: pandas={frames.memory_usage(deep=True).sum() / 1024 ** 2:.2f} MB, "
+          f"compact={compact.memory_usage(deep=True).sum() / 1024 ** 2:.2f} MB")
+    if not isinstance(dataset.image_paths, ImagePaths):
+        print("Image file names are not timestamps, image paths are not compacted")
+        return
+
+    # frames are repeated to n_samples with shifted timestamps, so every frame gets its own path
+    n_repeats = -(-args.n_samples // len(dataset))
+    frame_ids = np.tile(np.arange(len(dataset)), n_repeats)[:args.n_samples]
+    shifts = np.repeat(np.arange(n_repeats), len(dataset))[:args.n_samples]
+    paths = dataset.image_paths
+    compact_paths = ImagePaths(paths.folders, paths.suffixes, paths.folder_ids[frame_ids],
+                               paths.timestamps[frame_ids] + shifts)
+    string_paths = np.asarray(compact_paths)
+    compact_metadata = [values[frame_ids] for values in [
+        dataset.camera_steering_angles, dataset.vehicle_speeds, dataset.autonomous, dataset.positions_x,
+        dataset.positions_y, dataset.yaws, dataset.turn_signals, dataset.row_ids]]
+    wide_metadata = [values.astype(np.float64) if values.dtype == np.float32 else values
+                     for values in compact_metadata]
+    string_bytes = string_paths.nbytes + sum(sys.getsizeof(path) for path in string_paths)
+    print(f"image paths of {args.n_samples} frames: strings={string_bytes / 1024 ** 2:.1f} MB, "
+          f"compact={compact_paths.nbytes / 1024 ** 2:.1f} MB")
+
+    n_workers = 1
+    while n_workers <= args.num_workers:
+        copied = {}
+        for name, image_paths, metadata in [("strings", string_paths, wide_metadata),
+                                            ("compact", compact_paths, compact_metadata)]:
+            loader = DataLoader(MetadataPass(image_paths, metadata, n_workers), batch_size=None,
+                                num_workers=n_workers)
+            copied[name] = sum(loader) / 1024 ** 2
+        print(f"{n_workers} workers, memory copied into workers: strings={copied['strings']:.1f} MB, "
+              f"compact={copied['compact']:.1f} MB")
+        n_workers *= 2
+
+
+def benchmark_readahead(dataset_paths, args):
+    dataset = NvidiaDataset(dataset_paths, transforms.Compose([CROP_TRANSFORMS[args.crop]()]),
+                            camera=args.camera_name, metadata_file=args.metadata_file, read_ahead=args.read_ahead,
+                            fused_decode=True)
+
+    def slow_read(path):
+        time.sleep(args.read_latency_ms / 1000)
+        return read_file(path)
+
+    dataset.reader.read = slow_read
+    batches = [np.random.randint(0, len(dataset), size=args.batch_size)
+               for _ in range(max(min(args.n_samples, 2000) // args.batch_size, 1))]
+    n_samples = sum(len(indices) for indices in batches)
+
+    # file of a frame is read only when it is decoded
+    start = time.perf_counter()
+    for indices in batches:
+        for idx in indices:
+            dataset.decode_buffer(idx, slow_read(dataset.image_paths[idx]))
+    blocking = n_samples / (time.perf_counter() - start)
+
+    dataset.read_stats.reset()
+    start = time.perf_counter()
+    for indices in batches:
+        for image in dataset.load_images(indices):
+            pass
+    read_ahead = n_samples / (time.perf_counter() - start)
+
+    reads = dataset.read_stats.summary()
+    histograms = dataset.read_stats.histograms()
+    print(f"read latency {args.read_latency_ms:.1f}ms, {args.read_ahead} reader threads: "
+          f"blocking={blocking:.0f} samples/s, read ahead={read_ahead:.0f} samples/s, "
+          f"speedup={read_ahead / blocking:.2f}x")
+    print(f"reads={reads['reads']}, read p50={reads['read_p50'] * 1000:.2f}ms, p99={reads['read_p99'] * 1000:.2f}ms, "
+          f"waited for reads={reads['wait_seconds']:.2f}s of {reads['read_seconds']:.2f}s reading, "
+          f"mean queue depth={reads['mean_queue_depth']:.1f}")
+    for name in ['read_latency', 'wait_latency']:
+        counts = histograms[name]
+        print(f"{name} histogram: " + ", ".join(f"<={edge * 1000:g}ms: {count}" for edge, count
+                                                 in zip(histograms['latency_bins'], counts) if count))
+    print("queue depth histogram: " + ", ".join(f"{depth}: {count}" for depth, count
+                                               in enumerate(histograms['queue_depth']) if count))
+
+
+def benchmark_parquet(dataset_paths, args):
+    parquet_file = Path(args.metadata_file).with_suffix(PARQUET_SUFFIX).name
+    dataset = NvidiaDataset(dataset_paths, camera=args.camera_name, output_modality=args.output_modality,
+                            metadata_file=args.metadata_file)
+    usecols = dataset.metadata_columns(args.camera_name)
+
+    def read_seconds(paths, metadata_file):
+        start = time.perf_counter()
+        n_rows = 0
+        for path in paths:
+            if type(path) is dict:
+                frames_df, _ = read_metadata(path['path'] / metadata_file, usecols, path['start'], path['end'])
+            else:
+                frames_df, _ = read_metadata(path / metadata_file, usecols)
+            n_rows += len(frames_df)
+        return time.perf_counter() - start, n_rows, len(frames_df.columns)
+
+    with tempfile.TemporaryDirectory() as parquet_dir:
+        # Parquet files are written into temporary drive folders, so dataset folder is not changed
+        parquet_paths = [Path(parquet_dir) / dataset_path.name for dataset_path in dataset_paths]
+        csv_bytes = parquet_bytes = 0
+        halves = []
+        for dataset_path, parquet_path in zip(dataset_paths, parquet_paths):
+            parquet_path.mkdir()
+            frames_df = pd.read_csv(dataset_path / args.metadata_file)
+            write_parquet(frames_df, parquet_path / parquet_file)
+            # second half of the drive, only its row groups are read
+            halves.append({'path': parquet_path, 'start': len(frames_df) // 2, 'end': None})
+            csv_bytes += (dataset_path / args.metadata_file).stat().st_size
+            parquet_bytes += (parquet_path / parquet_file).stat().st_size
+
+        csv_seconds, csv_rows, n_columns = read_seconds(dataset_paths, args.metadata_file)
+        parquet_seconds, parquet_rows, _ = read_seconds(parquet_paths, parquet_file)
+        half_seconds, half_rows, _ = read_seconds(halves, parquet_file)
+
+    print(f"metadata size: csv={csv_bytes / 1024 ** 2:.1f} MB, parquet={parquet_bytes / 1024 ** 2:.1f} MB, "
+          f"{n_columns} of {len(frames_df.columns)} columns read")
+    print(f"metadata reading: csv={csv_seconds:.3f}s ({csv_rows} rows), parquet={parquet_seconds:.3f}s "
+          f"({parquet_rows} rows), parquet second half={half_seconds:.3f}s ({half_rows} rows), "
+          f"speedup={csv_seconds / parquet_seconds:.1f}x")
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    root_path = Path(args.dataset_folder)
+    dataset_paths = [root_path / dataset_name for dataset_name in args.dataset_name]
+
+    if args.benchmark == 'getitem':
+        ds = NvidiaDataset(dataset_paths, camera=args.camera_name, output_modality=args.output_modality,
+                           metadata_file=args.metadata_file)
+        benchmark_getitem(ds, args.n_samples)
+    elif args.benchmark == 'shards':
+        benchmark_shards(dataset_paths, args)
+    elif args.benchmark == 'decode':
+        benchmark_decode(dataset_paths, args)
+    elif args.benchmark == 'metadata':
+        benchmark_metadata(dataset_paths, args)
+    elif args.benchmark == 'batch':
+        benchmark_batch(dataset_paths, args)
+    elif args.benchmark == 'augment':
+        benchmark_augment(dataset_paths, args)
+    elif args.benchmark == 'ipc':
+        benchmark_ipc(dataset_paths, args)
+    elif args.benchmark == 'sampler':
+        benchmark_sampler(dataset_paths, args)
+    elif args.benchmark == 'tar':
+        benchmark_tar(dataset_paths, args)
+    elif args.benchmark == 'lidar':
+        benchmark_lidar(dataset_paths, args)
+    elif args.benchmark == 'alias':
+        benchmark_alias(dataset_paths, args)
+    elif args.benchmark == 'mixture':
+        benchmark_mixture(dataset_paths, args)
+    elif args.benchmark == 'fusion':
+        benchmark_fusion(dataset_paths, args)
+    elif args.benchmark == 'temporal':
+        benchmark_temporal(dataset_paths, args)
+
+    elif args.benchmark == 'prefetch':
+        benchmark_prefetch(dataset_paths, args)
+
+    elif args.benchmark == 'memory':
+        benchmark_memory(dataset_paths, args)
+
+    elif args.benchmark == 'readahead':
+        benchmark_readahead(dataset_paths, args)
+
+    elif args.benchmark == 'parquet':
+        benchmark_parquet(dataset_paths, args)
@@ -0,0 +1,131 @@
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+from dataloading.build_shards import CROP_TRANSFORMS
+from dataloading.crop_band import band_folder, crop_band_rows, save_crop_band
+from dataloading.ouster import OUSTER_CROP_SHARDS
+
+CAMERA_CROPS = [crop for crop in CROP_TRANSFORMS if crop != OUSTER_CROP_SHARDS]
+
+
+def parse_arguments():
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        '--dataset-folder',
+        default="/home/romet/data2/datasets/rally-estonia/dataset-new-small/summer2021",
+        help='Root path to the dataset.'
+    )
+
+    argparser.add_argument(
+        '--dataset-name',
+        required=False,
+        action='append',
+        help='Drive to write crop band images for, can be given multiple times. '
+             'If not provided, crop band images are written for all drives in given folder.'
+    )
+
+    argparser.add_argument(
+        '--camera-name',
+        default="front_wide",
+        choices=['front_wide', 'left', 'right'],
+        help="Camera to write crop band images for."
+    )
+
+    argparser.add_argument(
+        '--crop',
+        nargs='+',
+        default=["nvidia-crop-wide", "crop-vit"],
+        choices=CAMERA_CROPS,
+        help="Crops that must stay usable, band contains the union of rows used by these crops."
+    )
+
+    argparser.add_argument(
+        '--metadata-file',
+        default="nvidia_frames.csv",
+        help='Dataset metadata file used to find camera images.'
+    )
+
+    argparser.add_argument(
+        '--num-workers',
+        type=int,
+        default=16,
+        help='Number of workers used for reading and writing images.'
+    )
+
+    return argparser.parse_args()
+
+
+class BandImageDataset(Dataset):
+    """Writes rows ymin to ymax of every image into output folder, returns height and bytes of input and output."""
+
+    def __init__(self, image_paths, output_path, ymin, ymax):
+        self.image_paths = image_paths
+        self.output_path = output_path
+        self.ymin = ymin
+        self.ymax = ymax
+
+    def __getitem__(self, idx):
+        image_path = Path(self.image_paths[idx])
+        # unchanged keeps color channels and bit depth of the original image
+        image = cv2.imread(str(image_path), cv2.IMREAD_UNCHANGED)
+        output_file = self.output_path / image_path.name
+        cv2.imwrite(str(output_file), image[self.ymin:self.ymax])
+        return np.array([image.shape[0], image_path.stat().st_size, output_file.stat().st_size])
+
+    def __len__(self):
+        return len(self.image_paths)
+
+
+def build_crop_band(dataset_path, camera, crops, metadata_file="nvidia_frames.csv", num_workers=16):
+    """
+    Writes rows of all camera images of a drive used by given crops into <camera>_band folder, with the same file
+    names. Band is recorded into crop_band.json of the drive after all images are written, NvidiaDataset with
+    crop_band reads images from the band folder and crop transforms shift their crop boxes by the first row of band.
+    """
+    ymin, ymax = crop_band_rows([CROP_TRANSFORMS[crop]() for crop in crops])
+    frames_df = pd.read_csv(dataset_path / metadata_file)
+    image_paths = [str(dataset_path / image_path) for image_path in frames_df[f"{camera}_filename"].dropna()]
+
+    output_path = dataset_path / band_folder(camera)
+    output_path.mkdir(parents=True, exist_ok=True)
+    loader = DataLoader(BandImageDataset(image_paths, output_path, ymin, ymax), batch_size=64, shuffle=False,
+                        num_workers=num_workers)
+    progress_bar = tqdm(total=len(image_paths))
+    progress_bar.set_description(f"Writing crop band of {dataset_path.name}")
+
+    image_heights = set()
+    input_bytes = 0
+    output_bytes = 0
+    for stats in loader:
+        image_heights.update(stats[:, 0].tolist())
+        input_bytes += int(stats[:, 1].sum())
+        output_bytes += int(stats[:, 2].sum())
+        progress_bar.update(len(stats))
+    progress_bar.close()
+
+    if len(image_heights) > 1 or max(image_heights, default=ymax) < ymax:
+        print(f"Images of {dataset_path.name} have heights {sorted(image_heights)}, expected uncropped images "
+              f"with at least {ymax} rows")
+        return
+    save_crop_band(dataset_path, camera, ymin, ymax, image_heights.pop() if image_heights else None, crops)
+    print(f"{dataset_path.name}: rows {ymin}-{ymax}, {input_bytes / 1024 ** 3:.2f} GB -> "
+          f"{output_bytes / 1024 ** 3:.2f} GB ({output_bytes / max(input_bytes, 1):.0%})")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    root_path = Path(args.dataset_folder)
+    if args.dataset_name:
+        dataset_paths = [root_path / dataset_name for dataset_name in args.dataset_name]
+    else:
+        dataset_paths = sorted(path for path in root_path.iterdir() if (path / args.metadata_file).exists())
+
+    for path in dataset_paths:
+        build_crop_band(path, args.camera_name, args.crop, args.metadata_file, args.num_workers)
@@ -0,0 +1,159 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torchvision
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+from dataloading.nvidia import NvidiaCropWide, CropViT, NvidiaResizeAndCrop
+from dataloading.ouster import OusterCrop, OusterDataset, OUSTER_CROP_SHARDS
+from dataloading.shards import SHARD_SIZE, MISSING, FULL_FRAME, shard_cache_path
+
+CROP_TRANSFORMS = {
+    "nvidia-crop-wide": NvidiaCropWide,
+    "crop-vit": CropViT,
+    "nvidia-resize-and-crop": NvidiaResizeAndCrop,
+    OUSTER_CROP_SHARDS: OusterCrop,
+}
+
+
+def parse_arguments():
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        '--dataset-folder',
+        default="/home/romet/data2/datasets/rally-estonia/dataset-new-small/summer2021",
+        help='Root path to the dataset.'
+    )
+
+    argparser.add_argument(
+        '--dataset-name',
+        required=False,
+        action='append',
+        help='Drive to build shards for, can be given multiple times. '
+             'If not provided, shards are built for all drives in given folder.'
+    )
+
+    argparser.add_argument(
+        '--input-modality',
+        default="nvidia-camera",
+        choices=['nvidia-camera', 'ouster-lidar'],
+        help="Input modality to build shards for. Lidar channels are written into separate planar shards, "
+             "metadata is read from lidar_frames.csv."
+    )
+
+    argparser.add_argument(
+        '--camera-name',
+        default="front_wide",
+        choices=['front_wide', 'left', 'right'],
+        help="Camera to build shards for, only used with 'nvidia-camera' modality."
+    )
+
+    argparser.add_argument(
+        '--crop',
+        default="nvidia-crop-wide",
+        choices=list(CROP_TRANSFORMS.keys()) + [FULL_FRAME],
+        help=f"Crop transform applied to images before writing them into shards, '{FULL_FRAME}' keeps whole images."
+    )
+
+    argparser.add_argument(
+        '--metadata-file',
+        default="nvidia_frames.csv",
+        help='Dataset metadata file used to find camera images, only used with \'nvidia-camera\' modality.'
+    )
+
+    argparser.add_argument(
+        '--num-workers',
+        type=int,
+        default=16,
+        help='Number of workers used for decoding images.'
+    )
+
+    return argparser.parse_args()
+
+
+class CropImageDataset(Dataset):
+    def __init__(self, image_paths, crop):
+        self.image_paths = image_paths
+        self.crop = CROP_TRANSFORMS[crop]() if crop != FULL_FRAME else None
+
+    def __getitem__(self, idx):
+        image = torchvision.io.read_image(self.image_paths[idx])
+        if self.crop:
+            image = self.crop({"image": image})["image"]
+        return image
+
+    def __len__(self):
+        return len(self.image_paths)
+
+
+def build_shard_cache(dataset_path, camera, crop, metadata_file="nvidia_frames.csv", num_workers=16, channels=None):
+    """
+    Decodes and crops all camera images of a drive once and writes them into uint8 .npy shards of SHARD_SIZE frames.
+    index.npy maps metadata row_id (row number in metadata file) to frame offset in shards, MISSING if row has no image.
+
+    With channels (map from channel name to channel index), every channel is written into separate planar shards under
+    <camera>_<channel>_<crop>, so reading a single channel reads only that channel from disk.
+    """
+    frames_df = pd.read_csv(dataset_path / metadata_file)
+    has_image = frames_df[f"{camera}_filename"].notna().to_numpy()
+    image_paths = [str(dataset_path / image_path) for image_path in frames_df[f"{camera}_filename"][has_image]]
+
+    index = np.full(len(frames_df), MISSING, dtype=np.int64)
+    index[has_image] = np.arange(len(image_paths))
+
+    if channels:
+        outputs = {shard_cache_path(dataset_path, f"{camera}_{name}", crop): [channel_idx]
+                   for name, channel_idx in channels.items()}
+    else:
+        outputs = {shard_cache_path(dataset_path, camera, crop): slice(None)}
+    for output_path in outputs:
+        output_path.mkdir(parents=True, exist_ok=True)
+
+    loader = DataLoader(CropImageDataset(image_paths, crop), batch_size=64, shuffle=False, num_workers=num_workers)
+    progress_bar = tqdm(total=len(image_paths))
+    progress_bar.set_description(f"Sharding {dataset_path.name}")
+
+    shards = {}
+    offset = 0
+    for images in loader:
+        for image in images.numpy():
+            shard_idx, shard_offset = divmod(offset, SHARD_SIZE)
+            for output_path, channel_idxs in outputs.items():
+                if shard_offset == 0:
+                    if output_path in shards:
+                        shards[output_path].flush()
+                    shard_len = min(SHARD_SIZE, len(image_paths) - offset)
+                    frame_shape = image[channel_idxs].shape
+                    shards[output_path] = np.lib.format.open_memmap(output_path / f"shard_{shard_idx:05d}.npy",
+                                                                    mode="w+", dtype=np.uint8,
+                                                                    shape=(shard_len,) + frame_shape)
+                shards[output_path][shard_offset] = image[channel_idxs]
+            offset += 1
+        progress_bar.update(len(images))
+
+    for output_path, shard in shards.items():
+        shard.flush()
+    # index is written last, so incomplete shard caches are not picked up by the dataset
+    for output_path in outputs:
+        np.save(output_path / "index.npy", index)
+    progress_bar.close()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    root_path = Path(args.dataset_folder)
+    if args.input_modality == "ouster-lidar":
+        camera, metadata_file, channels = "lidar", "lidar_frames.csv", OusterDataset.CHANNEL_MAP
+    else:
+        camera, metadata_file, channels = args.camera_name, args.metadata_file, None
+
+    if args.dataset_name:
+        dataset_paths = [root_path / dataset_name for dataset_name in args.dataset_name]
+    else:
+        dataset_paths = sorted(path for path in root_path.iterdir() if (path / metadata_file).exists())
+
+    for path in dataset_paths:
+        build_shard_cache(path, camera, args.crop, metadata_file, args.num_workers, channels)
@@ -0,0 +1,158 @@
+import argparse
+import io
+import json
+import tarfile
+from pathlib import Path
+
+from tqdm import tqdm
+
+from dataloading.nvidia import NvidiaDataset
+from dataloading.ouster import OusterDataset
+from dataloading.tar_shards import MANIFEST_FILE, tar_shards_path
+
+
+def parse_arguments():
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        '--dataset-folder',
+        default="/home/romet/data2/datasets/rally-estonia/dataset-new-small/summer2021",
+        help='Root path to the dataset.'
+    )
+
+    argparser.add_argument(
+        '--dataset-name',
+        required=False,
+        action='append',
+        help='Drive to build shards for, can be given multiple times. '
+             'If not provided, shards are built for all drives in given folder.'
+    )
+
+    argparser.add_argument(
+        '--input-modality',
+        default="nvidia-camera",
+        choices=['nvidia-camera', 'ouster-lidar'],
+        help="Input modality to build shards for."
+    )
+
+    argparser.add_argument(
+        '--camera-name',
+        default="front_wide",
+        choices=['front_wide', 'left', 'right'],
+        help="Camera to build shards for, only used with 'nvidia-camera' modality."
+    )
+
+    argparser.add_argument(
+        '--output-modality',
+        default="steering_angle",
+        choices=["steering_angle", "waypoints"],
+        help="Output modality, frames are filtered the same way as in NvidiaDataset."
+    )
+
+    argparser.add_argument(
+        '--num-waypoints',
+        type=int,
+        default=10,
+        help="Number of waypoints stored with 'waypoints' output modality."
+    )
+
+    argparser.add_argument(
+        '--metadata-file',
+        default="nvidia_frames.csv",
+        help='Dataset metadata file.'
+    )
+
+    argparser.add_argument(
+        '--shard-size-gb',
+        type=float,
+        default=1.0,
+        help='Approximate size of a single shard in GB.'
+    )
+
+    return argparser.parse_args()
+
+
+def tar_shards_name(input_modality, camera="front_wide", output_modality="steering_angle", n_waypoints=10):
+    if input_modality == "ouster-lidar":
+        return "lidar"
+    if output_modality == "waypoints":
+        return f"{camera}_waypoints_{n_waypoints}"
+    return f"{camera}_{output_modality}"
+
+
+def nvidia_metadata(dataset, idx):
+    metadata = {
+        'steering_angle': float(dataset.camera_steering_angles[idx]),
+        'target_steering_angle': float(dataset.steering_angles[idx]),
+        'vehicle_speed': float(dataset.vehicle_speeds[idx]),
+        'autonomous': bool(dataset.autonomous[idx]),
+        'position_x': float(dataset.positions_x[idx]),
+        'position_y': float(dataset.positions_y[idx]),
+        'yaw': float(dataset.yaws[idx]),
+        'turn_signal': int(dataset.turn_signals[idx]),
+        'row_id': int(dataset.row_ids[idx]),
+    }
+    if dataset.output_modality == "waypoints":
+        metadata['waypoints'] = dataset.waypoints[idx].reshape(-1).tolist()
+    return metadata
+
+
+def ouster_metadata(dataset, idx):
+    return {
+        'steering_angle': float(dataset.steering_angles[idx]),
+        'vehicle_speed': float(dataset.vehicle_speeds[idx]),
+        'turn_signal': int(dataset.turn_signals[idx]),
+        'row_id': int(dataset.row_ids[idx]),
+    }
+
+
+def write_tar_shards(dataset, sample_metadata, output_path, shard_bytes=1024 ** 3):
+    """
+    Packs encoded images and metadata of all samples of the dataset into tar shards of about shard_bytes. Every sample
+    is stored as image file followed by JSON metadata file with the same name. Manifest listing shards and number of
+    samples in them is written last, so incomplete shards are not picked up by TarShardDataset.
+    """
+    output_path.mkdir(parents=True, exist_ok=True)
+    shards = []
+    tar = None
+
+    for idx in tqdm(range(len(dataset)), desc=f"Writing {output_path}"):
+        if tar is None or tar.offset >= shard_bytes:
+            if tar is not None:
+                tar.close()
+            shards.append({"name": f"shard_{len(shards):05d}.tar", "n_samples": 0})
+            tar = tarfile.open(output_path / shards[-1]["name"], mode="w")
+
+        image_path = Path(dataset.image_paths[idx])
+        tar.add(image_path, arcname=f"{idx:09d}{image_path.suffix}")
+        metadata = json.dumps(sample_metadata(dataset, idx)).encode()
+        metadata_info = tarfile.TarInfo(f"{idx:09d}.json")
+        metadata_info.size = len(metadata)
+        tar.addfile(metadata_info, io.BytesIO(metadata))
+        shards[-1]["n_samples"] += 1
+
+    if tar is not None:
+        tar.close()
+    with open(output_path / MANIFEST_FILE, "w") as manifest_file:
+        json.dump({"shards": shards}, manifest_file, indent=2)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    root_path = Path(args.dataset_folder)
+    metadata_file = "lidar_frames.csv" if args.input_modality == "ouster-lidar" else args.metadata_file
+    if args.dataset_name:
+        dataset_paths = [root_path / dataset_name for dataset_name in args.dataset_name]
+    else:
+        dataset_paths = sorted(path for path in root_path.iterdir() if (path / metadata_file).exists())
+
+    name = tar_shards_name(args.input_modality, args.camera_name, args.output_modality, args.num_waypoints)
+    shard_bytes = int(args.shard_size_gb * 1024 ** 3)
+    for path in dataset_paths:
+        if args.input_modality == "ouster-lidar":
+            ds = OusterDataset([path])
+            write_tar_shards(ds, ouster_metadata, tar_shards_path(path, name), shard_bytes)
+        else:
+            ds = NvidiaDataset([path], camera=args.camera_name, output_modality=args.output_modality,
+                               n_waypoints=args.num_waypoints, metadata_file=args.metadata_file)
+            write_tar_shards(ds, nvidia_metadata, tar_shards_path(path, name), shard_bytes)
@@ -0,0 +1,171 @@
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as functional
+import torchvision.transforms.functional as F
+
+from dataloading.nvidia import AugmentationConfig, AugmentImage, BatchAugmentImage, Normalize
+
+# Quantiles of per image statistics printed for AugmentImage and BatchAugmentImage
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+# Kolmogorov-Smirnov coefficient of distributions of per image ratios, distributions differ at 0.1% significance
+KS_COEFFICIENT = 1.95
+# Largest allowed relative difference of noise statistics
+NOISE_TOLERANCE = 0.1
+# Largest allowed difference of shares of images, in standard deviations of difference of two binomial shares
+SHARE_DEVIATIONS = 4
+
+LAPLACIAN = torch.tensor([[0.0, 1.0, 0.0], [1.0, -4.0, 1.0], [0.0, 1.0, 0.0]])
+
+
+def parse_arguments():
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        '--n-images',
+        type=int,
+        default=1000,
+        help='Number of synthetic images augmented with every augmentation.'
+    )
+
+    argparser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed of synthetic images and augmentations.'
+    )
+
+    return argparser.parse_args()
+
+
+def synthetic_images(n_images, height=66, width=200, seed=0):
+    """
+    Normalized uint8 images with smooth color regions and fine texture, values are kept away from 0 and 255, so noise
+    and color changes are mostly not clipped.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    regions = torch.rand((n_images, 3, height // 11, width // 25), generator=generator)
+    regions = functional.interpolate(regions, size=(height, width), mode="bilinear", align_corners=False)
+    texture = torch.rand((n_images, 3, height, width), generator=generator)
+    images = (40 + 150 * regions + 30 * texture).round().to(torch.uint8)
+    return Normalize()({"image": images})["image"]
+
+
+def per_sample_augment(images, config, seed):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    augment = AugmentImage(config)
+    return torch.stack([augment({"image": image.clone()})["image"].float() for image in images])
+
+
+def batch_augment(images, config, seed):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    return BatchAugmentImage(config)(images.clone())
+
+
+def color_statistics(images, augmented):
+    """Ratios of brightness, contrast and saturation of every augmented image to the original image."""
+    def saturation(image):
+        return (image - F.rgb_to_grayscale(image)).abs().mean(dim=(1, 2, 3))
+
+    return {
+        "brightness": augmented.mean(dim=(1, 2, 3)) / images.mean(dim=(1, 2, 3)),
+        "contrast": augmented.std(dim=(1, 2, 3)) / images.std(dim=(1, 2, 3)),
+        "saturation": saturation(augmented) / saturation(images),
+    }
+
+
+def noise_statistics(images, augmented):
+    """
+    Images with gaussian noise, variance of gaussian noise and share of pixels set to white by salt noise. Salt noise
+    changes under 1% of pixels, gaussian noise nearly all of them.
+    """
+    difference = augmented - images
+    changed = (difference.abs() > 1e-6).float().mean(dim=(1, 2, 3))
+    gaussian = changed > 0.5
+    return {
+        "gaussian images": gaussian,
+        "gaussian variance": difference[gaussian].var(),
+        "salt share": changed[~gaussian].mean(),
+    }
+
+
+def blur_statistics(images, augmented):
+    """Ratio of high frequency energy, measured with Laplacian filter, of every blurred image to the original image."""
+    kernel = LAPLACIAN.reshape(1, 1, 3, 3).repeat(3, 1, 1, 1)
+
+    def energy(image):
+        return functional.conv2d(image, kernel, groups=3).pow(2).mean(dim=(1, 2, 3))
+
+    return {"high frequency": energy(augmented) / energy(images)}
+
+
+def ks_statistic(first, second):
+    """Largest difference between empirical distribution functions of two samples."""
+    first, second = first.sort().values, second.sort().values
+    values = torch.cat([first, second])
+    first_cdf = torch.searchsorted(first, values, right=True) / len(first)
+    second_cdf = torch.searchsorted(second, values, right=True) / len(second)
+    return (first_cdf - second_cdf).abs().max().item()
+
+
+def compare_distributions(name, per_sample, batched):
+    per_sample_quantiles = torch.quantile(per_sample, torch.tensor(QUANTILES))
+    batched_quantiles = torch.quantile(batched, torch.tensor(QUANTILES))
+    statistic = ks_statistic(per_sample, batched)
+    critical = KS_COEFFICIENT * np.sqrt((len(per_sample) + len(batched)) / (len(per_sample) * len(batched)))
+    print(f"{name}: quantiles per sample={np.round(per_sample_quantiles.numpy(), 3)}, "
+          f"batched={np.round(batched_quantiles.numpy(), 3)}, KS statistic={statistic:.3f}")
+    assert statistic <= critical, f"{name} distributions differ, KS statistic {statistic:.3f} > {critical:.3f}"
+
+
+def compare_values(name, per_sample, batched):
+    difference = abs(per_sample.item() - batched.item()) / max(abs(per_sample.item()), 1e-12)
+    print(f"{name}: per sample={per_sample.item():.5f}, batched={batched.item():.5f}")
+    assert difference <= NOISE_TOLERANCE, f"{name} differs by {difference:.1%}"
+
+
+def compare_shares(name, per_sample, batched):
+    per_sample_share = per_sample.float().mean().item()
+    batched_share = batched.float().mean().item()
+    share = (per_sample_share + batched_share) / 2
+    tolerance = SHARE_DEVIATIONS * np.sqrt(2 * share * (1 - share) / len(per_sample))
+    print(f"{name}: share per sample={per_sample_share:.3f}, batched={batched_share:.3f}")
+    assert abs(per_sample_share - batched_share) <= tolerance, f"{name} shares differ by more than {tolerance:.3f}"
+
+
+def compare(name, per_sample, batched):
+    """Compares shares of boolean per image statistics, distributions of per image values and single values."""
+    if per_sample.dtype == torch.bool:
+        compare_shares(name, per_sample, batched)
+    elif per_sample.dim() == 1:
+        compare_distributions(name, per_sample, batched)
+    else:
+        compare_values(name, per_sample, batched)
+
+
+def check_augment_equivalence(n_images=1000, seed=0):
+    """
+    Checks that BatchAugmentImage draws the same augmentations as AugmentImage, by comparing distributions of per
+    image statistics of color jitter, noise and blur on synthetic images. Augmentations are random and drawn
+    differently, so only statistics over images are compared. Fails with AssertionError on mismatch.
+    """
+    images = synthetic_images(n_images, seed=seed)
+    checks = [
+        ("color", AugmentationConfig(color_prob=1.0), color_statistics),
+        ("noise", AugmentationConfig(noise_prob=1.0), noise_statistics),
+        ("blur", AugmentationConfig(blur_prob=1.0), blur_statistics),
+    ]
+    for name, config, statistics in checks:
+        per_sample = statistics(images, per_sample_augment(images, config, seed))
+        batched = statistics(images, batch_augment(images, config, seed))
+        for statistic in per_sample:
+            compare(f"{name} {statistic}", per_sample[statistic], batched[statistic])
+    print("batch augmentation matches per sample augmentation")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    check_augment_equivalence(args.n_images, args.seed)
@@ -0,0 +1,80 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataloading.compact import FLOAT64_COLUMNS, TIMESTAMP_COLUMN
+from dataloading.metadata import atomic_write
+
+PARQUET_SUFFIX = ".parquet"
+# Metadata rows per Parquet row group, reading a range of a drive given with start and end reads only the row groups
+# overlapping it
+ROW_GROUP_SIZE = 2048
+
+
+def import_parquet():
+    # pyarrow is only needed for Parquet metadata files, so it's imported only when one is read or written
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        print("Parquet metadata files need pyarrow, install it with 'pip install pyarrow'")
+        sys.exit()
+    return pyarrow, pyarrow.parquet
+
+
+def is_parquet(metadata_path):
+    return Path(metadata_path).suffix == PARQUET_SUFFIX
+
+
+def read_metadata(metadata_path, usecols=None, start=None, end=None):
+    """
+    Reads rows start to end of a CSV or Parquet metadata file, only columns for which usecols(column) is true if usecols
+    is given. Index of returned frames is the position of rows in the file. Returns frames and number of rows in the
+    file. From Parquet files, only row groups overlapping the rows are read.
+    """
+    if is_parquet(metadata_path):
+        return read_parquet(metadata_path, usecols, start, end)
+
+    frames_df = pd.read_csv(metadata_path, usecols=usecols)
+    return frames_df.iloc[start:end], len(frames_df)
+
+
+def read_parquet(metadata_path, usecols=None, start=None, end=None):
+    _, parquet = import_parquet()
+    parquet_file = parquet.ParquetFile(metadata_path)
+    metadata = parquet_file.metadata
+    columns = parquet_file.schema_arrow.names
+    if usecols is not None:
+        columns = [column for column in columns if usecols(column)]
+
+    rows = range(metadata.num_rows)[start:end]
+    group_starts = np.cumsum([0] + [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+    groups = [i for i in range(metadata.num_row_groups)
+              if group_starts[i] < rows.stop and group_starts[i + 1] > rows.start]
+    frames_df = parquet_file.read_row_groups(groups, columns=columns).to_pandas()
+
+    # rows before start in the first row group and after end in the last row group are dropped
+    offset = rows.start - group_starts[groups[0]] if groups else 0
+    frames_df = frames_df.iloc[offset:offset + len(rows)]
+    frames_df.index = pd.RangeIndex(rows.start, rows.start + len(frames_df))
+    return frames_df, metadata.num_rows
+
+
+def write_parquet(frames_df, parquet_path, row_group_size=ROW_GROUP_SIZE):
+    """
+    Writes metadata frames into Parquet file with float columns stored as float32, except for global positions, and
+    metadata row timestamps as timestamps.
+    """
+    pyarrow, parquet = import_parquet()
+    columns = {}
+    for column in frames_df.columns:
+        values = frames_df[column]
+        if column == TIMESTAMP_COLUMN and values.dtype == object:
+            values = pd.to_datetime(values)
+        elif values.dtype == np.float64 and column not in FLOAT64_COLUMNS:
+            values = values.astype(np.float32)
+        columns[column] = values
+    table = pyarrow.Table.from_pandas(pd.DataFrame(columns), preserve_index=False)
+    atomic_write(parquet_path, lambda tmp_path: parquet.write_table(table, tmp_path, row_group_size=row_group_size))
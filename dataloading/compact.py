@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+# Positions are global coordinates, float32 would lose centimetre precision
+FLOAT64_COLUMNS = ["position_x", "position_y", "position_z"]
+# Timestamp of the metadata row, stored as datetime64 instead of strings
+TIMESTAMP_COLUMN = "index"
+# Paths of image files, replaced by ImagePaths
+PATH_COLUMNS = r"image_path|.*_filename"
+
+
+class ImagePaths:
+    """
+    Image paths of frames stored as folder id and integer timestamp of the image file, instead of one Python string
+    per frame. Dataloader workers are forked from the main process and indexing array of strings updates reference
+    counts of the strings, which copies every memory page with strings into every worker. Paths are only created when
+    a single path is read, arrays of integers are never copied.
+
+    Indexing with an integer returns the path as string, indexing with an array or slice returns ImagePaths of the
+    selected frames. Converting to numpy array creates array of strings.
+    """
+
+    def __init__(self, folders, suffixes, folder_ids, timestamps):
+        self.folders = folders
+        self.suffixes = suffixes
+        self.folder_ids = folder_ids
+        self.timestamps = timestamps
+
+    @classmethod
+    def from_paths(cls, image_paths):
+        """Returns ImagePaths if every file name is integer timestamp, otherwise array of given paths."""
+        paths = pd.Series(image_paths, dtype=object)
+        parts = paths.str.extract(r"^(?P<folder>.*)/(?P<timestamp>[1-9][0-9]{0,18}|0)(?P<suffix>\.[^./]+)$")
+        if len(paths) == 0 or parts["timestamp"].isna().any():
+            return np.asarray(image_paths, dtype=object)
+
+        folder_ids, folder_keys = pd.MultiIndex.from_frame(parts[["folder", "suffix"]]).factorize()
+        return cls(list(folder_keys.get_level_values(0)), list(folder_keys.get_level_values(1)),
+                   folder_ids.astype(np.int32),
+                   parts["timestamp"].to_numpy().astype(np.int64))
+
+    @classmethod
+    def concatenate(cls, image_paths):
+        """ImagePaths of frames of all given ImagePaths in order, folders shared by them get one id."""
+        folder_keys = {}
+        folder_ids = []
+        for paths in image_paths:
+            remap = np.array([folder_keys.setdefault(key, len(folder_keys))
+                              for key in zip(paths.folders, paths.suffixes)], dtype=np.int32)
+            folder_ids.append(remap[paths.folder_ids])
+        return cls([folder for folder, _ in folder_keys], [suffix for _, suffix in folder_keys],
+                   np.concatenate(folder_ids).astype(np.int32),
+                   np.concatenate([paths.timestamps for paths in image_paths]).astype(np.int64))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            folder_id = self.folder_ids[idx]
+            return f"{self.folders[folder_id]}/{self.timestamps[idx]}{self.suffixes[folder_id]}"
+        return ImagePaths(self.folders, self.suffixes, self.folder_ids[idx], self.timestamps[idx])
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(list(self), dtype=dtype if dtype is not None else object)
+
+    @property
+    def nbytes(self):
+        return self.folder_ids.nbytes + self.timestamps.nbytes
+
+    def folder_of_frames(self):
+        """Folder of every frame as array of strings, strings are shared by all frames of a folder."""
+        return np.array(self.folders, dtype=object)[self.folder_ids]
+
+
+def compact_frames(frames_df):
+    """
+    Frames with image paths left out, see ImagePaths, and columns stored in smaller types: string columns like
+    camera_type as categoricals, integer columns as the smallest integer type fitting the values and float columns
+    as float32, except for global positions. Metadata row timestamps are stored as datetime64.
+    """
+    frames_df = frames_df.loc[:, ~frames_df.columns.str.fullmatch(PATH_COLUMNS)]
+    columns = {}
+    for column in frames_df.columns:
+        values = frames_df[column]
+        if column == TIMESTAMP_COLUMN and values.dtype == object:
+            values = pd.to_datetime(values)
+        elif values.dtype == object:
+            values = values.astype("category")
+        elif pd.api.types.is_integer_dtype(values.dtype) and len(values) > 0:
+            values = pd.to_numeric(values, downcast="integer")
+        elif values.dtype == np.float64 and column not in FLOAT64_COLUMNS:
+            values = values.astype(np.float32)
+        columns[column] = values
+    compacted = pd.DataFrame(columns, index=frames_df.index)
+    compacted.attrs = frames_df.attrs
+    return compacted
+
@@ -0,0 +1,85 @@
+import argparse
+import functools
+from pathlib import Path
+
+import pandas as pd
+
+from dataloading.columnar import PARQUET_SUFFIX, ROW_GROUP_SIZE, write_parquet
+from dataloading.incremental import run_incremental
+
+# Increase when Parquet layout changes, so existing Parquet metadata files are written again
+PARQUET_VERSION = 1
+
+
+def parse_arguments():
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        '--dataset-folder',
+        default="/home/romet/data2/datasets/rally-estonia/dataset-new-small/summer2021",
+        help='Root path to the dataset.'
+    )
+
+    argparser.add_argument(
+        '--dataset-name',
+        required=False,
+        action='append',
+        help='Drive to convert metadata of, can be given multiple times. '
+             'If not provided, metadata of all drives in given folder is converted.'
+    )
+
+    argparser.add_argument(
+        '--metadata-file',
+        default="nvidia_frames_ext.csv",
+        help='CSV metadata file to convert, Parquet file with the same name is written next to it.'
+    )
+
+    argparser.add_argument(
+        '--row-group-size',
+        type=int,
+        default=ROW_GROUP_SIZE,
+        help='Number of metadata rows in a Parquet row group.'
+    )
+
+    argparser.add_argument(
+        '--num-workers',
+        type=int,
+        default=8,
+        help='Number of processes converting drives in parallel.'
+    )
+
+    argparser.add_argument(
+        '--force',
+        default=False,
+        action='store_true',
+        help='Convert drives again even if their Parquet file is up to date.'
+    )
+
+    return argparser.parse_args()
+
+
+def convert_drive(dataset_path, metadata_file, row_group_size=ROW_GROUP_SIZE):
+    frames_df = pd.read_csv(dataset_path / metadata_file)
+    write_parquet(frames_df, dataset_path / Path(metadata_file).with_suffix(PARQUET_SUFFIX), row_group_size)
+
+
+def convert_metadata(dataset_paths, metadata_file, row_group_size=ROW_GROUP_SIZE, num_workers=8, force=False):
+    """
+    Writes CSV metadata file of every drive as Parquet file with the same name, drives whose Parquet file is up to
+    date with the CSV file are skipped. NvidiaDataset reads Parquet file when given as metadata_file.
+    """
+    return run_incremental(functools.partial(convert_drive, metadata_file=metadata_file, row_group_size=row_group_size),
+                           dataset_paths, Path(metadata_file).with_suffix(PARQUET_SUFFIX).name,
+                           lambda dataset_path: [dataset_path / metadata_file], PARQUET_VERSION, num_workers, force,
+                           description="Converting metadata")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    root_path = Path(args.dataset_folder)
+    if args.dataset_name:
+        dataset_paths = [root_path / dataset_name for dataset_name in args.dataset_name]
+    else:
+        dataset_paths = sorted(path for path in root_path.iterdir() if (path / args.metadata_file).exists())
+
+    convert_metadata(dataset_paths, args.metadata_file, args.row_group_size, args.num_workers, args.force)
@@ -0,0 +1,48 @@
+import json
+from pathlib import Path
+
+from dataloading.metadata import atomic_write
+
+# Drive metadata of crop band images written by build_crop_band.py, maps camera to its band
+CROP_BAND_FILE = "crop_band.json"
+BAND_FOLDER_SUFFIX = "_band"
+# Key of the first image row stored in band image, crop transforms shift their crop box by it
+ROW_OFFSET = "row_offset"
+
+
+def band_folder(camera):
+    return f"{camera}{BAND_FOLDER_SUFFIX}"
+
+
+def crop_band_rows(crops):
+    """
+    Union of image rows used by given crop transforms with crop_box method, as first row and row after the last.
+    Third value of crop box is the height of the crop in the original image.
+    """
+    boxes = [crop.crop_box() for crop in crops]
+    return min(box[0] for box in boxes), max(box[0] + box[2] for box in boxes)
+
+
+def read_crop_bands(dataset_path):
+    crop_band_path = Path(dataset_path) / CROP_BAND_FILE
+    if not crop_band_path.exists():
+        return {}
+    with open(crop_band_path) as crop_band_file:
+        return json.load(crop_band_file)
+
+
+def save_crop_band(dataset_path, camera, ymin, ymax, image_height, crops):
+    crop_bands = read_crop_bands(dataset_path)
+    crop_bands[camera] = {
+        "folder": band_folder(camera),
+        "ymin": ymin,
+        "ymax": ymax,
+        "image_height": image_height,
+        "crops": crops,
+    }
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as crop_band_file:
+            json.dump(crop_bands, crop_band_file, indent=2)
+
+    atomic_write(Path(dataset_path) / CROP_BAND_FILE, write)
@@ -0,0 +1,99 @@
+import multiprocessing
+
+import numpy as np
+import torch
+from torchvision import transforms
+
+from dataloading.compact import ImagePaths
+
+EMPTY = -1
+
+
+class SharedFrameCache:
+    """
+    Byte budgeted cache of decoded frames shared by all dataloader worker processes. Frames are stored in fixed size
+    slots of a single shared memory tensor. Must be created in the main process before dataloader workers are started.
+
+    Free slots are filled first, after that random slot is evicted. Unlike FIFO or LRU, random eviction still gives
+    hits when dataset larger than the cache is read in the same order every epoch (validation).
+
+    Keys are integer ids of image paths, see key_ids. Slot owners are checked again after copying frame out of slot, so
+    frame that was evicted by another worker during the copy is treated as a cache miss.
+    """
+
+    def __init__(self, n_keys, frame_shape, byte_budget, dtype=torch.uint8):
+        frame_bytes = int(np.prod(frame_shape)) * torch.empty((), dtype=dtype).element_size()
+        self.n_slots = int(min(byte_budget // frame_bytes, n_keys))
+        print(f"Frame cache: {self.n_slots} slots of {tuple(frame_shape)} for {n_keys} frames, "
+              f"{self.n_slots * frame_bytes / 1024 ** 3:.2f} GB")
+
+        self.frames = torch.empty((self.n_slots,) + tuple(frame_shape), dtype=dtype).share_memory_()
+        self.slot_owners = torch.full((self.n_slots,), EMPTY, dtype=torch.int64).share_memory_()
+        self.key_slots = torch.full((n_keys,), EMPTY, dtype=torch.int64).share_memory_()
+        # number of used slots, hit and miss counts
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+    def get(self, key):
+        # hit and miss counts are updated without lock and are approximate
+        slot = int(self.key_slots[key])
+        if slot != EMPTY and self.slot_owners[slot] == key:
+            frame = self.frames[slot].clone()
+            if self.slot_owners[slot] == key:
+                self.counters[1] += 1
+                return frame
+        self.counters[2] += 1
+        return None
+
+    def put(self, key, frame):
+        if self.n_slots == 0:
+            return
+        with self.lock:
+            if self.key_slots[key] != EMPTY:
+                return
+            if self.counters[0] < self.n_slots:
+                slot = int(self.counters[0])
+                self.counters[0] += 1
+            else:
+                slot = int(torch.randint(self.n_slots, ()))
+
+            evicted_key = int(self.slot_owners[slot])
+            if evicted_key != EMPTY:
+                self.key_slots[evicted_key] = EMPTY
+            self.slot_owners[slot] = EMPTY
+            self.frames[slot].copy_(frame)
+            self.key_slots[key] = slot
+            self.slot_owners[slot] = key
+
+    def stats(self):
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1),
+            'cached_frames': int((self.slot_owners != EMPTY).sum()),
+        }
+
+
+def key_ids(image_paths):
+    """Maps image paths to integer cache keys, same path gets the same key."""
+    if isinstance(image_paths, ImagePaths):
+        image_keys = np.stack([image_paths.folder_ids.astype(np.int64), image_paths.timestamps], axis=1)
+        unique_keys, keys = np.unique(image_keys, axis=0, return_inverse=True)
+        return len(unique_keys), keys.reshape(-1)
+    unique_paths, keys = np.unique(image_paths, return_inverse=True)
+    return len(unique_paths), keys
+
+
+def split_crop_transforms(transform):
+    """
+    Splits leading crop transforms (transforms with crop_box method) off from transforms.Compose, so frames can be
+    cached after cropping but before augmentation and normalization.
+    """
+    if not isinstance(transform, transforms.Compose):
+        return [], transform
+
+    n_crops = 0
+    while n_crops < len(transform.transforms) and hasattr(transform.transforms[n_crops], "crop_box"):
+        n_crops += 1
+    return transform.transforms[:n_crops], transforms.Compose(transform.transforms[n_crops:])
@@ -0,0 +1,148 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+from dataloading.columnar import read_metadata
+from dataloading.compact import ImagePaths
+from dataloading.metadata import join_index_cache_path, save_join_index
+from dataloading.nvidia import NvidiaDataset
+from dataloading.ouster import OusterDataset
+
+MISSING = -1
+
+
+def read_timestamps(metadata_path):
+    """Timestamps of metadata rows in nanoseconds, index column of the metadata files written by image_extractor.py."""
+    timestamps = read_metadata(metadata_path, usecols=lambda column: column == "index")[0]["index"]
+    return pd.to_datetime(timestamps).to_numpy().astype(np.int64)
+
+
+def timestamp_join(camera_timestamps, lidar_timestamps, max_time_difference):
+    """
+    Row of the lidar frame nearest in time to every camera frame, MISSING if there is no lidar frame closer than
+    max_time_difference seconds.
+    """
+    if len(lidar_timestamps) == 0:
+        return np.full(len(camera_timestamps), MISSING, dtype=np.int64)
+
+    lidar_order = np.argsort(lidar_timestamps, kind="stable")
+    sorted_timestamps = lidar_timestamps[lidar_order]
+    after = np.clip(np.searchsorted(sorted_timestamps, camera_timestamps), 0, len(sorted_timestamps) - 1)
+    before = np.clip(after - 1, 0, len(sorted_timestamps) - 1)
+    before_difference = np.abs(camera_timestamps - sorted_timestamps[before])
+    after_difference = np.abs(camera_timestamps - sorted_timestamps[after])
+    nearest = np.where(before_difference <= after_difference, before, after)
+    difference = np.minimum(before_difference, after_difference)
+    return np.where(difference <= max_time_difference * 1e9, lidar_order[nearest], MISSING)
+
+
+def drive_join_index(dataset_path, camera_metadata_file, max_time_difference, cache_dir=None):
+    camera_metadata_path = Path(dataset_path) / camera_metadata_file
+    lidar_metadata_path = Path(dataset_path) / "lidar_frames.csv"
+    cache_path = None
+    if cache_dir:
+        cache_path = join_index_cache_path(cache_dir, camera_metadata_path, lidar_metadata_path, max_time_difference)
+        if cache_path.exists():
+            return np.load(cache_path)
+
+    join_index = timestamp_join(read_timestamps(camera_metadata_path), read_timestamps(lidar_metadata_path),
+                                max_time_difference)
+    if cache_path:
+        save_join_index(join_index, cache_path)
+    return join_index
+
+
+def drive_of_frames(image_paths):
+    """Drive folder of every frame, images are stored in <drive>/<camera or lidar>/<timestamp>.<ext>."""
+    if isinstance(image_paths, ImagePaths):
+        drives = np.array([folder.rsplit("/", 1)[0] for folder in image_paths.folders], dtype=object)
+        return drives[image_paths.folder_ids]
+    return pd.Series(image_paths, dtype=object).str.rsplit("/", n=2).str[0].to_numpy()
+
+
+class NvidiaOusterDataset(Dataset):
+    """
+    Camera frames of NvidiaDataset together with the lidar frame nearest in time. Camera and lidar metadata are joined
+    on timestamps once per drive and the join is cached into metadata_cache_dir, samples only look up the joined
+    index. Camera frames without lidar frame within max_time_difference seconds are left out.
+
+    Samples are the same as samples of NvidiaDataset, with lidar image added as 'lidar_image' and its metadata row as
+    'lidar_row_id'. Lidar frames are shared by several camera frames, so lidar frame cache or lidar shards make
+    reading lidar frames much cheaper.
+    """
+
+    def __init__(self, dataset_paths, transform=None, lidar_transform=None, max_time_difference=0.05,
+                 lidar_channel=None, lidar_shard_cache=None, lidar_frame_cache_bytes=0, metadata_cache_dir=None,
+                 **camera_kwargs):
+        self.camera_dataset = NvidiaDataset(dataset_paths, transform, metadata_cache_dir=metadata_cache_dir,
+                                            **camera_kwargs)
+        # lidar metadata is not sliced with start and end of the camera metadata, frames are selected by the join
+        drive_paths = [dataset_path['path'] if type(dataset_path) is dict else dataset_path
+                       for dataset_path in dataset_paths]
+        self.lidar_dataset = OusterDataset(drive_paths, lidar_transform, channel=lidar_channel,
+                                           shard_cache=lidar_shard_cache, frame_cache_bytes=lidar_frame_cache_bytes)
+
+        self.lidar_row_ids = self.lidar_dataset.frames["row_id"].to_numpy(dtype=np.int64)
+        self.camera_indices, self.lidar_indices = self.create_join_index(drive_paths, max_time_difference,
+                                                                         metadata_cache_dir)
+        self.frames = self.camera_dataset.frames.iloc[self.camera_indices]
+        self.image_paths = self.camera_dataset.image_paths[self.camera_indices]
+        print(f"Matched lidar frames to {len(self.camera_indices)} of {len(self.camera_dataset)} camera frames")
+
+    def create_join_index(self, drive_paths, max_time_difference, cache_dir):
+        camera_drives = drive_of_frames(self.camera_dataset.image_paths)
+        lidar_drives = drive_of_frames(self.lidar_dataset.image_paths)
+        camera_row_ids = self.camera_dataset.row_ids
+
+        camera_indices = []
+        lidar_indices = []
+        for drive_path in drive_paths:
+            join_index = drive_join_index(drive_path, self.camera_dataset.metadata_file, max_time_difference,
+                                          cache_dir)
+            drive_camera_indices = np.flatnonzero(camera_drives == str(drive_path))
+            drive_lidar_indices = np.flatnonzero(lidar_drives == str(drive_path))
+            lidar_rows = join_index[camera_row_ids[drive_camera_indices]]
+
+            # lidar frames of a drive are sorted by row, rows removed by OusterDataset filtering are not matched
+            drive_lidar_rows = self.lidar_row_ids[drive_lidar_indices]
+            positions = np.clip(np.searchsorted(drive_lidar_rows, lidar_rows), 0, max(len(drive_lidar_rows) - 1, 0))
+            matched = (lidar_rows != MISSING) & (len(drive_lidar_rows) > 0)
+            matched[matched] = drive_lidar_rows[positions[matched]] == lidar_rows[matched]
+
+            camera_indices.append(drive_camera_indices[matched])
+            lidar_indices.append(drive_lidar_indices[positions[matched]])
+
+        return np.concatenate(camera_indices), np.concatenate(lidar_indices)
+
+    def load_lidar_image(self, lidar_idx):
+        image = self.lidar_dataset.load_image(lidar_idx)
+        if self.lidar_dataset.transform:
+            image = self.lidar_dataset.transform({"image": image})["image"]
+        return image
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, np.ndarray)):
+            return self.get_batch(idx)
+
+        data, target, conditional_mask = self.camera_dataset[int(self.camera_indices[idx])]
+        lidar_idx = int(self.lidar_indices[idx])
+        data['lidar_image'] = self.load_lidar_image(lidar_idx)
+        data['lidar_row_id'] = self.lidar_row_ids[lidar_idx]
+        return data, target, conditional_mask
+
+    def get_batch(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        data, target, conditional_mask = self.camera_dataset.get_batch(self.camera_indices[indices])
+        lidar_indices = self.lidar_indices[indices]
+        data['lidar_image'] = torch.stack([self.load_lidar_image(lidar_idx) for lidar_idx in lidar_indices])
+        data['lidar_row_id'] = torch.from_numpy(self.lidar_row_ids[lidar_indices])
+        return data, target, conditional_mask
+
+    def __len__(self):
+        return len(self.camera_indices)
+
+    def get_waypoints(self):
+        return self.camera_dataset.get_waypoints()[self.camera_indices]
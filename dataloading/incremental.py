@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from tqdm import tqdm
+
+from dataloading.metadata import atomic_write
+
+# Per drive record of preprocessing outputs and content hashes of the inputs they were created from
+MANIFEST_FILE = "preprocess_manifest.json"
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def read_manifest(dataset_path):
+    manifest_path = Path(dataset_path) / MANIFEST_FILE
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(dataset_path, manifest):
+    def write(tmp_path):
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    atomic_write(Path(dataset_path) / MANIFEST_FILE, write)
+
+
+def is_up_to_date(dataset_path, output_file, input_paths, version, input_values=None):
+    """
+    Output of a drive is up to date if it was recorded in the manifest by the same version of the step and it is newer
+    than all inputs. Inputs with newer modification time, like copied files, are compared by content hash.
+    input_values are hashes of inputs that are not files, they must equal the hashes recorded in the manifest.
+    """
+    output_path = Path(dataset_path) / output_file
+    entry = read_manifest(dataset_path).get(output_file)
+    if not output_path.exists() or entry is None or entry["version"] != version:
+        return False
+    if any(entry["inputs"].get(name) != value for name, value in (input_values or {}).items()):
+        return False
+
+    output_mtime = os.path.getmtime(output_path)
+    if all(os.path.getmtime(input_path) < output_mtime for input_path in input_paths):
+        return True
+    if all(entry["inputs"].get(Path(input_path).name) == file_hash(input_path) for input_path in input_paths):
+        # output is marked newer, so hashes are not computed again on next run
+        os.utime(output_path)
+        return True
+    return False
+
+
+def input_hashes(input_paths):
+    return {Path(input_path).name: file_hash(input_path) for input_path in input_paths}
+
+
+def record_output(dataset_path, output_file, hashes, version):
+    manifest = read_manifest(dataset_path)
+    manifest[output_file] = {"version": version, "inputs": hashes}
+    save_manifest(dataset_path, manifest)
+
+
+def run_incremental(step, dataset_paths, output_file, input_paths, version, num_workers=8, force=False,
+                    description="Preprocessing", input_values=None):
+    """
+    Runs step(dataset_path) for every drive whose output_file is not up to date, drives are processed in parallel in
+    num_workers processes. input_paths(dataset_path) returns files the output is created from. Optional
+    input_values(dataset_path) returns hashes of other inputs of the drive by name, like its entries of a table in
+    code. Returns processed drives.
+    """
+    input_values = input_values if input_values else lambda dataset_path: {}
+    missing = [dataset_path for dataset_path in dataset_paths
+               if not all(Path(input_path).exists() for input_path in input_paths(dataset_path))]
+    if missing:
+        print(f"Skipping {len(missing)} drives without inputs of {output_file}: "
+              f"{', '.join(Path(dataset_path).name for dataset_path in missing)}")
+    pending = [dataset_path for dataset_path in dataset_paths if dataset_path not in missing and
+               (force or not is_up_to_date(dataset_path, output_file, input_paths(dataset_path), version,
+                                           input_values(dataset_path)))]
+    print(f"{description}: {len(pending)} of {len(dataset_paths) - len(missing)} drives need {output_file}")
+    if not pending:
+        return []
+
+    # inputs are hashed before the step runs, so the manifest records the inputs the step has read
+    hashes = {dataset_path: {**input_hashes(input_paths(dataset_path)), **input_values(dataset_path)}
+              for dataset_path in pending}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(step, dataset_path): dataset_path for dataset_path in pending}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=description):
+            dataset_path = futures[future]
+            future.result()
+            record_output(dataset_path, output_file, hashes[dataset_path], version)
+    return pending
@@ -0,0 +1,156 @@
+import hashlib
+
+from dataloading.model import TurnSignal
+
+# Frames left out of training, like frames with dirty or wet camera
+SKIP = -1
+
+# Manual corrections of turn signal labels, applied to frames of a drive when its nvidia_frames_ext.csv is created. Maps
+# drive to ranges of frames given as (start, end, turn signal), positions of frames with known position, end exclusive.
+# Later ranges override earlier ones.
+LABEL_OVERRIDES = {
+    "2021-10-20-15-11-29_e2e_rec_vastse_ss13_17_back": [
+        (5841, 5937, TurnSignal.STRAIGHT.value),
+        (7876, 8444, TurnSignal.LEFT.value),
+        (10865, 11160, TurnSignal.LEFT.value),
+        (19455, 19670, TurnSignal.LEFT.value),
+        (25105, 25335, TurnSignal.LEFT.value),
+    ],
+    "2021-10-26-11-08-59_e2e_rec_ss20_elva_back": [
+        (17663, 17880, TurnSignal.RIGHT.value),
+        (17881, 18303, TurnSignal.STRAIGHT.value),
+        (31705, 31950, TurnSignal.STRAIGHT.value),
+    ],
+    "2021-06-07-14-36-16_e2e_rec_ss6": [
+        (7395, 7530, TurnSignal.RIGHT.value),
+        (18900, 19100, TurnSignal.RIGHT.value),
+    ],
+    "2021-06-07-14-20-07_e2e_rec_ss6": [
+        (22677, 22824, TurnSignal.LEFT.value),
+    ],
+    "2021-10-26-10-49-06_e2e_rec_ss20_elva": [
+        (9120, 9280, TurnSignal.RIGHT.value),
+        (14580, 14843, TurnSignal.LEFT.value),
+    ],
+    "2021-06-09-14-58-11_e2e_rec_ss3": [
+        (8635, 8880, TurnSignal.LEFT.value),
+        (3775, 4475, SKIP),
+    ],
+    "2021-06-09-16-24-59_e2e_rec_ss13": [
+        (6802, 7040, TurnSignal.LEFT.value),
+        (12459, 12715, TurnSignal.RIGHT.value),
+        (17275, 17518, TurnSignal.RIGHT.value),
+        (25335, 25525, TurnSignal.LEFT.value),
+        (14650, 15190, SKIP),
+    ],
+    "2021-06-10-13-19-22_e2e_ss4_backwards": [
+        (2395, 2645, TurnSignal.LEFT.value),
+        (6923, 7190, TurnSignal.LEFT.value),
+        (14740, 14970, TurnSignal.LEFT.value),
+    ],
+    "2021-06-09-15-42-05_e2e_rec_ss3_backwards": [
+        (13618, 13855, TurnSignal.RIGHT.value),
+        (32989, 33220, TurnSignal.RIGHT.value),
+        (34566, 34760, TurnSignal.LEFT.value),
+        (36935, 37210, TurnSignal.LEFT.value),
+        (38989, 39175, TurnSignal.RIGHT.value),
+    ],
+    "2021-10-20-14-15-07_e2e_rec_neeruti_ss19_22_back": [
+        (4800, 5090, TurnSignal.LEFT.value),
+        (13885, 14210, TurnSignal.RIGHT.value),
+    ],
+    "2021-06-09-16-50-22_e2e_rec_ss13_backwards": [
+        (13327, 13522, TurnSignal.RIGHT.value),
+        (18901, 19215, TurnSignal.RIGHT.value),
+        (19215, 19431, TurnSignal.LEFT.value),
+        (21236, 21554, TurnSignal.LEFT.value),
+        (21555, 21675, TurnSignal.RIGHT.value),
+        (21675, 21787, TurnSignal.LEFT.value),
+        (24410, 24649, TurnSignal.RIGHT.value),
+    ],
+    "2021-06-14-11-22-05_e2e_rec_ss14": [
+        (4230, 4450, TurnSignal.RIGHT.value),
+        (16939, 17113, TurnSignal.LEFT.value),
+    ],
+    "2021-06-10-12-59-59_e2e_ss4": [
+        (16159, 16457, TurnSignal.RIGHT.value),
+        (18257, 18748, TurnSignal.RIGHT.value),
+        (24473, 24733, SKIP),
+    ],
+    "2021-06-14-11-43-48_e2e_rec_ss14_backwards": [
+        (25210, 25434, TurnSignal.RIGHT.value),
+    ],
+    "2021-06-10-14-44-24_e2e_ss3_backwards": [
+        (7891, 8000, TurnSignal.RIGHT.value),
+        (29011, 29216, TurnSignal.LEFT.value),
+    ],
+    "2021-10-11-14-50-59_e2e_rec_vahi": [
+        (11365, 11610, TurnSignal.RIGHT.value),
+    ],
+    "2021-09-30-15-56-59_e2e_ss14_attempt_2": [
+        (7785, 8015, TurnSignal.RIGHT.value),
+        (29232, 29477, TurnSignal.RIGHT.value),
+        (47877, 47940, TurnSignal.STRAIGHT.value),
+        (47940, 48052, TurnSignal.LEFT.value),
+    ],
+    "2021-06-09-13-55-03_e2e_rec_ss2_backwards": [
+        (19262, 19484, TurnSignal.LEFT.value),
+    ],
+    "2021-10-07-13-22-35_e2e_rec_ss4_backwards": [
+        (8471, 8690, TurnSignal.LEFT.value),
+    ],
+    "2021-09-24-13-39-38_e2e_rec_ss11": [
+        (7338, 7564, TurnSignal.LEFT.value),
+        (8657, 9043, TurnSignal.RIGHT.value),
+    ],
+    "2021-06-10-15-03-16_e2e_ss3_backwards": [
+        (1311, 1470, TurnSignal.RIGHT.value),
+    ],
+    "2021-10-07-11-05-13_e2e_rec_ss3": [
+        (9820, 10102, TurnSignal.LEFT.value),
+        (35804, 36017, TurnSignal.LEFT.value),
+    ],
+    "2021-10-25-17-06-34_e2e_rec_ss2_arula_back": [
+        (18591, 18870, TurnSignal.LEFT.value),
+    ],
+    "2021-09-30-15-03-37_e2e_ss14_from_half_way": [
+        (8160, 8534, TurnSignal.RIGHT.value),
+    ],
+    "2021-09-24-12-02-32_e2e_rec_ss10_3": [
+        (4793, 4945, TurnSignal.RIGHT.value),
+    ],
+    "2021-10-14-13-08-51_e2e_rec_vahi_backwards": [
+        (2893, 3105, TurnSignal.LEFT.value),
+    ],
+    "2021-10-20-14-55-47_e2e_rec_vastse_ss13_17": [
+        (22109, 22425, TurnSignal.RIGHT.value),
+        (22426, 22596, TurnSignal.STRAIGHT.value),
+    ],
+    "2021-09-24-14-03-45_e2e_rec_ss11_backwards": [
+        (1765, 2153, TurnSignal.LEFT.value),
+    ],
+    # Dirty/wet camera
+    "2021-09-24-11-19-25_e2e_rec_ss10": [
+        (26250, 26470, SKIP),
+        (27210, 27620, SKIP),
+        (29250, 29445, SKIP),
+    ],
+    "2021-09-24-11-40-24_e2e_rec_ss10_2": [
+        (5440, 6025, SKIP),
+    ],
+}
+
+
+def label_overrides_hash(drive):
+    """
+    Hash of label overrides of given drive. It is recorded in the preprocessing manifest of the drive, so changing the
+    table creates waypoints again only for drives whose overrides changed.
+    """
+    return hashlib.sha1(repr(LABEL_OVERRIDES.get(drive, [])).encode()).hexdigest()
+
+
+def apply_label_overrides(frames_df, drive):
+    """Sets turn signals of frames of given drive from LABEL_OVERRIDES in place."""
+    turn_signal = frames_df.columns.get_loc("turn_signal")
+    for start, end, value in LABEL_OVERRIDES.get(drive, []):
+        frames_df.iloc[start:end, turn_signal] = value
@@ -0,0 +1,61 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+# Increase when filtering in NvidiaDataset changes to invalidate existing caches
+METADATA_CACHE_VERSION = 3
+
+
+def atomic_write(path, write_fn):
+    """
+    Writes file with write_fn(tmp_path) under temporary name and renames it to path, so other processes never read
+    partially written file. Temporary name ends with the suffix of path, as np.save and np.savez append it otherwise.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp{path.suffix}")
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def metadata_cache_path(cache_dir, metadata_path, camera, output_modality, n_waypoints, start=None, end=None,
+                        waypoint_spacing=None):
+    """
+    Path of cached filtered metadata of a drive. Cache key contains everything filtering depends on, including
+    modification time of the metadata file, so cache is rebuilt when metadata file changes. Waypoints computed from
+    poses are cached with the metadata, keyed by their number and spacing.
+    """
+    key = (METADATA_CACHE_VERSION, str(Path(metadata_path).resolve()), os.path.getmtime(metadata_path),
+           camera, output_modality, n_waypoints, start, end, waypoint_spacing)
+    key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+    return Path(cache_dir) / f"{Path(metadata_path).parent.name}_{camera}_{key_hash[:16]}.pkl"
+
+
+def save_metadata_cache(frames_df, cache_path):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(cache_path, lambda tmp_path: frames_df.to_pickle(tmp_path, protocol=4))
+
+
+def alias_table_cache_path(cache_dir, weights):
+    """Path of cached alias table of AliasSampler, keyed by the sampling weights."""
+    weights_hash = hashlib.sha1(np.ascontiguousarray(weights, dtype=np.float64).tobytes()).hexdigest()
+    return Path(cache_dir) / f"alias_{weights_hash[:16]}.npz"
+
+
+def save_alias_table(prob, alias, cache_path):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(cache_path, lambda tmp_path: np.savez(tmp_path, prob=prob, alias=alias))
+
+
+def join_index_cache_path(cache_dir, camera_metadata_path, lidar_metadata_path, max_time_difference):
+    """Path of cached timestamp join between camera and lidar metadata of a drive, see fusion.timestamp_join."""
+    key = (METADATA_CACHE_VERSION, str(Path(camera_metadata_path).resolve()), os.path.getmtime(camera_metadata_path),
+           str(Path(lidar_metadata_path).resolve()), os.path.getmtime(lidar_metadata_path), max_time_difference)
+    key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+    return Path(cache_dir) / f"{Path(camera_metadata_path).parent.name}_lidar_join_{key_hash[:16]}.npy"
+
+
+def save_join_index(join_index, cache_path):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(cache_path, lambda tmp_path: np.save(tmp_path, join_index))
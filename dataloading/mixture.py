@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+
+from dataloading.compact import ImagePaths
+
+
+def merge_batches(batches, order):
+    """Concatenates batches collated from different sources and puts samples into given order."""
+    first = batches[0]
+    if isinstance(first, torch.Tensor):
+        return torch.cat(batches)[order]
+    if isinstance(first, dict):
+        return {key: merge_batches([batch[key] for batch in batches], order) for key in first}
+    if isinstance(first, (tuple, list)) and isinstance(first[0], (torch.Tensor, dict, tuple, list)):
+        # batch structure like (data, target, conditional_mask), default_collate returns it as list
+        return type(first)(merge_batches(list(fields), order) for fields in zip(*batches))
+    # collated non-tensor values like strings
+    merged = [sample for batch in batches for sample in batch]
+    return [merged[position] for position in order.tolist()]
+
+
+class MixtureDataset(Dataset):
+    """
+    Virtual concatenation of datasets, for example summer and winter training sets. Sources are kept as they are and
+    global index is mapped to source and index inside the source with prefix sums of source lengths, so creating the
+    mixture copies nothing and its index has one entry per source.
+
+    Ratios give the share of samples drawn from every source, see sampling_weights. Without ratios, sources are
+    sampled in proportion to their size like with concatenated dataset.
+    """
+
+    def __init__(self, datasets, ratios=None):
+        if ratios is not None and len(ratios) != len(datasets):
+            raise ValueError(f"Got {len(ratios)} ratios for {len(datasets)} datasets")
+        self.datasets = datasets
+        self.ratios = np.asarray(ratios, dtype=np.float64) / np.sum(ratios) if ratios is not None else None
+        self.offsets = np.cumsum([0] + [len(dataset) for dataset in datasets])
+        self._frames = None
+
+    def locate(self, indices):
+        indices = np.asarray(indices)
+        sources = np.searchsorted(self.offsets, indices, side="right") - 1
+        return sources, indices - self.offsets[sources]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, np.ndarray)):
+            return self.get_batch(idx)
+        source, local_idx = self.locate(idx)
+        return self.datasets[source][int(local_idx)]
+
+    def __getitems__(self, indices):
+        """
+        Samples of a batch for DataLoader with automatic batching. Samples of every source are fetched together with
+        its __getitems__, so sources load images of the batch with read ahead.
+        """
+        sources, local_indices = self.locate(indices)
+        samples = [None] * len(sources)
+        for source in np.unique(sources):
+            source_positions = np.flatnonzero(sources == source)
+            dataset = self.datasets[source]
+            source_indices = local_indices[source_positions].tolist()
+            if hasattr(dataset, "__getitems__"):
+                source_samples = dataset.__getitems__(source_indices)
+            else:
+                source_samples = [dataset[idx] for idx in source_indices]
+            for position, sample in zip(source_positions, source_samples):
+                samples[position] = sample
+        return samples
+
+    def get_batch(self, indices):
+        sources, local_indices = self.locate(indices)
+        batches = []
+        positions = []
+        for source in np.unique(sources):
+            source_positions = np.flatnonzero(sources == source)
+            dataset = self.datasets[source]
+            source_indices = local_indices[source_positions]
+            if hasattr(dataset, "get_batch"):
+                batches.append(dataset.get_batch(source_indices))
+            else:
+                batches.append(default_collate([dataset[int(idx)] for idx in source_indices]))
+            positions.append(source_positions)
+        # position of every requested sample in the concatenated batches
+        order = np.argsort(np.concatenate(positions), kind="stable")
+        return merge_batches(batches, torch.from_numpy(order))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def sampling_weights(self, source_weights=None):
+        """
+        Sampling weight of every sample of the mixture. source_weights are optional weights of samples inside each
+        source, for example stratified weights. With ratios, weights of each source are scaled to sum up to the
+        ratio of the source. Returns None if samples should be sampled uniformly.
+        """
+        if source_weights is None:
+            if self.ratios is None:
+                return None
+            source_weights = [np.ones(len(dataset)) for dataset in self.datasets]
+
+        weights = [np.asarray(weights, dtype=np.float64) for weights in source_weights]
+        if self.ratios is not None:
+            weights = [ratio * w / w.sum() for ratio, w in zip(self.ratios, weights)]
+        return np.concatenate(weights)
+
+    @property
+    def image_paths(self):
+        """Image paths of all sources, as ImagePaths if every source stores its paths as ImagePaths."""
+        image_paths = [dataset.image_paths for dataset in self.datasets]
+        if all(isinstance(paths, ImagePaths) for paths in image_paths):
+            return ImagePaths.concatenate(image_paths)
+        return np.concatenate([np.asarray(paths, dtype=object) for paths in image_paths])
+
+    @property
+    def frames(self):
+        """Concatenated frames of all sources, created on first access as it copies metadata of all sources."""
+        if self._frames is None:
+            self._frames = pd.concat([dataset.frames for dataset in self.datasets])
+        return self._frames
+
+    def get_waypoints(self):
+        return np.concatenate([dataset.get_waypoints() for dataset in self.datasets])
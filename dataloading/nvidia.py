@@ -1,4 +1,6 @@
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
@@ -13,11 +15,35 @@ import torchvision.transforms.functional as F
 
 from skimage.util import random_noise
 
+from dataloading.columnar import read_metadata
+from dataloading.compact import ImagePaths, compact_frames
+from dataloading.crop_band import ROW_OFFSET, read_crop_bands
+from dataloading.frame_cache import SharedFrameCache, key_ids, split_crop_transforms
+from dataloading.metadata import metadata_cache_path, save_metadata_cache
 from dataloading.model import Camera
+from dataloading.read_ahead import READ_AHEAD_DEPTH, ReadAheadReader, ReadStats, read_ahead_images
+from dataloading.shards import ShardReader, shard_cache_path
+from dataloading.waypoints import camera_waypoints, pose_waypoints
+
+ALL_CAMERAS = [Camera.LEFT.value, Camera.RIGHT.value, Camera.FRONT_WIDE.value]
+# metadata columns specific to single camera
+CAMERA_COLUMNS = r"wp\d+_(left|right|front_wide)_[xy]|(left|right|front_wide)_filename"
+# Waypoint columns written by preprocess.py, only waypoints of used cameras are read from metadata files
+WAYPOINT_COLUMNS = r"wp\d+_.*|wp_steering_\d+"
 
 
 class NvidiaResizeAndCrop(object):
     def __call__(self, data):
+        ymin, xmin, scaled_height, scaled_width, height, width = self.crop_box()
+        # images stored as crop band start from the first row of the band
+        ymin -= data.pop(ROW_OFFSET, 0)
+        cropped = transforms.functional.resized_crop(data["image"], ymin, xmin, scaled_height, scaled_width,
+                                                     (height, width))
+
+        data["image"] = cropped
+        return data
+
+    def crop_box(self):
         xmin = 186
         ymin = 600
 
@@ -26,12 +52,7 @@ class NvidiaResizeAndCrop(object):
         height = 66
         scaled_width = int(width * scale)
         scaled_height = int(height * scale)
-
-        cropped = transforms.functional.resized_crop(data["image"], ymin, xmin, scaled_height, scaled_width,
-                                                     (height, width))
-
-        data["image"] = cropped
-        return data
+        return ymin, xmin, scaled_height, scaled_width, height, width
 
 
 class NvidiaCropWide(object):
@@ -39,6 +60,14 @@ class NvidiaCropWide(object):
         self.x_delta = x_delta
 
     def __call__(self, data):
+        ymin, xmin, height, width, scaled_height, scaled_width = self.crop_box()
+        ymin -= data.pop(ROW_OFFSET, 0)
+        cropped = F.resized_crop(data["image"], ymin, xmin, height, width, (scaled_height, scaled_width))
+
+        data["image"] = cropped
+        return data
+
+    def crop_box(self):
         xmin = 300
         xmax = 1620
 
@@ -49,15 +78,18 @@ class NvidiaCropWide(object):
 
         height = ymax - ymin
         width = xmax - xmin
-        cropped = F.resized_crop(data["image"], ymin, xmin + self.x_delta, height, width,
-                                 (int(scale * height), int(scale * width)))
-
-        data["image"] = cropped
-        return data
+        return ymin, xmin + self.x_delta, height, width, int(scale * height), int(scale * width)
 
 
 class CropViT(object):
     def __call__(self, data):
+        ymin, xmin, height, width, scaled_height, scaled_width = self.crop_box()
+        ymin -= data.pop(ROW_OFFSET, 0)
+        cropped = F.resized_crop(data["image"], ymin, xmin, height, width, (scaled_height, scaled_width))
+        data["image"] = cropped
+        return data
+
+    def crop_box(self):
         xmin = 540
         xmax = 1260
 
@@ -68,10 +100,63 @@ class CropViT(object):
 
         height = ymax - ymin
         width = xmax - xmin
-        cropped = F.resized_crop(data["image"], ymin, xmin, height, width,
-                                 (int(scale * height), int(scale * width)))
-        data["image"] = cropped
-        return data
+        return ymin, xmin, height, width, int(scale * height), int(scale * width)
+
+
+class FusedDecodeCrop(object):
+    """
+    Decodes, crops and resizes camera image in one step. Image is decoded with reduced scale when the crop is
+    downscaled by at least 2x, so JPEG images are decoded directly in smaller size, and crop is resized on the smaller
+    image straight into uint8 CHW tensor. Used by NvidiaDataset instead of decoding full image and then applying crop
+    transform with crop_box method (NvidiaCropWide, CropViT, NvidiaResizeAndCrop). Result is not bit exact compared to
+    the crop transforms as area interpolation is used for resizing, pixels can differ by tens of intensity levels, so
+    decoder is only used by NvidiaDataset with fused_decode. Crop box is shifted up by row_offset for images stored as
+    crop band.
+    """
+
+    REDUCED_READ_FLAGS = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    def __init__(self, crop, color_space="rgb", row_offset=0):
+        ymin, xmin, height, width, self.out_height, self.out_width = crop.crop_box()
+        ymin -= row_offset
+        self.crop_transform = crop
+        self.color_space = color_space
+
+        # largest reduction that keeps crop box on whole pixels and does not go below output resolution
+        self.reduction = 1
+        for reduction in [8, 4, 2]:
+            if all(v % reduction == 0 for v in (ymin, xmin, height, width)) \
+                    and height // reduction >= self.out_height and width // reduction >= self.out_width:
+                self.reduction = reduction
+                break
+
+        self.ymin = ymin // self.reduction
+        self.xmin = xmin // self.reduction
+        self.ymax = self.ymin + height // self.reduction
+        self.xmax = self.xmin + width // self.reduction
+
+    def __call__(self, image_path):
+        return self.crop(cv2.imread(image_path, self.REDUCED_READ_FLAGS[self.reduction]))
+
+    def decode(self, buffer):
+        """Same as calling with image path, but decodes encoded image bytes."""
+        return self.crop(cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), self.REDUCED_READ_FLAGS[self.reduction]))
+
+    def crop(self, image):
+        # resized into new array on every call, so decoder can be used from several reader threads at once
+        resized = cv2.resize(image[self.ymin:self.ymax, self.xmin:self.xmax], (self.out_width, self.out_height),
+                             interpolation=cv2.INTER_AREA)
+
+        # OpenCV decodes into BGR HWC, color conversion and transpose to CHW are done in the single copy to output
+        output = torch.empty((3, self.out_height, self.out_width), dtype=torch.uint8)
+        channels = resized[..., ::-1] if self.color_space == "rgb" else resized
+        np.copyto(output.numpy(), channels.transpose(2, 0, 1))
+        return output
 
 
 class NvidiaSideCameraZoom(object):
@@ -130,6 +215,83 @@ class AugmentImage:
         return data
 
 
+class BatchAugmentImage:
+    """
+    Batched version of AugmentImage applied to the whole batch of normalized images on the training device. Uses the
+    same augmentation probabilities and parameter ranges, random parameters are drawn separately for every sample.
+    """
+
+    def __init__(self, augment_config):
+        print(f"batch augmentation: color_prob={augment_config.color_prob}, "
+              f"noise_prob={augment_config.noise_prob}, "
+              f"blur_prob={augment_config.blur_prob}")
+        self.augment_config = augment_config
+
+    def __call__(self, images):
+        batch_size = images.shape[0]
+        device = images.device
+
+        color = torch.rand(batch_size, device=device) <= self.augment_config.color_prob
+        noise = torch.rand(batch_size, device=device) <= self.augment_config.noise_prob
+        blur = torch.rand(batch_size, device=device) <= self.augment_config.blur_prob
+
+        if color.any():
+            images = self.color_jitter(images, color)
+        if noise.any():
+            images = self.add_noise(images, noise)
+        if blur.any():
+            images = self.blur(images, blur)
+        return images
+
+    def color_jitter(self, images, selected):
+        # same as ColorJitter(contrast=0.5, saturation=0.5, brightness=0.5), adjustments are applied in random order
+        image = images[selected]
+        n_images = image.shape[0]
+        factors = torch.empty((3, n_images, 1, 1, 1), dtype=image.dtype, device=image.device).uniform_(0.5, 1.5)
+        order = torch.rand((n_images, 3), device=image.device).argsort(dim=1)
+        for position in range(3):
+            adjustment = order[:, position]
+            factor = factors[adjustment, torch.arange(n_images, device=image.device)]
+            adjustment = adjustment.reshape(-1, 1, 1, 1)
+            grayscale = F.rgb_to_grayscale(image)
+            # image is blended with black image for brightness, mean gray for contrast and grayscale for saturation
+            contrast_weight = (1 - factor) * (adjustment == 1)
+            saturation_weight = (1 - factor) * (adjustment == 2)
+            image = factor * image + contrast_weight * grayscale.mean(dim=(-3, -2, -1), keepdim=True)
+            image = image.addcmul_(saturation_weight, grayscale).clamp_(0, 1)
+        images[selected] = image
+        return images
+
+    def add_noise(self, images, selected):
+        # same as random_noise with mode 'gaussian' or 'salt', both chosen with equal probability
+        gaussian = selected & (torch.rand(images.shape[0], device=images.device) > 0.5)
+        salt = selected & ~gaussian
+        if gaussian.any():
+            image = images[gaussian]
+            images[gaussian] = (image + torch.randn_like(image) * np.sqrt(0.005)).clamp(0, 1)
+        if salt.any():
+            image = images[salt]
+            images[salt] = image.masked_fill(torch.rand_like(image) < 0.005, 1.0)
+        return images
+
+    def blur(self, images, selected):
+        # same as GaussianBlur(kernel_size=(3, 3), sigma=(0.3, 1)), sigma is drawn for every sample
+        image = images[selected]
+        n_images, n_channels, height, width = image.shape
+        sigma = torch.empty((n_images, 1), dtype=images.dtype, device=images.device).uniform_(0.3, 1)
+        x = torch.arange(-1, 2, dtype=images.dtype, device=images.device)
+        kernel_1d = torch.exp(-0.5 * (x / sigma) ** 2)
+        kernel_1d = kernel_1d / kernel_1d.sum(dim=1, keepdim=True)
+        kernel = kernel_1d[:, :, None] * kernel_1d[:, None, :]
+        kernel = kernel.repeat_interleave(n_channels, dim=0)[:, None]
+
+        padded = torch.nn.functional.pad(image.reshape(1, n_images * n_channels, height, width), [1, 1, 1, 1],
+                                         mode="reflect")
+        blurred = torch.nn.functional.conv2d(padded, kernel, groups=n_images * n_channels)
+        images[selected] = blurred.reshape(n_images, n_channels, height, width)
+        return images
+
+
 class Normalize(object):
     def __call__(self, data, transform=None):
         # normalize = transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
@@ -140,11 +302,32 @@ class Normalize(object):
         return data
 
 
+def conditional_target(target_values, turn_signal, n_branches, target_size):
+    """
+    Puts target values into the branch selected by turn signal, conditional mask marks the branch. Target values are
+    put into the only branch if there is only one.
+    """
+    if n_branches > 1:
+        target = np.zeros((n_branches, target_size))
+        target[turn_signal, :] = target_values
+
+        conditional_mask = np.zeros((n_branches, target_size))
+        conditional_mask[turn_signal, :] = 1
+    else:
+        target = np.zeros((n_branches, target_size))
+        target[0, :] = target_values
+        conditional_mask = np.ones((n_branches, target_size))
+
+    return target.reshape(-1), conditional_mask.reshape(-1)
+
+
 class NvidiaDataset(Dataset):
 
     def __init__(self, dataset_paths, transform=None, camera="front_wide", name="Nvidia dataset",
                  filter_turns=False, output_modality="steering_angle", n_branches=1, n_waypoints=10,
-                 metadata_file="nvidia_frames.csv", color_space="rgb", side_cameras_weight=0.33):
+                 metadata_file="nvidia_frames.csv", color_space="rgb", side_cameras_weight=0.33, shard_cache=None,
+                 fused_decode=False, frame_cache_bytes=0, metadata_cache_dir=None, metadata_workers=8, crop_band=False,
+                 read_ahead=0, waypoint_spacing=None):
         self.name = name
         self.metadata_file = metadata_file
         self.color_space = color_space
@@ -157,6 +340,11 @@ class NvidiaDataset(Dataset):
         self.output_modality = output_modality
         self.n_waypoints = n_waypoints
         self.side_cameras_weight = side_cameras_weight
+        # Filtered metadata of each drive is cached into this directory, caching is disabled if not set
+        self.metadata_cache_dir = metadata_cache_dir
+        # When set, waypoints are computed from poses of frames, waypoint_spacing meters apart, instead of reading
+        # waypoint columns written by preprocess.py
+        self.waypoint_spacing = waypoint_spacing
 
         if self.output_modality == "waypoints":
             self.target_size = 2 * self.n_waypoints
@@ -168,78 +356,257 @@ class NvidiaDataset(Dataset):
 
         self.n_branches = n_branches
 
-        if camera == 'all':
-            datasets = [self.read_dataset(dataset_path, "left") for dataset_path in dataset_paths] + \
-                       [self.read_dataset(dataset_path, "right") for dataset_path in dataset_paths] + \
-                       [self.read_dataset(dataset_path, "front_wide") for dataset_path in dataset_paths]
+        # Name of the crop used to build shards with build_shards.py. When set, images are read already cropped from
+        # shards instead of decoding image files, so transform must not contain the crop.
+        self.shard_cache = shard_cache
+        self.shard_readers = []
 
-        else:
-            datasets = [self.read_dataset(dataset_path, camera) for dataset_path in dataset_paths]
+        # Images are read from crop band folders written by build_crop_band.py, crop transforms are shifted by the
+        # first row of the band.
+        self.crop_band = crop_band
+        if crop_band and shard_cache:
+            print("Crop band images can't be used together with shards")
+            sys.exit()
+
+        # With fused_decode, when transform starts with a known crop, decoding and cropping are fused into single step.
+        # Pixels differ from the crop transform, so models trained without it should be evaluated without it.
+        self.fused_decoder = None
+        if fused_decode and not shard_cache and isinstance(self.transform, transforms.Compose) \
+                and self.transform.transforms and hasattr(self.transform.transforms[0], "crop_box"):
+            self.fused_decoder = FusedDecodeCrop(self.transform.transforms[0], self.color_space)
+            self.transform = transforms.Compose(self.transform.transforms[1:])
+        # decoders of crop bands starting from different rows
+        self.band_decoders = {}
+
+        # Image files of a batch are read by read_ahead reader threads ahead of decoding, not used with shards.
+        self.reader = None
+        self.read_stats = None
+        if read_ahead and not shard_cache:
+            self.read_stats = ReadStats(read_ahead * READ_AHEAD_DEPTH)
+            self.reader = ReadAheadReader(read_ahead, read_ahead * READ_AHEAD_DEPTH, self.read_stats)
+
+        # With camera 'all', metadata of each drive is read once and expanded to all cameras
+        with ThreadPoolExecutor(max_workers=metadata_workers) as executor:
+            datasets = list(executor.map(lambda dataset_path: self.read_dataset(dataset_path, camera), dataset_paths))
+
+        if self.shard_cache:
+            for frames_df, dataset_path in zip(datasets, dataset_paths):
+                self.add_shards(frames_df, dataset_path)
         self.frames = pd.concat(datasets)
 
         if filter_turns:
             print("Filtering turns with blinker signal")
             self.frames = self.frames[self.frames.turn_signal == 1]
 
-    def __getitem__(self, idx):
-        frame = self.frames.iloc[idx]
+        # paths and frames are kept compact, so forked dataloader workers don't copy them on access
+        self.image_paths = ImagePaths.from_paths(self.frames["image_path"].to_numpy())
+        self.frames = compact_frames(self.frames)
+        self.create_index()
+
+        # Decoded and cropped frames are cached in shared memory before augmentation and normalization.
+        self.frame_cache = None
+        self.cache_crops = []
+        if frame_cache_bytes and len(self.frames) > 0:
+            self.cache_crops, self.transform = split_crop_transforms(self.transform)
+            n_keys, self.cache_keys = key_ids(self.image_paths)
+            self.frame_cache = SharedFrameCache(n_keys, self.decode_image(0).shape, frame_cache_bytes)
+
+    def create_index(self):
+        """
+        Copies the columns used by __getitem__ out of the frames dataframe into contiguous numpy arrays, so fetching
+        a sample is plain array indexing instead of a pandas row lookup. Must be called again if frames is modified,
+        image_paths must be modified the same way.
+        """
+        # TODO replace if-else with map
+        if self.camera_name == Camera.LEFT.value:
+            steering_column = "steering_angle_left"
+        elif self.camera_name == Camera.RIGHT.value:
+            steering_column = "steering_angle_right"
+        else:
+            steering_column = "steering_angle"
+
+        self.camera_steering_angles = self.frames[steering_column].to_numpy(dtype=np.float32)
+        self.steering_angles = self.frames["steering_angle"].to_numpy(dtype=np.float32)
+        self.vehicle_speeds = self.frames["vehicle_speed"].to_numpy(dtype=np.float32)
+        self.autonomous = self.frames["autonomous"].to_numpy(dtype=bool)
+        self.positions_x = self.frames["position_x"].to_numpy(dtype=np.float64)
+        self.positions_y = self.frames["position_y"].to_numpy(dtype=np.float64)
+        self.yaws = self.frames["yaw"].to_numpy(dtype=np.float32)
+        self.turn_signals = self.frames["turn_signal"].to_numpy(dtype=np.int64)
+        self.row_ids = self.frames["row_id"].to_numpy(dtype=np.int64)
+
+        if self.output_modality == "waypoints":
+            self.waypoints = self.get_waypoints().astype(np.float32).reshape(-1, self.n_waypoints, 2)
+        else:
+            self.waypoints = None
+
+        if self.shard_cache:
+            self.shard_ids = self.frames["shard_id"].to_numpy(dtype=np.int64)
+            self.shard_offsets = self.frames["shard_offset"].to_numpy(dtype=np.int64)
+
+        self.row_offsets = self.frames[ROW_OFFSET].to_numpy(dtype=np.int64) if self.crop_band else None
+
+    def load_image(self, idx):
+        if self.frame_cache:
+            image = self.frame_cache.get(self.cache_keys[idx])
+            if image is None:
+                image = self.decode_image(idx)
+                self.frame_cache.put(self.cache_keys[idx], image)
+            return image
+        return self.decode_image(idx)
+
+    def load_images(self, indices):
+        """Images of given frames in order, same as load_image. With read ahead, files are read ahead of decoding."""
+        if self.reader:
+            return read_ahead_images(self, indices)
+        return (self.load_image(idx) for idx in indices)
+
+    def decode_image(self, idx):
+        if self.shard_cache:
+            return self.shard_readers[self.shard_ids[idx]][self.shard_offsets[idx]]
+        if self.fused_decoder:
+            return self.fused_decode(idx)
+
+        image = self.read_image(self.image_paths[idx])
+        for crop in self.cache_crops:
+            image = crop(self.band_row_offset({"image": image}, idx))["image"]
+        return image
+
+    def decode_buffer(self, idx, buffer):
+        """Same as decode_image, but from contents of the image file of frame idx."""
+        if self.fused_decoder:
+            return self.frame_decoder(idx).decode(buffer)
+
+        image = self.decode_bytes(buffer)
+        for crop in self.cache_crops:
+            image = crop(self.band_row_offset({"image": image}, idx))["image"]
+        return image
+
+    def fused_decode(self, idx):
+        return self.frame_decoder(idx)(self.image_paths[idx])
+
+    def frame_decoder(self, idx):
+        if self.row_offsets is None:
+            return self.fused_decoder
+        row_offset = int(self.row_offsets[idx])
+        if row_offset not in self.band_decoders:
+            self.band_decoders[row_offset] = FusedDecodeCrop(self.fused_decoder.crop_transform, self.color_space,
+                                                             row_offset)
+        return self.band_decoders[row_offset]
+
+    def band_row_offset(self, data, idx):
+        """Adds first row of the crop band to the data, crop transforms shift their crop box by it."""
+        if self.row_offsets is not None:
+            data[ROW_OFFSET] = self.row_offsets[idx]
+        return data
+
+    def read_image(self, image_path):
         if self.color_space == "rgb":
-            image = torchvision.io.read_image(frame["image_path"])
+            image = torchvision.io.read_image(image_path)
         elif self.color_space == "bgr":
-            image = cv2.imread(frame["image_path"])
+            image = cv2.imread(image_path)
             image = torch.tensor(image, dtype=torch.uint8).permute(2, 0, 1)
         else:
             print(f"Unknown color space: ", self.color_space)
             sys.exit()
+        return image
 
-        # TODO replace if-else with map
-        if self.camera_name == Camera.LEFT.value:
-            steering_angle = np.array(frame["steering_angle_left"])
-        elif self.camera_name == Camera.RIGHT.value:
-            steering_angle = np.array(frame["steering_angle_right"])
+    def decode_bytes(self, buffer):
+        if self.color_space == "rgb":
+            image = torchvision.io.decode_image(torch.from_numpy(buffer))
+        elif self.color_space == "bgr":
+            image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+            image = torch.tensor(image, dtype=torch.uint8).permute(2, 0, 1)
         else:
-            steering_angle = np.array(frame["steering_angle"])
+            print(f"Unknown color space: ", self.color_space)
+            sys.exit()
+        return image
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, np.ndarray)):
+            return self.get_batch(idx)
+        return self.create_sample(idx, self.load_image(idx))
 
+    def __getitems__(self, indices):
+        """Samples of a batch for DataLoader with automatic batching, images are loaded with load_images."""
+        return [self.create_sample(idx, image) for idx, image in zip(indices, self.load_images(indices))]
+
+    def create_sample(self, idx, image):
+        """Sample with metadata and target of frame idx and given decoded image, before transforms."""
         data = {
             'image': image,
-            'steering_angle': steering_angle,
-            'vehicle_speed': np.array(frame["vehicle_speed"]),
-            'autonomous': np.array(frame["autonomous"]),
-            'position_x': np.array(frame["position_x"]),
-            'position_y': np.array(frame["position_y"]),
-            'yaw': np.array(frame["yaw"]),
-            'turn_signal': np.array(frame["turn_signal"]),
-            'row_id': np.array(frame["row_id"]),
+            'steering_angle': self.camera_steering_angles[idx],
+            'vehicle_speed': self.vehicle_speeds[idx],
+            'autonomous': self.autonomous[idx],
+            'position_x': self.positions_x[idx],
+            'position_y': self.positions_y[idx],
+            'yaw': self.yaws[idx],
+            'turn_signal': self.turn_signals[idx],
+            'row_id': self.row_ids[idx],
         }
 
-        turn_signal = int(frame["turn_signal"])
+        turn_signal = self.turn_signals[idx]
 
         if self.output_modality == "waypoints":
-            waypoints = []
-            for i in np.arange(1, self.n_waypoints + 1):
-                waypoints.append(frame[f"wp{i}_{self.camera_name}_x"])
-                waypoints.append(frame[f"wp{i}_{self.camera_name}_y"])
-
-            data['waypoints'] = np.array(waypoints)
+            waypoints = self.waypoints[idx].reshape(-1)
+            data['waypoints'] = waypoints
             target_values = waypoints
         else:
-            target_values = frame["steering_angle"]
+            target_values = self.steering_angles[idx]
 
         if self.transform:
-            data = self.transform(data)
+            data = self.transform(self.band_row_offset(data, idx))
+        # images cropped before transforms, like fused decoding does, leave row offset unused
+        data.pop(ROW_OFFSET, None)
+
+        target, conditional_mask = conditional_target(target_values, turn_signal, self.n_branches, self.target_size)
+        return data, target, conditional_mask
+
+    def get_batch(self, indices, images=None):
+        """
+        Fetches whole batch, result is the same as default_collate of samples returned by __getitem__. Only images are
+        processed per sample, metadata, targets and conditional masks are gathered for the whole batch at once.
+        Used with BatchSampler, see dataloading.batching. Already decoded images of the samples can be given, then
+        only transforms are applied to them.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        batch_size = len(indices)
+        if images is None:
+            images = self.load_images(indices)
+
+        transformed_images = []
+        for idx, image in zip(indices, images):
+            if self.transform:
+                image = self.transform(self.band_row_offset({'image': image}, idx))['image']
+            transformed_images.append(image)
 
-        if self.n_branches > 1:
-            target = np.zeros((self.n_branches, self.target_size))
-            target[turn_signal, :] = target_values
+        data = {
+            'image': torch.stack(transformed_images),
+            'steering_angle': torch.from_numpy(self.camera_steering_angles[indices]),
+            'vehicle_speed': torch.from_numpy(self.vehicle_speeds[indices]),
+            'autonomous': torch.from_numpy(self.autonomous[indices]),
+            'position_x': torch.from_numpy(self.positions_x[indices]),
+            'position_y': torch.from_numpy(self.positions_y[indices]),
+            'yaw': torch.from_numpy(self.yaws[indices]),
+            'turn_signal': torch.from_numpy(self.turn_signals[indices]),
+            'row_id': torch.from_numpy(self.row_ids[indices]),
+        }
 
-            conditional_mask = np.zeros((self.n_branches, self.target_size))
-            conditional_mask[turn_signal, :] = 1
+        if self.output_modality == "waypoints":
+            target_values = self.waypoints[indices].reshape(batch_size, -1)
+            data['waypoints'] = torch.from_numpy(target_values)
         else:
-            target = np.zeros((self.n_branches, self.target_size))
-            target[0, :] = target_values
-            conditional_mask = np.ones((self.n_branches, self.target_size))
+            target_values = self.steering_angles[indices].reshape(batch_size, 1)
+
+        # target values are scattered into branch selected by turn signal
+        branches = self.turn_signals[indices] if self.n_branches > 1 else 0
+        target = np.zeros((batch_size, self.n_branches, self.target_size))
+        target[np.arange(batch_size), branches] = target_values
+        conditional_mask = np.zeros((batch_size, self.n_branches, self.target_size))
+        conditional_mask[np.arange(batch_size), branches] = 1
 
-        return data, target.reshape(-1), conditional_mask.reshape(-1)
+        return data, torch.from_numpy(target.reshape(batch_size, -1)), \
+            torch.from_numpy(conditional_mask.reshape(batch_size, -1))
 
     def __len__(self):
         return len(self.frames.index)
@@ -252,14 +619,123 @@ class NvidiaDataset(Dataset):
 
     def read_dataset(self, dataset_path, camera):
         if type(dataset_path) is dict:
-            frames_df = pd.read_csv(dataset_path['path'] / self.metadata_file)
-            len_before_filtering = len(frames_df)
-            frames_df = frames_df.iloc[dataset_path['start']:dataset_path['end']]
+            start = dataset_path['start']
+            end = dataset_path['end']
             dataset_path = dataset_path['path']
         else:
-            frames_df = pd.read_csv(dataset_path / self.metadata_file)
-            len_before_filtering = len(frames_df)
+            start = None
+            end = None
+
+        metadata_path = dataset_path / self.metadata_file
+        cache_path = None
+        if self.metadata_cache_dir:
+            cache_path = metadata_cache_path(self.metadata_cache_dir, metadata_path, camera, self.output_modality,
+                                             self.n_waypoints, start, end, self.waypoint_spacing)
+
+        if cache_path and cache_path.exists():
+            frames_df = pd.read_pickle(cache_path)
+            print(f"{dataset_path}: lenght={len(frames_df)}, cached")
+        else:
+            frames_df = self.load_metadata(metadata_path, dataset_path, camera, start, end)
+            if cache_path:
+                save_metadata_cache(frames_df, cache_path)
+
+        if self.crop_band:
+            frames_df = self.band_images(frames_df, dataset_path)
+        return frames_df
+
+    def load_metadata(self, metadata_path, dataset_path, camera, start=None, end=None):
+        if not self.computes_waypoints():
+            frames_df, metadata_rows = read_metadata(metadata_path, self.metadata_columns(camera), start, end)
+            return self.filter_dataset(frames_df, dataset_path, camera, metadata_rows=metadata_rows)
+
+        # waypoints of the last frames of a range are after its end, so the whole drive is read
+        frames_df, _ = read_metadata(metadata_path, self.metadata_columns(camera))
+        cameras = ALL_CAMERAS if camera == 'all' else [camera]
+        return self.filter_dataset(self.add_waypoints(frames_df, cameras), dataset_path, camera, start, end)
+
+    def computes_waypoints(self):
+        return self.output_modality == "waypoints" and self.waypoint_spacing is not None
+
+    def add_waypoints(self, frames_df, cameras):
+        """Adds waypoint columns of given cameras computed from poses of frames, see pose_waypoints."""
+        positions = frames_df[["position_x", "position_y", "position_z"]].to_numpy(dtype=np.float64)
+        waypoints = pose_waypoints(positions, frames_df["roll"].to_numpy(), frames_df["pitch"].to_numpy(),
+                                   frames_df["yaw"].to_numpy(), self.n_waypoints, self.waypoint_spacing)
+        columns = {}
+        for camera in cameras:
+            cam_waypoints = camera_waypoints(waypoints, camera).astype(np.float32)
+            for i in np.arange(1, self.n_waypoints + 1):
+                columns[f"wp{i}_{camera}_x"] = cam_waypoints[:, i - 1, 0]
+                columns[f"wp{i}_{camera}_y"] = cam_waypoints[:, i - 1, 1]
+        return pd.concat([frames_df, pd.DataFrame(columns, index=frames_df.index)], axis=1)
+
+    def metadata_columns(self, camera):
+        """
+        Returns function telling if a metadata column is used with given camera. Waypoint columns are read only with
+        waypoints output modality, of used cameras and up to n_waypoints, and not when waypoints are computed from
+        poses. Image file columns are read only of used cameras.
+        """
+        cameras = ALL_CAMERAS if camera == 'all' else [camera]
+        used_columns = {f"{frames_camera}_filename" for frames_camera in cameras}
+        if self.output_modality == "waypoints" and not self.computes_waypoints():
+            used_columns.update(f"wp{i}_{frames_camera}_{axis}" for frames_camera in cameras
+                                for i in np.arange(1, self.n_waypoints + 1) for axis in ["x", "y"])
+        return lambda column: column in used_columns or not re.fullmatch(f"{WAYPOINT_COLUMNS}|{CAMERA_COLUMNS}", column)
+
+    def band_images(self, frames_df, dataset_path):
+        """Points image paths of frames to crop band images and records first row of the band of every frame."""
+        crop_bands = read_crop_bands(dataset_path)
+        image_paths = frames_df["image_path"].to_numpy(dtype=object).copy()
+        camera_types = frames_df["camera_type"].to_numpy()
+        row_offsets = np.zeros(len(frames_df), dtype=np.int64)
+        for camera in np.unique(camera_types):
+            if camera not in crop_bands:
+                print(f"Crop band of {camera} camera not found in {dataset_path}, build it with build_crop_band.py")
+                sys.exit()
+            camera_frames = camera_types == camera
+            band_path = dataset_path / crop_bands[camera]["folder"]
+            image_paths[camera_frames] = [str(band_path / Path(image_path).name)
+                                          for image_path in image_paths[camera_frames]]
+            row_offsets[camera_frames] = crop_bands[camera]["ymin"]
+
+        frames_df["image_path"] = image_paths
+        frames_df[ROW_OFFSET] = row_offsets
+        return frames_df
 
+    def filter_dataset(self, frames_df, dataset_path, camera, start=None, end=None, metadata_rows=None):
+        """
+        Frames of the drive usable with given camera. metadata_rows is the number of rows in metadata file, when frames
+        are only part of the file already read with read_metadata.
+        """
+        len_before_filtering = len(frames_df) if metadata_rows is None else metadata_rows
+        frames_df = frames_df.iloc[start:end]
+
+        cameras = ALL_CAMERAS if camera == 'all' else [camera]
+        camera_rows = []
+        yaw_deltas = []
+        for frames_camera in cameras:
+            rows, yaw_delta = self.filter_rows(frames_df, frames_camera)
+            camera_rows.append(rows)
+            yaw_deltas.append(yaw_delta)
+        rows = np.concatenate(camera_rows)
+
+        # Camera specific columns are gathered into image_path and wp{i}_all_* columns, so with camera 'all' only
+        # columns shared by all cameras are copied.
+        camera_images = np.concatenate([frames_df[f"{frames_camera}_filename"].to_numpy()[rows]
+                                        for frames_camera, rows in zip(cameras, camera_rows)])
+        camera_waypoints = {}
+        if self.output_modality == "waypoints":
+            for i in np.arange(1, self.n_waypoints + 1):
+                for axis in ["x", "y"]:
+                    camera_waypoints[f"wp{i}_all_{axis}"] = np.concatenate([
+                        frames_df[f"wp{i}_{frames_camera}_{axis}"].to_numpy()[rows]
+                        for frames_camera, rows in zip(cameras, camera_rows)])
+
+        turn_signal = frames_df["turn_signal"].fillna(1).to_numpy().astype(int)
+        if camera == 'all':
+            frames_df = frames_df.loc[:, ~frames_df.columns.str.fullmatch(CAMERA_COLUMNS)]
+        frames_df = frames_df.take(rows)
         frames_df["row_id"] = frames_df.index
 
         # temp hack
@@ -267,29 +743,8 @@ class NvidiaDataset(Dataset):
             frames_df["autonomous"] = False
         # frames_df["autonomous"] = False
 
-        frames_df = frames_df[frames_df['steering_angle'].notna()]  # TODO: one steering angle is NaN, why?
-        if camera != Camera.FRONT_WIDE.value:
-            frames_df = frames_df[frames_df['steering_angle_left'].notna()]
-            frames_df = frames_df[frames_df['steering_angle_right'].notna()]
-        frames_df = frames_df[frames_df['vehicle_speed'].notna()]
-        frames_df = frames_df[frames_df[f'{camera}_filename'].notna()]
-
-        frames_df["turn_signal"].fillna(1, inplace=True)
-        frames_df["turn_signal"] = frames_df["turn_signal"].astype(int)
-
-        # Removed frames marked as skipped
-        frames_df = frames_df[frames_df["turn_signal"] != -1]  # TODO: remove magic values.
-
-        if self.output_modality == "waypoints":
-            frames_df = frames_df[frames_df[f"position_x"].notna()]
-            frames_df = frames_df[frames_df[f"position_y"].notna()]
-
-            for i in np.arange(1, self.n_waypoints + 1):
-                frames_df = frames_df[frames_df[f"wp{i}_{camera}_x"].notna()]
-                frames_df = frames_df[frames_df[f"wp{i}_{camera}_y"].notna()]
-
-        frames_df["yaw_delta"] = np.abs(frames_df["yaw"]) - np.abs(frames_df["yaw"]).shift(-1)
-        frames_df = frames_df[np.abs(frames_df["yaw_delta"]) < 0.1]
+        frames_df["turn_signal"] = turn_signal[rows]
+        frames_df["yaw_delta"] = np.concatenate(yaw_deltas)
 
         # if self.calculate_waypoints:
         #
@@ -325,26 +780,80 @@ class NvidiaDataset(Dataset):
 
         len_after_filtering = len(frames_df)
 
-        camera_images = frames_df[f"{camera}_filename"].to_numpy()
         frames_df["image_path"] = [str(dataset_path / image_path) for image_path in camera_images]
-        if self.output_modality == "waypoints":
-            for i in np.arange(1, self.n_waypoints + 1):
-                frames_df[f"wp{i}_all_x"] = frames_df[f"wp{i}_{camera}_x"]
-                frames_df[f"wp{i}_all_y"] = frames_df[f"wp{i}_{camera}_y"]
+        for column, values in camera_waypoints.items():
+            frames_df[column] = values
 
-        frames_df["camera_type"] = camera
+        frames_df["camera_type"] = np.repeat(cameras, [len(rows) for rows in camera_rows])
 
-        print(f"{dataset_path}: lenght={len(frames_df)}, filtered={len_before_filtering - len_after_filtering}")
+        print(f"{dataset_path}: lenght={len(frames_df)}, "
+              f"filtered={len(cameras) * len_before_filtering - len_after_filtering}")
         frames_df.reset_index(inplace=True)
+        frames_df.attrs["metadata_rows"] = len_before_filtering
         return frames_df
 
+    def filter_rows(self, frames_df, camera):
+        """
+        Returns positions of frames usable with given camera and yaw deltas of these frames. Filters are combined into
+        single mask, so metadata is copied only once.
+        """
+        # TODO: one steering angle is NaN, why?
+        required_columns = ['steering_angle', 'vehicle_speed', f'{camera}_filename']
+        if camera != Camera.FRONT_WIDE.value:
+            required_columns += ['steering_angle_left', 'steering_angle_right']
+        if self.output_modality == "waypoints":
+            required_columns += ["position_x", "position_y"]
+            for i in np.arange(1, self.n_waypoints + 1):
+                required_columns += [f"wp{i}_{camera}_x", f"wp{i}_{camera}_y"]
+
+        mask = np.ones(len(frames_df), dtype=bool)
+        for column in required_columns:
+            mask &= frames_df[column].notna().to_numpy()
+
+        # Removed frames marked as skipped
+        mask &= frames_df["turn_signal"].to_numpy() != -1  # TODO: remove magic values.
+
+        # yaw delta is calculated between consecutive frames left after previous filters
+        abs_yaw = np.abs(frames_df["yaw"].to_numpy()[mask])
+        yaw_delta = np.full(len(abs_yaw), np.nan)
+        yaw_delta[:-1] = abs_yaw[:-1] - abs_yaw[1:]
+        valid_yaw = np.abs(yaw_delta) < 0.1
+        return np.flatnonzero(mask)[valid_yaw], yaw_delta[valid_yaw]
+
+    def add_shards(self, frames_df, dataset_path):
+        if type(dataset_path) is dict:
+            dataset_path = dataset_path['path']
+
+        shard_ids = np.empty(len(frames_df), dtype=np.int64)
+        shard_offsets = np.empty(len(frames_df), dtype=np.int64)
+        camera_types = frames_df["camera_type"].to_numpy()
+        row_ids = frames_df["row_id"].to_numpy()
+        for camera in np.unique(camera_types):
+            shard_path = shard_cache_path(dataset_path, camera, self.shard_cache)
+            if not (shard_path / "index.npy").exists():
+                print(f"Shards of {camera} camera not found in {shard_path}, build them with build_shards.py")
+                sys.exit()
+            shard_reader = ShardReader(shard_path)
+            if len(shard_reader.index) != frames_df.attrs["metadata_rows"]:
+                print(f"Shards in {shard_reader.path} were not built from {self.metadata_file}")
+                sys.exit()
+            camera_frames = camera_types == camera
+            shard_ids[camera_frames] = len(self.shard_readers)
+            shard_offsets[camera_frames] = shard_reader.offsets(row_ids[camera_frames])
+            self.shard_readers.append(shard_reader)
+
+        frames_df["shard_id"] = shard_ids
+        frames_df["shard_offset"] = shard_offsets
+
     def steering_angles_degrees(self):
         return self.frames.steering_angle.to_numpy() / np.pi * 180
 
 
 class NvidiaTrainDataset(NvidiaDataset):
     def __init__(self, root_path, output_modality="steering_angle", n_branches=3, n_waypoints=10,
-                 camera="front_wide", augment_conf=AugmentationConfig(), metadata_file="nvidia_frames.csv"):
+                 camera="front_wide", augment_conf=AugmentationConfig(), metadata_file="nvidia_frames.csv",
+                 shard_cache=None, frame_cache_bytes=0, metadata_cache_dir=None, normalize=True, read_ahead=0,
+                 waypoint_spacing=None):
         self.dataset_paths = [
             root_path / "2021-05-20-12-36-10_e2e_sulaoja_20_30",
             root_path / "2021-05-20-12-43-17_e2e_sulaoja_20_30",
@@ -393,15 +902,19 @@ class NvidiaTrainDataset(NvidiaDataset):
             root_path / "2021-10-25-17-06-34_e2e_rec_ss2_arula_back",
         ]
 
-        tr = transforms.Compose([AugmentImage(augment_config=augment_conf), Normalize()])
+        # without normalization images are kept uint8 and are normalized on the training device
+        tr = transforms.Compose([AugmentImage(augment_config=augment_conf)] + ([Normalize()] if normalize else []))
         super().__init__(self.dataset_paths, tr, camera=camera, output_modality=output_modality, n_branches=n_branches,
-                         n_waypoints=n_waypoints, metadata_file=metadata_file)
+                         n_waypoints=n_waypoints, metadata_file=metadata_file, shard_cache=shard_cache,
+                         frame_cache_bytes=frame_cache_bytes, metadata_cache_dir=metadata_cache_dir,
+                         read_ahead=read_ahead, waypoint_spacing=waypoint_spacing)
 
 
 class NvidiaValidationDataset(NvidiaDataset):
     # todo: remove default parameters
     def __init__(self, root_path, output_modality="steering_angle", n_branches=3, n_waypoints=10, camera="front_wide",
-                 metadata_file="nvidia_frames.csv"):
+                 metadata_file="nvidia_frames.csv", shard_cache=None, frame_cache_bytes=0, metadata_cache_dir=None,
+                 normalize=True, read_ahead=0, waypoint_spacing=None):
         self.dataset_paths = [
             root_path / "2021-05-28-15-19-48_e2e_sulaoja_20_30",
             #root_path / "2021-06-07-14-20-07_e2e_rec_ss6",
@@ -418,14 +931,17 @@ class NvidiaValidationDataset(NvidiaDataset):
             #root_path / "2022-06-10-13-03-20_e2e_elva_backward"
         ]
 
-        tr = transforms.Compose([Normalize()])
+        tr = transforms.Compose([Normalize()] if normalize else [])
         super().__init__(self.dataset_paths, tr, camera=camera, output_modality=output_modality, n_branches=n_branches,
-                         n_waypoints=n_waypoints, metadata_file=metadata_file)
+                         n_waypoints=n_waypoints, metadata_file=metadata_file, shard_cache=shard_cache,
+                         frame_cache_bytes=frame_cache_bytes, metadata_cache_dir=metadata_cache_dir,
+                         read_ahead=read_ahead, waypoint_spacing=waypoint_spacing)
 
 
 class NvidiaWinterTrainDataset(NvidiaDataset):
     def __init__(self, root_path, output_modality="steering_angle",
-                 n_branches=3, n_waypoints=10, augment_conf=AugmentationConfig()):
+                 n_branches=3, n_waypoints=10, augment_conf=AugmentationConfig(), normalize=True,
+                 metadata_file="nvidia_frames.csv", metadata_cache_dir=None, waypoint_spacing=None):
         train_paths = [
             root_path / '2021-11-08-11-24-44_e2e_rec_ss12_raanitsa',
             root_path / '2021-11-08-12-08-40_e2e_rec_ss12_raanitsa_backward',
@@ -448,12 +964,15 @@ class NvidiaWinterTrainDataset(NvidiaDataset):
             root_path / "2022-01-18-15-49-26_e2e_rec_kanepi_backwards",
         ]
 
-        tr = transforms.Compose([AugmentImage(augment_config=augment_conf), Normalize()])
-        super().__init__(train_paths, tr, output_modality=output_modality, n_branches=n_branches, n_waypoints=n_waypoints)
+        tr = transforms.Compose([AugmentImage(augment_config=augment_conf)] + ([Normalize()] if normalize else []))
+        super().__init__(train_paths, tr, output_modality=output_modality, n_branches=n_branches, n_waypoints=n_waypoints,
+                         metadata_file=metadata_file, metadata_cache_dir=metadata_cache_dir,
+                         waypoint_spacing=waypoint_spacing)
 
 
 class NvidiaWinterValidationDataset(NvidiaDataset):
-    def __init__(self, root_path, output_modality="steering_angle", n_branches=3, n_waypoints=10):
+    def __init__(self, root_path, output_modality="steering_angle", n_branches=3, n_waypoints=10, normalize=True,
+                 metadata_file="nvidia_frames.csv", metadata_cache_dir=None, waypoint_spacing=None):
         valid_paths = [
             root_path / "2022-01-18-12-37-01_e2e_rec_arula_forward",
             root_path / "2022-01-18-12-47-32_e2e_rec_arula_forward_continue",
@@ -463,5 +982,7 @@ class NvidiaWinterValidationDataset(NvidiaDataset):
             root_path / "2022-01-25-15-34-01_e2e_rec_vahi_backwards",
         ]
 
-        tr = transforms.Compose([Normalize()])
-        super().__init__(valid_paths, tr, output_modality=output_modality, n_branches=n_branches, n_waypoints=n_waypoints)
+        tr = transforms.Compose([Normalize()] if normalize else [])
+        super().__init__(valid_paths, tr, output_modality=output_modality, n_branches=n_branches, n_waypoints=n_waypoints,
+                         metadata_file=metadata_file, metadata_cache_dir=metadata_cache_dir,
+                         waypoint_spacing=waypoint_spacing)
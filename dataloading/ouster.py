@@ -1,3 +1,5 @@
+import sys
+
 import numpy as np
 import pandas as pd
 import torch
@@ -7,6 +9,14 @@ from torchvision import transforms
 
 from torch.utils.data import Dataset
 
+from dataloading.compact import ImagePaths, compact_frames
+from dataloading.frame_cache import SharedFrameCache, key_ids, split_crop_transforms
+from dataloading.read_ahead import READ_AHEAD_DEPTH, ReadAheadReader, ReadStats, read_ahead_images
+from dataloading.shards import ShardReader, shard_cache_path
+
+# crop name of lidar shards built with OusterCrop
+OUSTER_CROP_SHARDS = "ouster-crop"
+
 
 class OusterCrop(object):
     def __init__(self, xmin=384, ymin=54):
@@ -19,6 +29,9 @@ class OusterCrop(object):
         data["image"] = data["image"][..., self.ymin:self.ymin + self.height, self.xmin:self.xmin + self.width]
         return data
 
+    def crop_box(self):
+        return self.ymin, self.xmin, self.height, self.width, self.height, self.width
+
 
 class OusterNormalize(object):
     def __call__(self, data, transform=None):
@@ -33,7 +46,8 @@ class OusterDataset(Dataset):
         "range": 0
     }
 
-    def __init__(self, dataset_paths, transform=None, filter_turns=False, channel=None):
+    def __init__(self, dataset_paths, transform=None, filter_turns=False, channel=None, frame_cache_bytes=0,
+                 shard_cache=None, read_ahead=0):
 
         self.dataset_paths = dataset_paths
         if transform:
@@ -44,27 +58,105 @@ class OusterDataset(Dataset):
         print(f"Using only lidar channel {channel}")
         self.channel = channel
 
+        # Crop name of planar lidar shards built with build_shards.py. Each channel is stored separately, so only the
+        # used channels are read. Transform must not crop the image again if shards are cropped.
+        self.shard_cache = shard_cache
+        self.shard_channels = [channel] if channel else sorted(self.CHANNEL_MAP, key=self.CHANNEL_MAP.get)
+        self.shard_readers = []
+
+        # Image files of a batch are read by read_ahead reader threads ahead of decoding, not used with shards.
+        self.reader = None
+        self.read_stats = None
+        if read_ahead and not shard_cache:
+            self.read_stats = ReadStats(read_ahead * READ_AHEAD_DEPTH)
+            self.reader = ReadAheadReader(read_ahead, read_ahead * READ_AHEAD_DEPTH, self.read_stats)
+
         datasets = [self.read_dataset(dataset_path) for dataset_path in dataset_paths]
+        if self.shard_cache:
+            for frames_df, dataset_path in zip(datasets, dataset_paths):
+                self.add_shards(frames_df, dataset_path['path'] if type(dataset_path) is dict else dataset_path)
         self.frames = pd.concat(datasets)
 
         if filter_turns:
             print("Filtering turns with blinker signal")
             self.frames = self.frames[self.frames.turn_signal == 1]
 
-    def __getitem__(self, idx):
-        frame = self.frames.iloc[idx]
+        # paths and frames are kept compact, so forked dataloader workers don't copy them on access
+        self.image_paths = ImagePaths.from_paths(self.frames["image_path"].to_numpy())
+        self.frames = compact_frames(self.frames)
+        self.steering_angles = self.frames["steering_angle"].to_numpy(dtype=np.float32)
+        self.vehicle_speeds = self.frames["vehicle_speed"].to_numpy(dtype=np.float32)
+        self.turn_signals = self.frames["turn_signal"].to_numpy(dtype=np.int64)
+        self.row_ids = self.frames["row_id"].to_numpy(dtype=np.int64)
+        if self.shard_cache:
+            self.shard_ids = self.frames["shard_id"].to_numpy(dtype=np.int64)
+            self.shard_offsets = self.frames["shard_offset"].to_numpy(dtype=np.int64)
+
+        # Decoded and cropped frames are cached in shared memory before normalization.
+        self.frame_cache = None
+        self.cache_crops = []
+        if frame_cache_bytes and len(self.frames) > 0:
+            self.cache_crops, self.transform = split_crop_transforms(self.transform)
+            n_keys, self.cache_keys = key_ids(self.image_paths)
+            self.frame_cache = SharedFrameCache(n_keys, self.decode_image(0).shape, frame_cache_bytes)
+
+    def load_image(self, idx):
+        if self.frame_cache:
+            image = self.frame_cache.get(self.cache_keys[idx])
+            if image is None:
+                image = self.decode_image(idx)
+                self.frame_cache.put(self.cache_keys[idx], image)
+            return image
+        return self.decode_image(idx)
+
+    def load_images(self, indices):
+        """Images of given frames in order, same as load_image. With read ahead, files are read ahead of decoding."""
+        if self.reader:
+            return read_ahead_images(self, indices)
+        return (self.load_image(idx) for idx in indices)
+
+    def decode_image(self, idx):
+        if self.shard_cache:
+            channel_readers = self.shard_readers[self.shard_ids[idx]]
+            offset = self.shard_offsets[idx]
+            if len(channel_readers) == 1:
+                image = channel_readers[0][offset]
+            else:
+                image = torch.cat([reader[offset] for reader in channel_readers])
+        else:
+            image = self.select_channel(torchvision.io.read_image(self.image_paths[idx]))
 
-        image = torchvision.io.read_image(frame["image_path"])
+        for crop in self.cache_crops:
+            image = crop({"image": image})["image"]
+        return image
+
+    def decode_buffer(self, idx, buffer):
+        """Same as decode_image, but from contents of the image file of frame idx."""
+        image = self.select_channel(torchvision.io.decode_image(torch.from_numpy(buffer)))
+        for crop in self.cache_crops:
+            image = crop({"image": image})["image"]
+        return image
+
+    def select_channel(self, image):
         if self.channel:
             channel_idx = self.CHANNEL_MAP[self.channel]
             image = torch.unsqueeze(image[channel_idx], dim=0)
+        return image
+
+    def __getitem__(self, idx):
+        return self.create_sample(idx, self.load_image(idx))
 
+    def __getitems__(self, indices):
+        """Samples of a batch for DataLoader with automatic batching, images are loaded with load_images."""
+        return [self.create_sample(idx, image) for idx, image in zip(indices, self.load_images(indices))]
+
+    def create_sample(self, idx, image):
         data = {
             'image': image,
-            'steering_angle': np.array(frame["steering_angle"]),
-            'vehicle_speed': np.array(frame["vehicle_speed"]),
-            'turn_signal': np.array(frame["turn_signal"]),
-            'row_id': np.array(frame["row_id"])
+            'steering_angle': np.array(self.steering_angles[idx]),
+            'vehicle_speed': np.array(self.vehicle_speeds[idx]),
+            'turn_signal': np.array(self.turn_signals[idx]),
+            'row_id': np.array(self.row_ids[idx])
         }
 
         if self.transform:
@@ -104,11 +196,30 @@ class OusterDataset(Dataset):
 
         len_after_filtering = len(frames_df)
         print(f"{dataset_path}: {len(frames_df)}, filtered={len_before_filtering-len_after_filtering}")
+        frames_df.attrs["metadata_rows"] = len_before_filtering
         return frames_df
 
+    def add_shards(self, frames_df, dataset_path):
+        shard_paths = [shard_cache_path(dataset_path, f"lidar_{channel}", self.shard_cache)
+                       for channel in self.shard_channels]
+        for shard_path in shard_paths:
+            if not (shard_path / "index.npy").exists():
+                print(f"Lidar shards not found in {shard_path}, build them with build_shards.py")
+                sys.exit()
+        channel_readers = [ShardReader(shard_path) for shard_path in shard_paths]
+        if len(channel_readers[0].index) != frames_df.attrs["metadata_rows"]:
+            print(f"Shards in {channel_readers[0].path} were not built from lidar_frames.csv")
+            sys.exit()
+
+        frames_df["shard_id"] = len(self.shard_readers)
+        # all channels are written with the same index
+        frames_df["shard_offset"] = channel_readers[0].offsets(frames_df["row_id"].to_numpy())
+        self.shard_readers.append(channel_readers)
+
 
 class OusterTrainDataset(OusterDataset):
-    def __init__(self, root_path, filter_turns=False, channel=None):
+    def __init__(self, root_path, filter_turns=False, channel=None, frame_cache_bytes=0, normalize=True,
+                 shard_cache=None, read_ahead=0):
         train_paths = [
             root_path / "2021-05-20-12-36-10_e2e_sulaoja_20_30",
             root_path / "2021-05-20-12-43-17_e2e_sulaoja_20_30",
@@ -157,13 +268,17 @@ class OusterTrainDataset(OusterDataset):
             root_path / "2021-10-25-17-06-34_e2e_rec_ss2_arula_back"
         ]
 
-        tr = transforms.Compose([OusterCrop(), OusterNormalize()])
+        # without normalization images are kept uint8 and are normalized on the training device
+        crop = [] if shard_cache == OUSTER_CROP_SHARDS else [OusterCrop()]
+        tr = transforms.Compose(crop + ([OusterNormalize()] if normalize else []))
 
-        super().__init__(train_paths, tr, filter_turns=filter_turns, channel=channel)
+        super().__init__(train_paths, tr, filter_turns=filter_turns, channel=channel,
+                         frame_cache_bytes=frame_cache_bytes, shard_cache=shard_cache, read_ahead=read_ahead)
 
 
 class OusterValidationDataset(OusterDataset):
-    def __init__(self, root_path, filter_turns=False, channel=None):
+    def __init__(self, root_path, filter_turns=False, channel=None, frame_cache_bytes=0, normalize=True,
+                 shard_cache=None, read_ahead=0):
         valid_paths = [
             root_path / "2021-05-28-15-19-48_e2e_sulaoja_20_30",
             root_path / "2021-06-07-14-20-07_e2e_rec_ss6",
@@ -179,5 +294,7 @@ class OusterValidationDataset(OusterDataset):
 
         ]
 
-        tr = transforms.Compose([OusterCrop(), OusterNormalize()])
-        super().__init__(valid_paths, tr, filter_turns=filter_turns, channel=channel)
+        crop = [] if shard_cache == OUSTER_CROP_SHARDS else [OusterCrop()]
+        tr = transforms.Compose(crop + ([OusterNormalize()] if normalize else []))
+        super().__init__(valid_paths, tr, filter_turns=filter_turns, channel=channel,
+                         frame_cache_bytes=frame_cache_bytes, shard_cache=shard_cache, read_ahead=read_ahead)
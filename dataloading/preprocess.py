@@ -1,18 +1,18 @@
 import argparse
-import math
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
-from pytransform3d.urdf import UrdfTransformManager
-from pytransform3d import rotations as pr
-from pytransform3d import transformations as pt
+from dataloading.incremental import run_incremental
+from dataloading.label_overrides import apply_label_overrides, label_overrides_hash
+from dataloading.model import Camera
+from dataloading.waypoints import N_WAYPOINTS, URDF_PATH, WAYPOINT_CAP, camera_waypoints, local_waypoints, \
+    rotation_matrices, waypoint_indices
 
-from dataloading.model import Camera, TurnSignal
-
-SKIP = -1
+# Increase when waypoint computation or applying label overrides changes, so existing nvidia_frames_ext.csv files are
+# created again
+WAYPOINTS_VERSION = 1
 
 
 def parse_arguments():
@@ -30,18 +30,31 @@ def parse_arguments():
         help='Dataset name to preprocess. If not provided all datasets in given folder are preprocessed.'
     )
 
+    argparser.add_argument(
+        '--num-workers',
+        type=int,
+        default=8,
+        help='Number of processes preprocessing drives in parallel.'
+    )
+
+    argparser.add_argument(
+        '--force',
+        default=False,
+        action='store_true',
+        help='Preprocess drives again even if their output is up to date.'
+    )
+
     return argparser.parse_args()
 
 
-def preprocess_dataset(dataset_folder, dataset_name):
+def preprocess_dataset(dataset_folder, dataset_name, num_workers=8, force=False):
     root_path = Path(dataset_folder)
     if dataset_name:
-        create_waypoints([root_path / dataset_name])
+        dataset_paths = [root_path / dataset_name]
     else:
         dataset_paths = get_dataset_paths(root_path)
-        create_waypoints(dataset_paths)
 
-    fix_frames(root_path)
+    create_waypoints(dataset_paths, num_workers, force)
 
 
 def get_dataset_paths(root_path):
@@ -133,326 +146,58 @@ def get_dataset_paths(root_path):
     return dataset_paths
 
 
-def create_waypoints(dataset_paths):
-    for dataset_path in dataset_paths:
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames.csv", index_col='index')
-        frames_df = frames_df[frames_df[f"position_x"].notna()]
-
-        # distance
-        next_pos_df = frames_df.shift(-1)
-        frames_df["distance"] = np.sqrt((next_pos_df.position_x - frames_df.position_x) ** 2 +
-                                        (next_pos_df.position_y - frames_df.position_y) ** 2)
-
-        N_WAYPOINTS = 10
-        WAYPOINT_CAP = 5
-
-        # initialize columns to NaN
-        for wp_i in np.arange(1, N_WAYPOINTS + 1):
-            frames_df[f"wp_steering_{wp_i}"] = np.nan
-
-            frames_df[f"wp{wp_i}_x"] = np.nan
-            frames_df[f"wp{wp_i}_y"] = np.nan
-            frames_df[f"wp{wp_i}_z"] = np.nan
-
-            frames_df[f"wp{wp_i}_{Camera.FRONT_WIDE.value}_x"] = np.nan
-            frames_df[f"wp{wp_i}_{Camera.FRONT_WIDE.value}_y"] = np.nan
-            frames_df[f"wp{wp_i}_{Camera.FRONT_WIDE.value}_z"] = np.nan
-
-            frames_df[f"wp{wp_i}_{Camera.LEFT.value}_x"] = np.nan
-            frames_df[f"wp{wp_i}_{Camera.LEFT.value}_y"] = np.nan
-            frames_df[f"wp{wp_i}_{Camera.LEFT.value}_z"] = np.nan
-
-            frames_df[f"wp{wp_i}_{Camera.RIGHT.value}_x"] = np.nan
-            frames_df[f"wp{wp_i}_{Camera.RIGHT.value}_y"] = np.nan
-            frames_df[f"wp{wp_i}_{Camera.RIGHT.value}_z"] = np.nan
-
-        tm = get_transform_manager()
-
-        progress_bar = tqdm(frames_df.iterrows(), total=frames_df.shape[0])
-        for index, row in progress_bar:
-            progress_bar.set_description(f"Processing {dataset_path.name}")
-
-            window = frames_df[index:]
-            window_cumsum = window['distance'].cumsum()
-
-            base_transform = calculate_waypoint_transform(row)
-
-            for wp_i in np.arange(1, N_WAYPOINTS + 1):  # TODO: vectorize
-                window_index = window_cumsum.searchsorted(wp_i * WAYPOINT_CAP)
-                next_wp = window.iloc[window_index]
-
-                cumsum = window_cumsum[window_index]
-                if math.isnan(cumsum) or math.ceil(cumsum) < wp_i * WAYPOINT_CAP:
-                    break
-
-                frames_df.loc[index, f"wp_steering_{wp_i}"] = next_wp["steering_angle"]
-
-                wp_global = np.array([next_wp["position_x"], next_wp["position_y"], next_wp["position_z"], 1])
-                wp_local = pt.transform(pt.invert_transform(base_transform), wp_global)
-                frames_df.loc[index, f"wp{wp_i}_x"] = wp_local[0]
-                frames_df.loc[index, f"wp{wp_i}_y"] = wp_local[1]
-                frames_df.loc[index, f"wp{wp_i}_z"] = wp_local[2]
-
-                center_cam_transform = tm.get_transform("base_link", "interfacea_link2")
-                wp_center_cam = pt.transform(center_cam_transform, wp_local)
-                # Camera frames are rotated compared to base_link frame (x = z, y = -x, z = -y)
-                frames_df.loc[index, f"wp{wp_i}_{Camera.FRONT_WIDE.value}_x"] = wp_center_cam[2]
-                frames_df.loc[index, f"wp{wp_i}_{Camera.FRONT_WIDE.value}_y"] = -wp_center_cam[0]
-                frames_df.loc[index, f"wp{wp_i}_{Camera.FRONT_WIDE.value}_z"] = -wp_center_cam[1]
-
-                left_cam_transform = tm.get_transform("base_link", "interfacea_link0")
-                wp_left_cam = pt.transform(left_cam_transform, wp_local)
-                frames_df.loc[index, f"wp{wp_i}_{Camera.LEFT.value}_x"] = wp_left_cam[2]
-                frames_df.loc[index, f"wp{wp_i}_{Camera.LEFT.value}_y"] = -wp_left_cam[0]
-                frames_df.loc[index, f"wp{wp_i}_{Camera.LEFT.value}_z"] = -wp_left_cam[1]
-
-                right_cam_transform = tm.get_transform("base_link", "interfacea_link1")
-                wp_right_cam = pt.transform(right_cam_transform, wp_local)
-                frames_df.loc[index, f"wp{wp_i}_{Camera.RIGHT.value}_x"] = wp_right_cam[2]
-                frames_df.loc[index, f"wp{wp_i}_{Camera.RIGHT.value}_y"] = -wp_right_cam[0]
-                frames_df.loc[index, f"wp{wp_i}_{Camera.RIGHT.value}_z"] = -wp_right_cam[1]
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-
-def calculate_waypoint_transform(row):
-    rot_mat = pr.active_matrix_from_intrinsic_euler_xyz(np.array([row["roll"], row["pitch"], row["yaw"]]))
-    translate_mat = np.array([row["position_x"], row["position_y"], row["position_z"]])
-    wp_trans = pt.transform_from(rot_mat, translate_mat)
-    return wp_trans
-
-
-def get_transform_manager():
-    tm = UrdfTransformManager()
-
-    filename = "dataloading/platform.urdf"
-    with open(filename, "r") as f:
-        tm.load_urdf(f.read())
-
-    return tm
-
-
-def fix_frames(root_path):
-
-    dataset_path = root_path / "2021-10-20-15-11-29_e2e_rec_vastse_ss13_17_back"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[5841:5937].index, 'turn_signal'] = TurnSignal.STRAIGHT.value
-        frames_df.loc[frames_df.iloc[7876:8444].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[10865:11160].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[19455:19670].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[25105:25335].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-26-11-08-59_e2e_rec_ss20_elva_back"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[17663:17880].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[17881:18303].index, 'turn_signal'] = TurnSignal.STRAIGHT.value
-        frames_df.loc[frames_df.iloc[31705:31950].index, 'turn_signal'] = TurnSignal.STRAIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-07-14-36-16_e2e_rec_ss6"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[7395:7530].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[18900:19100].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-07-14-20-07_e2e_rec_ss6"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[22677:22824].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-26-10-49-06_e2e_rec_ss20_elva"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[9120:9280].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[14580:14843].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-09-14-58-11_e2e_rec_ss3"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[8635:8880].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[3775:4475].index, 'turn_signal'] = SKIP
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-09-16-24-59_e2e_rec_ss13"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[6802:7040].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[12459:12715].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[17275:17518].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[25335:25525].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[14650:15190].index, 'turn_signal'] = SKIP
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-10-13-19-22_e2e_ss4_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[2395:2645].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[6923:7190].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[14740:14970].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-09-15-42-05_e2e_rec_ss3_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[13618:13855].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[32989:33220].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[34566:34760].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[36935:37210].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[38989:39175].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-20-14-15-07_e2e_rec_neeruti_ss19_22_back"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[4800:5090].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[13885:14210].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-09-16-50-22_e2e_rec_ss13_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[13327:13522].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[18901:19215].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[19215:19431].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[21236:21554].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[21555:21675].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[21675:21787].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[24410:24649].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-14-11-22-05_e2e_rec_ss14"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[4230:4450].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[16939:17113].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-10-12-59-59_e2e_ss4"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[16159:16457].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[18257:18748].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[24473:24733].index, 'turn_signal'] = SKIP
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-14-11-43-48_e2e_rec_ss14_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[25210:25434].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-10-14-44-24_e2e_ss3_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[7891:8000].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[29011:29216].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-11-14-50-59_e2e_rec_vahi"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[11365:11610].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-09-30-15-56-59_e2e_ss14_attempt_2"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[7785:8015].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[29232:29477].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[47877:47940].index, 'turn_signal'] = TurnSignal.STRAIGHT.value
-        frames_df.loc[frames_df.iloc[47940:48052].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-09-13-55-03_e2e_rec_ss2_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[19262:19484].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-07-13-22-35_e2e_rec_ss4_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[8471:8690].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-09-24-13-39-38_e2e_rec_ss11"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[7338:7564].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[8657:9043].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-06-10-15-03-16_e2e_ss3_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[1311:1470].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-07-11-05-13_e2e_rec_ss3"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[9820:10102].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.loc[frames_df.iloc[35804:36017].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-25-17-06-34_e2e_rec_ss2_arula_back"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[18591:18870].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-09-30-15-03-37_e2e_ss14_from_half_way"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[8160:8534].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-09-24-12-02-32_e2e_rec_ss10_3"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[4793:4945].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-14-13-08-51_e2e_rec_vahi_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[2893:3105].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-10-20-14-55-47_e2e_rec_vastse_ss13_17"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[22109:22425].index, 'turn_signal'] = TurnSignal.RIGHT.value
-        frames_df.loc[frames_df.iloc[22426:22596].index, 'turn_signal'] = TurnSignal.STRAIGHT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-09-24-14-03-45_e2e_rec_ss11_backwards"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[1765:2153].index, 'turn_signal'] = TurnSignal.LEFT.value
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-        # Dirty/wet camera
-
-    dataset_path = root_path / "2021-09-24-11-19-25_e2e_rec_ss10"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[26250:26470].index, 'turn_signal'] = SKIP
-        frames_df.loc[frames_df.iloc[27210:27620].index, 'turn_signal'] = SKIP
-        frames_df.loc[frames_df.iloc[29250:29445].index, 'turn_signal'] = SKIP
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
-    dataset_path = root_path / "2021-09-24-11-40-24_e2e_rec_ss10_2"
-    if dataset_path.exists():
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        frames_df.loc[frames_df.iloc[5440:6025].index, 'turn_signal'] = SKIP
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
-
+def create_waypoints(dataset_paths, num_workers=8, force=False):
+    """
+    Creates waypoints of drives in parallel processes, drives whose nvidia_frames_ext.csv is up to date with their
+    nvidia_frames.csv, platform.urdf and label overrides are skipped. Returns processed drives.
+    """
+    return run_incremental(create_drive_waypoints, dataset_paths, "nvidia_frames_ext.csv", waypoint_inputs,
+                           WAYPOINTS_VERSION, num_workers, force, description="Creating waypoints",
+                           input_values=waypoint_input_values)
+
+
+def waypoint_inputs(dataset_path):
+    return [dataset_path / "nvidia_frames.csv", URDF_PATH]
+
+
+def waypoint_input_values(dataset_path):
+    return {"label_overrides": label_overrides_hash(dataset_path.name)}
+
+
+def create_drive_waypoints(dataset_path):
+    """
+    Writes nvidia_frames_ext.csv of the drive with N_WAYPOINTS waypoints WAYPOINT_CAP meters apart for every frame,
+    in base_link frame and in frames of all cameras, and steering angle at every waypoint. Turn signals are corrected
+    by LABEL_OVERRIDES of the drive.
+    """
+    frames_df = pd.read_csv(dataset_path / "nvidia_frames.csv", index_col='index')
+    frames_df = frames_df[frames_df[f"position_x"].notna()]
+
+    # distance
+    next_pos_df = frames_df.shift(-1)
+    frames_df["distance"] = np.sqrt((next_pos_df.position_x - frames_df.position_x) ** 2 +
+                                    (next_pos_df.position_y - frames_df.position_y) ** 2)
+
+    travelled = np.concatenate([[0.0], np.nancumsum(frames_df["distance"].to_numpy()[:-1])])
+    indices = waypoint_indices(travelled, N_WAYPOINTS, WAYPOINT_CAP)
+    positions = frames_df[["position_x", "position_y", "position_z"]].to_numpy(dtype=np.float64)
+    rotations = rotation_matrices(frames_df["roll"].to_numpy(), frames_df["pitch"].to_numpy(),
+                                  frames_df["yaw"].to_numpy())
+    waypoints = local_waypoints(positions, rotations, indices)
+    steering_angles = np.where(indices >= 0, frames_df["steering_angle"].to_numpy()[np.maximum(indices, 0)], np.nan)
+    cameras = [Camera.FRONT_WIDE.value, Camera.LEFT.value, Camera.RIGHT.value]
+    cam_waypoints = {camera: camera_waypoints(waypoints, camera) for camera in cameras}
+
+    columns = {}
+    for wp_i in np.arange(1, N_WAYPOINTS + 1):
+        columns[f"wp_steering_{wp_i}"] = steering_angles[:, wp_i - 1]
+        for axis, axis_name in enumerate(["x", "y", "z"]):
+            columns[f"wp{wp_i}_{axis_name}"] = waypoints[:, wp_i - 1, axis]
+        for camera in cameras:
+            for axis, axis_name in enumerate(["x", "y", "z"]):
+                columns[f"wp{wp_i}_{camera}_{axis_name}"] = cam_waypoints[camera][:, wp_i - 1, axis]
+
+    frames_df = pd.concat([frames_df, pd.DataFrame(columns, index=frames_df.index)], axis=1)
+    apply_label_overrides(frames_df, dataset_path.name)
+    frames_df.to_csv(dataset_path / "nvidia_frames_ext.csv", header=True)
 
-if __name__ == "__main__":
-    args = parse_arguments()
-    preprocess_dataset(args.dataset_folder, args.dataset_name)
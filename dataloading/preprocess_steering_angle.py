@@ -3,12 +3,15 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
 import trajectory
+from dataloading.incremental import run_incremental
 from dataloading.model import Camera
 from dataloading.nvidia import NvidiaValidationDataset, NvidiaTrainDataset
 
+# Increase when steering angle computation changes, so existing nvidia_frames_ext2.csv files are created again
+STEERING_ANGLE_VERSION = 1
+
 
 def parse_arguments():
     argparser = argparse.ArgumentParser()
@@ -25,26 +28,47 @@ def parse_arguments():
         help='Dataset name to preprocess. If not provided all datasets in given folder are preprocessed.'
     )
 
+    argparser.add_argument(
+        '--num-workers',
+        type=int,
+        default=8,
+        help='Number of processes preprocessing drives in parallel.'
+    )
+
+    argparser.add_argument(
+        '--force',
+        default=False,
+        action='store_true',
+        help='Preprocess drives again even if their output is up to date.'
+    )
+
     return argparser.parse_args()
 
 
-def preprocess_dataset(dataset_folder, dataset_name):
+def preprocess_dataset(dataset_folder, dataset_name, num_workers=8, force=False):
     root_path = Path(dataset_folder)
     if dataset_name:
-        preprocess_steering_angle([root_path / dataset_name])
+        preprocess_steering_angle([root_path / dataset_name], num_workers, force)
     else:
         dataset_paths = get_dataset_paths(root_path)
-        preprocess_steering_angle(dataset_paths)
+        preprocess_steering_angle(dataset_paths, num_workers, force)
+
+
+def preprocess_steering_angle(dataset_paths, num_workers=8, force=False):
+    """
+    Computes side camera steering angles of drives in parallel processes, drives whose nvidia_frames_ext2.csv is up to
+    date with their nvidia_frames_ext.csv are skipped. Returns processed drives.
+    """
+    return run_incremental(preprocess_drive_steering_angle, dataset_paths, "nvidia_frames_ext2.csv",
+                           lambda dataset_path: [dataset_path / "nvidia_frames_ext.csv"], STEERING_ANGLE_VERSION,
+                           num_workers, force, description="Computing steering angles")
 
 
-def preprocess_steering_angle(dataset_paths):
-    progress = tqdm(dataset_paths)
-    for dataset_path in progress:
-        progress.set_description(dataset_path.name)
-        frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
-        create_steering_angles(frames_df, Camera.LEFT.value)
-        create_steering_angles(frames_df, Camera.RIGHT.value)
-        frames_df.to_csv(dataset_path / "nvidia_frames_ext2.csv", header=True)
+def preprocess_drive_steering_angle(dataset_path):
+    frames_df = pd.read_csv(dataset_path / "nvidia_frames_ext.csv", index_col='index')
+    create_steering_angles(frames_df, Camera.LEFT.value)
+    create_steering_angles(frames_df, Camera.RIGHT.value)
+    frames_df.to_csv(dataset_path / "nvidia_frames_ext2.csv", header=True)
 
 
 def create_steering_angles(frames_df, camera):
@@ -69,4 +93,4 @@ def get_dataset_paths(root_path):
 
 if __name__ == "__main__":
     args = parse_arguments()
-    preprocess_dataset(args.dataset_folder, args.dataset_name)
\ No newline at end of file
+    preprocess_dataset(args.dataset_folder, args.dataset_name, args.num_workers, args.force)
\ No newline at end of file
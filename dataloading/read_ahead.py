@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+# Upper edges of read latency histogram bins in seconds, 10 µs doubling up to ~10 s, last bin is open
+LATENCY_BINS = 1e-5 * 2.0 ** np.arange(21)
+# Reads in flight per reader thread, so a thread has next read queued while the caller waits for current one
+READ_AHEAD_DEPTH = 2
+# Number of processes with their own row of statistics, main process and dataloader workers by worker id
+STATS_SLOTS = 65
+
+
+def read_file(path):
+    """Whole file as writable uint8 array, can be decoded with cv2.imdecode or torchvision.io.decode_image."""
+    return np.fromfile(path, dtype=np.uint8)
+
+
+class ReadStats:
+    """
+    Histograms of reads of all dataloader workers, kept in shared memory. Must be created in the main process before
+    dataloader workers are started. Every process counts into its own row, so no lock is needed between processes.
+
+    Read latency is the time reader thread spent reading a file. Wait is the time decoding waited for bytes of the file,
+    with reads running ahead of decoding it's zero for reads that finished before their bytes were needed. Queue depth
+    is the number of reads in flight when a read is issued.
+    """
+
+    def __init__(self, max_pending):
+        self.read_latency = torch.zeros((STATS_SLOTS, len(LATENCY_BINS) + 1), dtype=torch.int64).share_memory_()
+        self.wait_latency = torch.zeros((STATS_SLOTS, len(LATENCY_BINS) + 1), dtype=torch.int64).share_memory_()
+        self.queue_depth = torch.zeros((STATS_SLOTS, max_pending + 1), dtype=torch.int64).share_memory_()
+        # bytes read and total read and wait seconds
+        self.totals = torch.zeros((STATS_SLOTS, 3), dtype=torch.float64).share_memory_()
+
+    @staticmethod
+    def slot():
+        worker_info = torch.utils.data.get_worker_info()
+        return 0 if worker_info is None else 1 + worker_info.id % (STATS_SLOTS - 1)
+
+    def add_read(self, slot, seconds, n_bytes):
+        self.read_latency[slot, np.searchsorted(LATENCY_BINS, seconds)] += 1
+        self.totals[slot, 0] += n_bytes
+        self.totals[slot, 1] += seconds
+
+    def add_wait(self, slot, seconds):
+        self.wait_latency[slot, np.searchsorted(LATENCY_BINS, seconds)] += 1
+        self.totals[slot, 2] += seconds
+
+    def add_depth(self, slot, depth):
+        self.queue_depth[slot, depth] += 1
+
+    def histograms(self):
+        """Histograms summed over all processes, latency bins are upper edges from LATENCY_BINS and inf."""
+        return {
+            'latency_bins': np.append(LATENCY_BINS, np.inf),
+            'read_latency': self.read_latency.sum(dim=0).numpy(),
+            'wait_latency': self.wait_latency.sum(dim=0).numpy(),
+            'queue_depth': self.queue_depth.sum(dim=0).numpy(),
+        }
+
+    def summary(self):
+        histograms = self.histograms()
+        totals = self.totals.sum(dim=0).numpy()
+        n_reads = int(histograms['read_latency'].sum())
+        depths = histograms['queue_depth']
+        return {
+            'reads': n_reads,
+            'read_gb': totals[0] / 1024 ** 3,
+            'read_seconds': totals[1],
+            'wait_seconds': totals[2],
+            'read_p50': latency_percentile(histograms['read_latency'], 0.5),
+            'read_p99': latency_percentile(histograms['read_latency'], 0.99),
+            'wait_p50': latency_percentile(histograms['wait_latency'], 0.5),
+            'wait_p99': latency_percentile(histograms['wait_latency'], 0.99),
+            'mean_queue_depth': float(np.arange(len(depths)) @ depths / max(depths.sum(), 1)),
+        }
+
+    def reset(self):
+        for counts in [self.read_latency, self.wait_latency, self.queue_depth, self.totals]:
+            counts.zero_()
+
+
+def latency_percentile(counts, q):
+    """Upper edge of the latency bin containing given quantile of the histogram, 0 for empty histogram."""
+    if counts.sum() == 0:
+        return 0.0
+    return float(np.append(LATENCY_BINS, np.inf)[np.searchsorted(np.cumsum(counts), q * counts.sum())])
+
+
+class ReadAheadReader:
+    """
+    Reads files in reader threads ahead of the caller. read_all keeps at most max_pending reads in flight, so while
+    the caller decodes a file, the next files are already being read. Thread pool is created on first use, so reader
+    can be created before dataloader workers are forked.
+    """
+
+    def __init__(self, n_threads, max_pending, stats=None, read=read_file):
+        self.n_threads = n_threads
+        self.max_pending = max_pending
+        self.stats = stats
+        self.read = read
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def pool(self):
+        # forked worker gets copy of the executor without its threads and lock possibly held by one of them
+        if self.executor is None or self.pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.n_threads)
+            self.lock = threading.Lock()
+            self.pid = os.getpid()
+        return self.executor
+
+    def timed_read(self, path, slot):
+        start = time.perf_counter()
+        buffer = self.read(path)
+        if self.stats is not None:
+            with self.lock:
+                self.stats.add_read(slot, time.perf_counter() - start, len(buffer))
+        return buffer
+
+    def read_all(self, paths):
+        """Yields contents of given files in order, reading up to max_pending files ahead."""
+        slot = ReadStats.slot()
+        pool = self.pool()
+        paths = iter(paths)
+        pending = deque()
+
+        def submit():
+            path = next(paths, None)
+            if path is None:
+                return
+            if self.stats is not None:
+                with self.lock:
+                    self.stats.add_depth(slot, len(pending))
+            pending.append(pool.submit(self.timed_read, path, slot))
+
+        for _ in range(self.max_pending):
+            submit()
+        try:
+            while pending:
+                future = pending.popleft()
+                start = time.perf_counter()
+                buffer = future.result()
+                if self.stats is not None:
+                    with self.lock:
+                        self.stats.add_wait(slot, time.perf_counter() - start)
+                submit()
+                yield buffer
+        finally:
+            # reads of a generator that is not consumed to the end are dropped
+            for future in pending:
+                future.cancel()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["executor"] = None
+        state["pid"] = None
+        state["lock"] = None
+        return state
+
+
+def read_ahead_images(dataset, indices):
+    """
+    Decoded images of given frames of the dataset in order, same as dataset.load_image. Files of frames not found in
+    frame cache are read by dataset.reader ahead of decoding. Dataset must implement decode_buffer(idx, buffer).
+    """
+    indices = list(indices)
+    cached = {}
+    if dataset.frame_cache:
+        for i, idx in enumerate(indices):
+            image = dataset.frame_cache.get(dataset.cache_keys[idx])
+            if image is not None:
+                cached[i] = image
+
+    buffers = dataset.reader.read_all(dataset.image_paths[idx] for i, idx in enumerate(indices) if i not in cached)
+    for i, idx in enumerate(indices):
+        if i in cached:
+            yield cached[i]
+            continue
+        image = dataset.decode_buffer(idx, next(buffers))
+        if dataset.frame_cache:
+            dataset.frame_cache.put(dataset.cache_keys[idx], image)
+        yield image
@@ -0,0 +1,210 @@
+import os
+
+import numpy as np
+import pandas as pd
+from torch.utils.data import Sampler
+
+from dataloading.compact import ImagePaths
+from dataloading.metadata import alias_table_cache_path, save_alias_table
+from dataloading.model import Camera, TurnSignal
+
+# Steering angle bin edges of weighted sampling, first and last edge are replaced by minimum and maximum steering angle
+STEERING_BINS = np.array([-np.inf, -5.26168, -2.91877, -1.71195, -1.05283, -0.69548, -0.46468, -0.29645, -0.16921,
+                          -0.06559, 0.01271, 0.08248, 0.17921, 0.29897, 0.45133, 0.65823, 0.98126, 1.57150, 2.78337,
+                          5.05328, np.inf])
+
+
+def folder_ids(image_paths):
+    """Integer id of the folder of every image, frames of one camera of one drive get the same id."""
+    if isinstance(image_paths, ImagePaths):
+        return pd.factorize(image_paths.folder_ids)[0]
+    return pd.factorize(np.array([os.path.dirname(image_path) for image_path in image_paths]))[0]
+
+
+def steering_weights(steering_angles):
+    """
+    Weights that make steering angles sampled uniformly over the width of the steering angle bins. Frames of a bin get
+    weight proportional to width of the bin divided by number of frames in it.
+    """
+    steering_angles = np.asarray(steering_angles)
+    bins = STEERING_BINS.copy()
+    bins[0], bins[-1] = steering_angles.min() - 0.00001, steering_angles.max() + 0.00001
+    # bins include the right edge, same as pandas cut
+    bin_ids = np.searchsorted(bins, steering_angles, side="left") - 1
+    counts = np.bincount(bin_ids, minlength=len(bins) - 1)
+    widths = np.diff(bins)
+    with np.errstate(divide="ignore"):
+        bin_weights = (widths / counts) * counts.sum() / widths.sum()
+    return bin_weights[bin_ids]
+
+
+def camera_weights(camera_types, side_camera_weight):
+    center_camera_weight = 1 - 2 * side_camera_weight
+    return np.where(np.asarray(camera_types) == Camera.FRONT_WIDE.value, center_camera_weight, side_camera_weight)
+
+
+def turn_weights(turn_signals, turn_sampling_weight):
+    without_turn_weight = 1 - 2 * turn_sampling_weight
+    return np.where(np.asarray(turn_signals) == TurnSignal.STRAIGHT.value, without_turn_weight, turn_sampling_weight)
+
+
+def stratified_weights(frames, strata, side_camera_weight=0.33, turn_sampling_weight=0.33):
+    """
+    Sampling weight of every frame as product of weights of given strata: 'steering' (steering angle bins), 'camera'
+    and 'turn'. Frames without camera_type column are treated as front camera frames.
+    """
+    weights = np.ones(len(frames), dtype=np.float64)
+    if "steering" in strata:
+        weights *= steering_weights(frames["steering_angle"].to_numpy())
+    if "camera" in strata:
+        camera_types = frames["camera_type"].to_numpy() if "camera_type" in frames else Camera.FRONT_WIDE.value
+        weights *= camera_weights(camera_types, side_camera_weight)
+    if "turn" in strata:
+        weights *= turn_weights(frames["turn_signal"].to_numpy(), turn_sampling_weight)
+    return weights
+
+
+def alias_table(weights):
+    """
+    Builds alias table for sampling from discrete distribution in constant time (Vose's alias method). Column i is
+    sampled uniformly, then i is kept with probability prob[i] and replaced with alias[i] otherwise.
+
+    Instead of pairing one underfull column with one overfull column at a time, all underfull columns are assigned at
+    once: deficits of underfull columns and surpluses of overfull columns are laid out one after another and every
+    underfull column gets the overfull column its deficit starts in. Overfull columns that give away more than their
+    surplus become underfull and are assigned in the next round.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    prob = weights * n / weights.sum()
+    alias = np.arange(n)
+
+    small = np.flatnonzero(prob < 1)
+    large = np.flatnonzero(prob >= 1)
+    while len(small) and len(large):
+        surplus_ends = np.cumsum(prob[large] - 1)
+        deficit_starts = np.cumsum(1 - prob[small]) - (1 - prob[small])
+        # rounding errors can leave deficit past the total surplus, those columns are kept as they are
+        assigned = deficit_starts < surplus_ends[-1]
+        if not assigned.any():
+            break
+        small = small[assigned]
+        donors = large[np.searchsorted(surplus_ends, deficit_starts[assigned], side="right")]
+        alias[small] = donors
+        prob[large] -= np.bincount(np.searchsorted(large, donors), weights=1 - prob[small], minlength=len(large))
+
+        small = large[prob[large] < 1]
+        large = large[prob[large] >= 1]
+
+    prob[small] = 1
+    prob[large] = 1
+    return prob, alias
+
+
+class AliasSampler(Sampler):
+    """
+    Weighted sampling with replacement like WeightedRandomSampler, but the distribution is turned into alias table
+    once and indices are drawn in constant time per sample, batch_size indices at a time. Alias table is cached in
+    cache_dir when given, keyed by the weights.
+    """
+
+    def __init__(self, weights, num_samples, batch_size=1024, cache_dir=None):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+
+        cache_path = alias_table_cache_path(cache_dir, weights) if cache_dir else None
+        if cache_path and cache_path.exists():
+            table = np.load(cache_path)
+            self.prob, self.alias = table["prob"], table["alias"]
+        else:
+            self.prob, self.alias = alias_table(weights)
+            if cache_path:
+                save_alias_table(self.prob, self.alias, cache_path)
+
+    def sample(self, size):
+        columns = np.random.randint(0, len(self.prob), size=size)
+        return np.where(np.random.random(size) < self.prob[columns], columns, self.alias[columns])
+
+    def __iter__(self):
+        for start in range(0, self.num_samples, self.batch_size):
+            yield from self.sample(min(self.batch_size, self.num_samples - start)).tolist()
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ChunkedShuffleSampler(Sampler):
+    """
+    Samples contiguous blocks of frames instead of single random frames, so frames close to each other on disk are
+    read together. Frames of the blocks are interleaved with a shuffle buffer, so batches still contain frames from
+    many drives.
+
+    Without weights, every frame is sampled once per epoch like with shuffling. With weights, blocks are chosen with
+    probability proportional to their total weight and frames inside the block proportional to their weight, so
+    probability of sampling a frame is the same as with WeightedRandomSampler. Frames sampled from the same block are
+    correlated, larger buffer interleaves more blocks.
+
+    Blocks never cross boundaries of groups (drives and cameras), given as group id of every frame. Frames of a group
+    must be consecutive.
+    """
+
+    def __init__(self, group_ids, block_size=64, buffer_size=4096, weights=None, num_samples=None):
+        group_ids = np.asarray(group_ids)
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        self.weights = np.asarray(weights, dtype=np.float64) if weights is not None else None
+        self.num_samples = num_samples if num_samples is not None else len(group_ids)
+        # blocks are sampled with replacement when weights or number of samples is given, same as with samplers in
+        # train.py
+        self.replacement = weights is not None or num_samples is not None
+
+        group_starts = np.flatnonzero(np.diff(group_ids, prepend=np.nan) != 0)
+        group_ends = np.append(group_starts[1:], len(group_ids))
+        self.block_starts = np.concatenate([np.arange(start, end, block_size)
+                                            for start, end in zip(group_starts, group_ends)])
+        self.block_ends = np.minimum(np.append(self.block_starts[1:], len(group_ids)), self.block_starts + block_size)
+
+    def blocks(self):
+        if not self.replacement:
+            for block in np.random.permutation(len(self.block_starts)):
+                yield np.arange(self.block_starts[block], self.block_ends[block])
+            return
+
+        if self.weights is not None:
+            block_weights = np.add.reduceat(self.weights, self.block_starts)
+        else:
+            block_weights = (self.block_ends - self.block_starts).astype(np.float64)
+        block_probs = block_weights / block_weights.sum()
+
+        n_sampled = 0
+        while n_sampled < self.num_samples:
+            for block in np.random.choice(len(self.block_starts), size=1024, p=block_probs):
+                start, end = self.block_starts[block], self.block_ends[block]
+                size = min(self.block_size, self.num_samples - n_sampled)
+                if self.weights is not None:
+                    frame_weights = self.weights[start:end]
+                    frames = np.random.choice(end - start, size=size, p=frame_weights / frame_weights.sum())
+                else:
+                    frames = np.random.randint(0, end - start, size=size)
+                yield start + np.sort(frames)
+                n_sampled += size
+                if n_sampled >= self.num_samples:
+                    return
+
+    def __iter__(self):
+        buffer = []
+        for block in self.blocks():
+            block = block.tolist()
+            if len(buffer) < self.buffer_size:
+                n_fill = min(self.buffer_size - len(buffer), len(block))
+                buffer.extend(block[:n_fill])
+                block = block[n_fill:]
+            for idx, position in zip(block, np.random.randint(0, len(buffer), size=len(block)).tolist()):
+                yield buffer[position]
+                buffer[position] = idx
+
+        np.random.shuffle(buffer)
+        yield from buffer
+
+    def __len__(self):
+        return self.num_samples
@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+
+SHARD_SIZE = 8192
+SHARDS_FOLDER = "shards"
+MISSING = -1
+# crop name of shards storing uncropped frames
+FULL_FRAME = "full"
+
+
+def shard_cache_path(dataset_path, camera, crop):
+    return Path(dataset_path) / SHARDS_FOLDER / f"{camera}_{crop}"
+
+
+class ShardReader:
+    """
+    Reads cropped frames from shards built by build_shard_cache. Shards are memory mapped lazily, so reader can be
+    pickled to dataloader workers without copying the data.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index = np.load(self.path / "index.npy")
+        self.shards = None
+
+    def offsets(self, row_ids):
+        return self.index[row_ids]
+
+    def __getitem__(self, offset):
+        if self.shards is None:
+            # copy-on-write mapping gives writable arrays, so torch.from_numpy does not need to copy
+            self.shards = [np.load(shard_path, mmap_mode="c") for shard_path in sorted(self.path.glob("shard_*.npy"))]
+        shard_idx, shard_offset = divmod(offset, SHARD_SIZE)
+        return torch.from_numpy(self.shards[shard_idx][shard_offset])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
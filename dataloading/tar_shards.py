@@ -0,0 +1,180 @@
+import json
+import tarfile
+from abc import abstractmethod
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import IterableDataset, get_worker_info
+from torchvision import transforms
+
+from dataloading.nvidia import FusedDecodeCrop, Normalize, conditional_target
+from dataloading.ouster import OusterCrop, OusterDataset, OusterNormalize
+
+TAR_SHARDS_FOLDER = "tar_shards"
+MANIFEST_FILE = "manifest.json"
+
+
+def tar_shards_path(dataset_path, name):
+    return Path(dataset_path) / TAR_SHARDS_FOLDER / name
+
+
+def read_tar_shard(shard_path):
+    """Streams samples of a shard written by write_tar_shards as pairs of encoded image and metadata."""
+    with tarfile.open(shard_path, mode="r|") as tar:
+        image_bytes = None
+        for member in tar:
+            content = tar.extractfile(member).read()
+            if member.name.endswith(".json"):
+                yield image_bytes, json.loads(content)
+            else:
+                image_bytes = content
+
+
+def shuffled(samples, buffer_size, rng):
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        position = rng.randint(buffer_size)
+        yield buffer[position]
+        buffer[position] = sample
+
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class TarShardDataset(IterableDataset):
+    """
+    Streams samples from tar shards written by build_tar_shards.py, shards are read sequentially. Shards are divided
+    between dataloader workers. With shuffle buffer, order of shards is shuffled every epoch and samples are shuffled
+    with the buffer of given size, otherwise samples are read in the same order as in the original dataset.
+    """
+
+    def __init__(self, shard_folders, shuffle_buffer=0):
+        self.shards = []
+        self.n_samples = 0
+        for shard_folder in shard_folders:
+            with open(Path(shard_folder) / MANIFEST_FILE) as manifest_file:
+                manifest = json.load(manifest_file)
+            for shard in manifest["shards"]:
+                self.shards.append(Path(shard_folder) / shard["name"])
+                self.n_samples += shard["n_samples"]
+        self.shuffle_buffer = shuffle_buffer
+        self.epoch = 0
+
+    def worker_shards(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info else 0
+
+        shard_order = np.arange(len(self.shards))
+        if self.shuffle_buffer:
+            # all workers start from the same base seed, so they shuffle shards in the same order
+            base_seed = torch.initial_seed() - worker_id
+            shard_order = np.random.RandomState((base_seed + self.epoch) % 2 ** 32).permutation(len(self.shards))
+        if worker_info:
+            shard_order = shard_order[worker_id::worker_info.num_workers]
+        return [self.shards[shard_idx] for shard_idx in shard_order]
+
+    def __iter__(self):
+        self.epoch += 1
+        samples = (sample for shard_path in self.worker_shards() for sample in read_tar_shard(shard_path))
+        if self.shuffle_buffer:
+            rng = np.random.RandomState((torch.initial_seed() + self.epoch) % 2 ** 32)
+            samples = shuffled(samples, self.shuffle_buffer, rng)
+
+        for image_bytes, metadata in samples:
+            yield self.create_sample(image_bytes, metadata)
+
+    def __len__(self):
+        return self.n_samples
+
+    @abstractmethod
+    def create_sample(self, image_bytes, metadata):
+        pass
+
+
+class NvidiaTarShardDataset(TarShardDataset):
+    """Streaming version of NvidiaDataset, samples are the same as created by NvidiaDataset with the same arguments."""
+
+    def __init__(self, shard_folders, transform=None, output_modality="steering_angle", n_branches=1,
+                 n_waypoints=10, color_space="rgb", fused_decode=False, shuffle_buffer=0):
+        super().__init__(shard_folders, shuffle_buffer)
+        self.transform = transform if transform else transforms.Compose([Normalize()])
+        self.output_modality = output_modality
+        self.n_branches = n_branches
+        self.color_space = color_space
+        self.target_size = 2 * n_waypoints if output_modality == "waypoints" else 1
+
+        self.fused_decoder = None
+        if fused_decode and isinstance(self.transform, transforms.Compose) \
+                and self.transform.transforms and hasattr(self.transform.transforms[0], "crop_box"):
+            self.fused_decoder = FusedDecodeCrop(self.transform.transforms[0], self.color_space)
+            self.transform = transforms.Compose(self.transform.transforms[1:])
+
+    def decode_image(self, image_bytes):
+        if self.fused_decoder:
+            return self.fused_decoder.decode(image_bytes)
+        if self.color_space == "bgr":
+            image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            return torch.tensor(image, dtype=torch.uint8).permute(2, 0, 1)
+        return torchvision.io.decode_image(torch.from_numpy(np.frombuffer(image_bytes, dtype=np.uint8).copy()))
+
+    def create_sample(self, image_bytes, metadata):
+        data = {
+            'image': self.decode_image(image_bytes),
+            'steering_angle': np.float32(metadata["steering_angle"]),
+            'vehicle_speed': np.float32(metadata["vehicle_speed"]),
+            'autonomous': np.bool_(metadata["autonomous"]),
+            'position_x': np.float64(metadata["position_x"]),
+            'position_y': np.float64(metadata["position_y"]),
+            'yaw': np.float32(metadata["yaw"]),
+            'turn_signal': np.int64(metadata["turn_signal"]),
+            'row_id': np.int64(metadata["row_id"]),
+        }
+
+        turn_signal = data['turn_signal']
+
+        if self.output_modality == "waypoints":
+            waypoints = np.array(metadata["waypoints"], dtype=np.float32)
+            data['waypoints'] = waypoints
+            target_values = waypoints
+        else:
+            target_values = np.float32(metadata["target_steering_angle"])
+
+        if self.transform:
+            data = self.transform(data)
+
+        target, conditional_mask = conditional_target(target_values, turn_signal, self.n_branches, self.target_size)
+        return data, target, conditional_mask
+
+
+class OusterTarShardDataset(TarShardDataset):
+    """Streaming version of OusterDataset, samples are the same as created by OusterDataset with the same arguments."""
+
+    def __init__(self, shard_folders, transform=None, channel=None, shuffle_buffer=0):
+        super().__init__(shard_folders, shuffle_buffer)
+        self.transform = transform if transform else transforms.Compose([OusterCrop(), OusterNormalize()])
+        self.channel = channel
+
+    def create_sample(self, image_bytes, metadata):
+        image = torchvision.io.decode_image(torch.from_numpy(np.frombuffer(image_bytes, dtype=np.uint8).copy()))
+        if self.channel:
+            channel_idx = OusterDataset.CHANNEL_MAP[self.channel]
+            image = torch.unsqueeze(image[channel_idx], dim=0)
+
+        data = {
+            'image': image,
+            'steering_angle': np.array(metadata["steering_angle"], dtype=np.float32),
+            'vehicle_speed': np.array(metadata["vehicle_speed"], dtype=np.float32),
+            'turn_signal': np.array(metadata["turn_signal"]),
+            'row_id': np.array(metadata["row_id"])
+        }
+
+        if self.transform:
+            data = self.transform(data)
+
+        return data, "dummy", "dummy"
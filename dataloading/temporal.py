@@ -0,0 +1,122 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from dataloading.samplers import folder_ids
+
+
+def window_index(group_ids, row_ids, n_frames, stride=1):
+    """
+    Dataset indices of frames of all complete windows of n_frames frames, oldest frame first. Frames of a window are
+    stride metadata rows apart and belong to the same group (drive and camera). Windows over rows removed by filtering,
+    like frames marked with turn_signal -1, are incomplete and left out.
+    """
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    # groups are consecutive and rows increase inside a group, so keys are sorted
+    keys = group_ids * (row_ids.max() + 1 + (n_frames - 1) * stride) + row_ids
+    if len(keys) > 1 and np.any(np.diff(keys) <= 0):
+        raise ValueError("Frames must be sorted by drive and metadata row")
+
+    offsets = np.arange(n_frames - 1, -1, -1) * stride
+    window_keys = keys[:, np.newaxis] - offsets[np.newaxis, :]
+    positions = np.clip(np.searchsorted(keys, window_keys), 0, len(keys) - 1)
+    complete = np.all(keys[positions] == window_keys, axis=1)
+    return positions[complete]
+
+
+class FrameBuffer:
+    """
+    Fixed number of recently decoded frames, least recently used frame is dropped when buffer is full. Every
+    dataloader worker has its own copy of the dataset, so every worker has its own buffer.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.frames = OrderedDict()
+
+    def get(self, key):
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame):
+        if self.capacity == 0:
+            return
+        self.frames[key] = frame
+        if len(self.frames) > self.capacity:
+            self.frames.popitem(last=False)
+
+
+class TemporalDataset(Dataset):
+    """
+    Windows of the last n_frames frames of NvidiaDataset, stride metadata rows apart. Sample is the sample of the last
+    frame of the window, with images of all frames of the window stacked into 'image' of shape
+    (n_frames, channels, height, width), or (n_frames * channels, height, width) with stack_channels. Transforms of the
+    dataset are applied to the whole window, so all frames get the same augmentation.
+
+    Windows never cross drives or frames removed by filtering. Decoded frames are kept in a buffer of buffer_size
+    frames, by default enough for windows read in order to decode each frame once. Batches fetched with get_batch
+    decode frames shared by windows of the batch once.
+    """
+
+    def __init__(self, dataset, n_frames=3, stride=1, buffer_size=None, stack_channels=False):
+        self.dataset = dataset
+        self.n_frames = n_frames
+        self.stride = stride
+        self.stack_channels = stack_channels
+        # frame is used again stride windows later, meanwhile stride windows touch n_frames * stride frames
+        self.buffer_size = buffer_size if buffer_size is not None else n_frames * stride
+        self.buffer = FrameBuffer(self.buffer_size)
+        self.read_stats = getattr(dataset, "read_stats", None)
+
+        self.windows = window_index(folder_ids(dataset.image_paths), dataset.row_ids, n_frames, stride)
+        last_frames = self.windows[:, -1]
+        self.frames = dataset.frames.iloc[last_frames]
+        self.image_paths = dataset.image_paths[last_frames]
+        print(f"Temporal dataset: {len(self.windows)} windows of {n_frames} frames with stride {stride} "
+              f"from {len(dataset)} frames")
+
+    def load_frames(self, frame_indices):
+        """Frames by dataset index, frames missing from buffer are loaded together with dataset.load_images."""
+        frames = {frame_idx: self.buffer.get(frame_idx) for frame_idx in frame_indices}
+        missing = [frame_idx for frame_idx, frame in frames.items() if frame is None]
+        for frame_idx, frame in zip(missing, self.dataset.load_images(missing)):
+            self.buffer.put(frame_idx, frame)
+            frames[frame_idx] = frame
+        return frames
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, np.ndarray)):
+            return self.get_batch(idx)
+
+        window = self.windows[idx].tolist()
+        frames = self.load_frames(window)
+        images = torch.stack([frames[frame_idx] for frame_idx in window])
+        data, target, conditional_mask = self.dataset.create_sample(window[-1], images)
+        if self.stack_channels:
+            data['image'] = data['image'].flatten(0, 1)
+        return data, target, conditional_mask
+
+    def get_batch(self, indices):
+        windows = self.windows[np.asarray(indices, dtype=np.int64)]
+        frames = self.load_frames(np.unique(windows).tolist())
+        images = [torch.stack([frames[frame_idx] for frame_idx in window]) for window in windows.tolist()]
+        data, target, conditional_mask = self.dataset.get_batch(windows[:, -1], images)
+        if self.stack_channels:
+            data['image'] = data['image'].flatten(1, 2)
+        return data, target, conditional_mask
+
+    def __len__(self):
+        return len(self.windows)
+
+    def get_waypoints(self):
+        return self.dataset.get_waypoints()[self.windows[:, -1]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["buffer"] = FrameBuffer(self.buffer_size)
+        return state
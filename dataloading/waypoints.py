@@ -0,0 +1,109 @@
+import functools
+from pathlib import Path
+
+import numpy as np
+
+from dataloading.model import Camera
+
+N_WAYPOINTS = 10
+# Distance between consecutive waypoints in meters
+WAYPOINT_CAP = 5
+URDF_PATH = Path(__file__).parent / "platform.urdf"
+CAMERA_LINKS = {
+    Camera.FRONT_WIDE.value: "interfacea_link2",
+    Camera.LEFT.value: "interfacea_link0",
+    Camera.RIGHT.value: "interfacea_link1",
+}
+
+
+def get_transform_manager():
+    # imported here, so datasets using waypoint functions don't need pytransform3d unless camera transforms are used
+    from pytransform3d.urdf import UrdfTransformManager
+
+    tm = UrdfTransformManager()
+    with open(URDF_PATH, "r") as f:
+        tm.load_urdf(f.read())
+    return tm
+
+
+@functools.lru_cache(maxsize=None)
+def camera_transform(camera):
+    """Transform from base_link frame to the frame of given camera, read from platform.urdf once."""
+    return get_transform_manager().get_transform("base_link", CAMERA_LINKS[camera])
+
+
+def travelled_distances(positions_x, positions_y):
+    """
+    Distance driven from the first frame to every frame, as sum of planar distances between consecutive frames.
+    Missing distances count as zero.
+    """
+    distances = np.sqrt(np.diff(positions_x) ** 2 + np.diff(positions_y) ** 2)
+    return np.concatenate([[0.0], np.cumsum(np.nan_to_num(distances))])
+
+
+def waypoint_indices(travelled, n_waypoints=N_WAYPOINTS, spacing=WAYPOINT_CAP):
+    """
+    Frame of every waypoint of every frame, -1 where the drive ends before the waypoint. Waypoint k of a frame is the
+    last frame before distance driven from the frame reaches k * spacing meters.
+    """
+    travelled = np.asarray(travelled, dtype=np.float64)
+    targets = travelled[:, np.newaxis] + spacing * np.arange(1, n_waypoints + 1)
+    reached = np.searchsorted(travelled, targets, side="left")
+    return np.where(reached < len(travelled), reached - 1, -1)
+
+
+def rotation_matrices(roll, pitch, yaw):
+    """Active rotation matrices of every frame from intrinsic xyz Euler angles, shape (n, 3, 3)."""
+    angles = np.stack([roll, pitch, yaw], axis=-1).astype(np.float64)
+    cos, sin = np.cos(angles), np.sin(angles)
+    ones, zeros = np.ones(len(angles)), np.zeros(len(angles))
+    rotate_x = np.stack([ones, zeros, zeros,
+                         zeros, cos[:, 0], -sin[:, 0],
+                         zeros, sin[:, 0], cos[:, 0]], axis=-1).reshape(-1, 3, 3)
+    rotate_y = np.stack([cos[:, 1], zeros, sin[:, 1],
+                         zeros, ones, zeros,
+                         -sin[:, 1], zeros, cos[:, 1]], axis=-1).reshape(-1, 3, 3)
+    rotate_z = np.stack([cos[:, 2], -sin[:, 2], zeros,
+                         sin[:, 2], cos[:, 2], zeros,
+                         zeros, zeros, ones], axis=-1).reshape(-1, 3, 3)
+    return rotate_x @ rotate_y @ rotate_z
+
+
+def local_waypoints(positions, rotations, indices):
+    """
+    Positions of waypoint frames given by indices in base_link frame of every frame, shape (n, n_waypoints, 3).
+    Positions are global positions of frames, shape (n, 3), and rotations their rotation matrices. Missing waypoints
+    are NaN.
+    """
+    waypoints = positions[np.maximum(indices, 0)] - positions[:, np.newaxis, :]
+    # inverse of frame pose applied to global waypoint positions
+    waypoints = np.einsum("nji,nkj->nki", rotations, waypoints)
+    waypoints[indices < 0] = np.nan
+    return waypoints
+
+
+def pose_waypoints(positions, roll, pitch, yaw, n_waypoints=N_WAYPOINTS, spacing=WAYPOINT_CAP):
+    """
+    Waypoints of every frame in its base_link frame, shape (n, n_waypoints, 3), computed from global positions of
+    frames, shape (n, 3), and their roll, pitch and yaw. Frames without position are left out when finding waypoints,
+    same as in preprocess.py, and their waypoints are NaN.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    located = ~np.isnan(positions[:, 0])
+    waypoints = np.full((len(positions), n_waypoints, 3), np.nan)
+    if not located.any():
+        return waypoints
+
+    travelled = travelled_distances(positions[located, 0], positions[located, 1])
+    indices = waypoint_indices(travelled, n_waypoints, spacing)
+    rotations = rotation_matrices(np.asarray(roll)[located], np.asarray(pitch)[located], np.asarray(yaw)[located])
+    waypoints[located] = local_waypoints(positions[located], rotations, indices)
+    return waypoints
+
+
+def camera_waypoints(waypoints, camera):
+    """Waypoints in base_link frame transformed to camera frame, with axes of base_link frame (x forward, y left)."""
+    transform = camera_transform(camera)
+    camera_points = waypoints @ transform[:3, :3].T + transform[:3, 3]
+    # Camera frames are rotated compared to base_link frame (x = z, y = -x, z = -y)
+    return np.stack([camera_points[..., 2], -camera_points[..., 0], -camera_points[..., 1]], axis=-1)
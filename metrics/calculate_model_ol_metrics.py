@@ -6,7 +6,8 @@ from torch.utils.data import DataLoader
 from torchvision import transforms
 
 from dataloading.nvidia import NvidiaDataset, Normalize, NvidiaCropWide
-from dataloading.ouster import OusterCrop, OusterNormalize, OusterDataset
+from dataloading.ouster import OusterCrop, OusterNormalize, OusterDataset, OUSTER_CROP_SHARDS
+from dataloading.shards import FULL_FRAME
 from metrics.metrics import calculate_open_loop_metrics
 from pilotnet import PilotNet
 from trainer import PilotNetTrainer
@@ -17,51 +18,59 @@ def main():
     parser.add_argument("--root-path",
                         default="/home/romet/data/datasets/rally-estonia/dataset",
                         help='Path to extracted datasets')
+    parser.add_argument("--lidar-shard-cache",
+                        choices=[OUSTER_CROP_SHARDS, FULL_FRAME],
+                        help='Read lidar images from planar shards built with dataloading/build_shards.py using '
+                             'given crop, intensity models read only the intensity channel.')
+    parser.add_argument("--crop-band",
+                        default=False,
+                        action='store_true',
+                        help='Read camera images from crop bands written with dataloading/build_crop_band.py.')
     args = parser.parse_args()
     root_path = Path(args.root_path)
 
     results = {}
-    nvidia_spring_ds = NvidiaSpringDataset(root_path)
+    nvidia_spring_ds = NvidiaSpringDataset(root_path, crop_band=args.crop_band)
     results["nvidia-v1-spring"] = calculate_metrics(load_model("nvidia-v1"), nvidia_spring_ds, fps=30)
     results["nvidia-v2-spring"] = calculate_metrics(load_model("nvidia-v2"), nvidia_spring_ds, fps=30)
     results["nvidia-v3-spring"] = calculate_metrics(load_model("nvidia-v3"), nvidia_spring_ds, fps=30)
     results["nvidia-in-train-spring"] = calculate_metrics(load_model("nvidia-with-test-track"), nvidia_spring_ds,
                                                           fps=30)
 
-    nvidia_autumn_ds = NvidiaAutumnDataset(root_path)
+    nvidia_autumn_ds = NvidiaAutumnDataset(root_path, crop_band=args.crop_band)
     results["nvidia-v1-autumn"] = calculate_metrics(load_model("nvidia-v1"), nvidia_autumn_ds, fps=30)
     results["nvidia-v2-autumn"] = calculate_metrics(load_model("nvidia-v2"), nvidia_autumn_ds, fps=30)
     results["nvidia-v3-autumn"] = calculate_metrics(load_model("nvidia-v3"), nvidia_autumn_ds, fps=30)
     results["nvidia-in-train-autumn"] = calculate_metrics(load_model("nvidia-with-test-track"), nvidia_autumn_ds,
                                                           fps=30)
 
-    ouster_spring_ds = OusterSpringDataset(root_path)
+    ouster_spring_ds = OusterSpringDataset(root_path, shard_cache=args.lidar_shard_cache)
     results["lidar-v3-spring"] = calculate_metrics(load_model("lidar-v3"), ouster_spring_ds, fps=10)
     results["lidar-v4-spring"] = calculate_metrics(load_model("lidar-v4"), ouster_spring_ds, fps=10)
     results["lidar-v5-spring"] = calculate_metrics(load_model("lidar-v5"), ouster_spring_ds, fps=10)
     results["lidar-in-train-spring"] = calculate_metrics(load_model("lidar-with-test-track"), ouster_spring_ds,
                                                          fps=10)
-    intensity_spring_ds = OusterSpringDataset(root_path, channel="intensity")
+    intensity_spring_ds = OusterSpringDataset(root_path, channel="intensity", shard_cache=args.lidar_shard_cache)
     results["lidar-intensity-spring"] = calculate_metrics(load_model("lidar-intensity", n_input_channels=1),
                                                           intensity_spring_ds, fps=10)
 
-    ouster_winter_ds = OusterWinterDataset(root_path)
+    ouster_winter_ds = OusterWinterDataset(root_path, shard_cache=args.lidar_shard_cache)
     results["lidar-v3-winter"] = calculate_metrics(load_model("lidar-v3"), ouster_winter_ds, fps=10)
     results["lidar-v4-winter"] = calculate_metrics(load_model("lidar-v4"), ouster_winter_ds, fps=10)
     results["lidar-v5-winter"] = calculate_metrics(load_model("lidar-v5"), ouster_winter_ds, fps=10)
     results["lidar-in-train-winter"] = calculate_metrics(load_model("lidar-with-test-track"), ouster_winter_ds,
                                                          fps=10)
-    intensity_winter_ds = OusterWinterDataset(root_path, channel="intensity")
+    intensity_winter_ds = OusterWinterDataset(root_path, channel="intensity", shard_cache=args.lidar_shard_cache)
     results["lidar-intensity-winter"] = calculate_metrics(load_model("lidar-intensity", n_input_channels=1),
                                                           intensity_winter_ds, fps=10)
 
-    ouster_autumn_ds = OusterAutumnDataset(root_path)
+    ouster_autumn_ds = OusterAutumnDataset(root_path, shard_cache=args.lidar_shard_cache)
     results["lidar-v3-autumn"] = calculate_metrics(load_model("lidar-v3"), ouster_autumn_ds, fps=10)
     results["lidar-v4-autumn"] = calculate_metrics(load_model("lidar-v4"), ouster_autumn_ds, fps=10)
     results["lidar-v5-autumn"] = calculate_metrics(load_model("lidar-v5"), ouster_autumn_ds, fps=10)
     results["lidar-in-train-autumn"] = calculate_metrics(load_model("lidar-with-test-track"), ouster_autumn_ds,
                                                          fps=10)
-    intensity_autumn_ds = OusterAutumnDataset(root_path, channel="intensity")
+    intensity_autumn_ds = OusterAutumnDataset(root_path, channel="intensity", shard_cache=args.lidar_shard_cache)
     results["lidar-intensity-autumn"] = calculate_metrics(load_model("lidar-intensity", n_input_channels=1),
                                                           intensity_autumn_ds, fps=10)
 
@@ -89,58 +98,62 @@ def load_model(model_name, n_input_channels=3):
 
 
 class OusterSpringDataset(OusterDataset):
-    def __init__(self, root_path, channel=None):
+    def __init__(self, root_path, channel=None, shard_cache=None):
         data_paths = [
             root_path / "2022-05-04-10-54-24_e2e_elva_seasonal_val_set_forw",
             root_path / "2022-05-04-11-01-40_e2e_elva_seasonal_val_set_back"
         ]
 
         tr = transforms.Compose([OusterCrop(xmin=516, ymin=46), OusterNormalize()])
-        super().__init__(data_paths, tr, channel=channel)
+        # crop differs from the default lidar crop, so only uncropped shards can be used
+        shard_cache = shard_cache if shard_cache == FULL_FRAME else None
+        super().__init__(data_paths, tr, channel=channel, shard_cache=shard_cache)
 
 
 class OusterAutumnDataset(OusterDataset):
-    def __init__(self, root_path, channel=None):
+    def __init__(self, root_path, channel=None, shard_cache=None):
         data_paths = [
             {'path': root_path / "2021-10-26-10-49-06_e2e_rec_ss20_elva", 'start': 3080, 'end': 7708},
             {'path': root_path / "2021-10-26-11-08-59_e2e_rec_ss20_elva_back", 'start': 3173, 'end': 7900}
         ]
 
-        tr = transforms.Compose([OusterCrop(), OusterNormalize()])
-        super().__init__(data_paths, tr, channel=channel)
+        crop = [] if shard_cache == OUSTER_CROP_SHARDS else [OusterCrop()]
+        tr = transforms.Compose(crop + [OusterNormalize()])
+        super().__init__(data_paths, tr, channel=channel, shard_cache=shard_cache)
 
 
 class OusterWinterDataset(OusterDataset):
-    def __init__(self, root_path, channel=None):
+    def __init__(self, root_path, channel=None, shard_cache=None):
         data_paths = [
             {'path': root_path / "2022-01-28-14-47-23_e2e_rec_elva_forward", 'start': 2360, 'end': 6940},
             {'path': root_path / "2022-01-28-15-09-01_e2e_rec_elva_backward", 'start': 3420, 'end': 8360}
         ]
 
-        tr = transforms.Compose([OusterCrop(), OusterNormalize()])
-        super().__init__(data_paths, tr, channel=channel)
+        crop = [] if shard_cache == OUSTER_CROP_SHARDS else [OusterCrop()]
+        tr = transforms.Compose(crop + [OusterNormalize()])
+        super().__init__(data_paths, tr, channel=channel, shard_cache=shard_cache)
 
 
 class NvidiaSpringDataset(NvidiaDataset):
-    def __init__(self, root_path):
+    def __init__(self, root_path, crop_band=False):
         data_paths = [
             root_path / "2022-05-04-10-54-24_e2e_elva_seasonal_val_set_forw",
             root_path / "2022-05-04-11-01-40_e2e_elva_seasonal_val_set_back"
         ]
 
         tr = transforms.Compose([NvidiaCropWide(), Normalize()])
-        super().__init__(data_paths, tr, metadata_file="nvidia_frames.csv", color_space="rgb")
+        super().__init__(data_paths, tr, metadata_file="nvidia_frames.csv", color_space="rgb", crop_band=crop_band)
 
 
 class NvidiaAutumnDataset(NvidiaDataset):
-    def __init__(self, root_path):
+    def __init__(self, root_path, crop_band=False):
         data_paths = [
             {'path': root_path / "2021-10-26-10-49-06_e2e_rec_ss20_elva", 'start': 9240, 'end': 23125},
             {'path': root_path / "2021-10-26-11-08-59_e2e_rec_ss20_elva_back", 'start': 9520, 'end': 23700}
         ]
 
         tr = transforms.Compose([NvidiaCropWide(), Normalize()])
-        super().__init__(data_paths, tr, metadata_file="nvidia_frames.csv", color_space="bgr")
+        super().__init__(data_paths, tr, metadata_file="nvidia_frames.csv", color_space="bgr", crop_band=crop_band)
 
 
 if __name__ == "__main__":
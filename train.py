@@ -2,22 +2,30 @@ import argparse
 import sys
 from pathlib import Path
 
-import numpy as np
-import pandas as pd
 import torch
 import wandb
 from torch import Tensor
 from torch.nn import L1Loss, MSELoss, HuberLoss
-from torch.utils.data import ConcatDataset, RandomSampler, WeightedRandomSampler
+from torch.utils.data import ConcatDataset, RandomSampler
 #from torchsummary import summary
-from dataloading.model import Camera, TurnSignal
+from dataloading.batching import batched_data_loader
+from dataloading.mixture import MixtureDataset
 from dataloading.nvidia import NvidiaTrainDataset, NvidiaValidationDataset, NvidiaWinterTrainDataset, \
-    NvidiaWinterValidationDataset, AugmentationConfig
+    NvidiaWinterValidationDataset, AugmentationConfig, BatchAugmentImage
 from dataloading.ouster import OusterTrainDataset, OusterValidationDataset
+from dataloading.samplers import AliasSampler, ChunkedShuffleSampler, folder_ids, stratified_weights
+from dataloading.temporal import TemporalDataset
 from efficient_net import effnetv2_s
 from pilotnet import PilotNetConditional, PilotnetControl, PilotNet
 from trainer import ControlTrainer, ConditionalTrainer, PilotNetTrainer
 
+CAMERA_SHARD_CROPS = ['nvidia-crop-wide', 'crop-vit', 'nvidia-resize-and-crop', 'full']
+# Crops of shards that can be read with --shard-cache by each input modality, winter datasets have no shards
+SHARD_CACHE_CROPS = {
+    'nvidia-camera': CAMERA_SHARD_CROPS,
+    'nvidia-camera-all': CAMERA_SHARD_CROPS,
+    'ouster-lidar': ['ouster-crop', 'full'],
+}
 
 def parse_arguments():
     argparser = argparse.ArgumentParser()
@@ -39,6 +47,16 @@ def parse_arguments():
         '--input-modality',
         required=True,
         choices=['nvidia-camera', 'nvidia-camera-winter', 'nvidia-camera-all', 'ouster-lidar'],
+        help="'nvidia-camera-all' mixes summer and winter camera datasets, see --mixture-ratios."
+    )
+
+    argparser.add_argument(
+        '--mixture-ratios',
+        nargs=2,
+        type=float,
+        required=False,
+        help="Share of training samples drawn from summer and winter datasets with 'nvidia-camera-all' modality. "
+             "By default datasets are sampled in proportion to their size."
     )
 
     argparser.add_argument(
@@ -72,6 +90,15 @@ def parse_arguments():
         help="Number of waypoints used for trajectory."
     )
 
+    argparser.add_argument(
+        '--waypoint-spacing',
+        type=float,
+        default=None,
+        help="Distance between waypoints in meters. When set, waypoints are computed from vehicle poses when loading "
+             "metadata instead of reading waypoints created by preprocessing, so any --metadata-file with poses, "
+             "like nvidia_frames.csv, can be used. Cached with --metadata-cache-dir."
+    )
+
     argparser.add_argument(
         '--dataset-folder',
         default="/home/romet/data2/datasets/rally-estonia/dataset-new-small/summer2021",
@@ -143,9 +170,19 @@ def parse_arguments():
     argparser.add_argument(
         '--batch-sampler',
         required=False,
-        choices=['old', 'random', 'weighted', 'camera-weighted', 'turn-weighted'],
+        choices=['old', 'random', 'weighted', 'camera-weighted', 'turn-weighted', 'stratified'],
         default='old',
-        help='Sampler used for creating batches for training.'
+        help='Sampler used for creating batches for training. \'stratified\' combines weights of strata given with '
+             '--stratify-by.'
+    )
+
+    argparser.add_argument(
+        '--stratify-by',
+        nargs='+',
+        choices=['steering', 'camera', 'turn'],
+        default=['steering', 'camera', 'turn'],
+        help="Strata whose weights are multiplied together by 'stratified' batch sampler. 'steering' weights are the "
+             "same as used by 'weighted', 'camera' by 'camera-weighted' and 'turn' by 'turn-weighted' sampler."
     )
 
     argparser.add_argument(
@@ -166,6 +203,22 @@ def parse_arguments():
              "Default uses same ratio as in dataset."
     )
 
+    argparser.add_argument(
+        '--sampler-block-size',
+        type=int,
+        default=0,
+        help='Sample training frames in contiguous blocks of given size from the same drive and camera, which makes '
+             'reading from network filesystems faster. Weights of the batch sampler are still used. '
+             'Frames are sampled one by one by default.'
+    )
+
+    argparser.add_argument(
+        '--sampler-buffer-size',
+        type=int,
+        default=8192,
+        help='Size of shuffle buffer used for mixing frames of the blocks when --sampler-block-size is used.'
+    )
+
     argparser.add_argument(
         '--num-workers',
         type=int,
@@ -194,6 +247,23 @@ def parse_arguments():
         help='Probability of augmenting input image by blurring it.'
     )
 
+    argparser.add_argument(
+        '--batch-augment',
+        default=False,
+        action='store_true',
+        help='Augment whole training batches on the training device instead of augmenting images one by one in '
+             'dataloader workers.'
+    )
+
+    argparser.add_argument(
+        '--uint8-images',
+        default=False,
+        action='store_true',
+        help='Keep images uint8 in dataloader and normalize them on the training device, reduces memory and '
+             'bandwidth used for transferring batches. Implies --batch-augment with camera modalities, lidar '
+             'images are not augmented.'
+    )
+
     argparser.add_argument(
         '--loss',
         required=False,
@@ -224,7 +294,77 @@ def parse_arguments():
         help='Dataset metadata file used for reading metadata like steering angles etc.'
     )
 
-    return argparser.parse_args()
+    argparser.add_argument(
+        '--shard-cache',
+        required=False,
+        choices=['nvidia-crop-wide', 'crop-vit', 'nvidia-resize-and-crop', 'ouster-crop', 'full'],
+        help='Read images from shards built with dataloading/build_shards.py using given crop. Applies to '
+             '\'nvidia-camera\' modality, summer datasets of \'nvidia-camera-all\' modality and to '
+             '\'ouster-lidar\' modality with \'ouster-crop\' or \'full\', where only the channel given with '
+             '--lidar-channel is read from planar lidar shards.'
+    )
+
+    argparser.add_argument(
+        '--frame-cache-gb',
+        type=float,
+        default=0,
+        help='Size of shared memory cache for decoded and cropped frames in GB, used separately for training and '
+             'validation data. Caching is disabled by default.'
+    )
+
+    argparser.add_argument(
+        '--read-ahead',
+        type=int,
+        default=0,
+        help='Number of threads in every dataloader worker reading image files of a batch ahead of decoding, hides '
+             'latency of network filesystems. Not used with --shard-cache. Disabled by default.'
+    )
+
+    argparser.add_argument(
+        '--metadata-cache-dir',
+        required=False,
+        help='Directory for caching filtered dataset metadata, so metadata files do not need to be parsed and '
+             'filtered again on next run. Caching is disabled by default.'
+    )
+
+    argparser.add_argument(
+        '--batched-fetch',
+        default=False,
+        action='store_true',
+        help='Fetch and collate whole batches at once in dataloader workers instead of sample by sample. '
+             'Only applies to \'nvidia-camera\' and \'nvidia-camera-winter\' modalities.'
+    )
+
+    argparser.add_argument(
+        '--device-prefetch',
+        default=False,
+        action='store_true',
+        help='Stage next batches on the training device in a background thread while the current batch is used.'
+    )
+
+    argparser.add_argument(
+        '--temporal-frames',
+        type=int,
+        default=1,
+        help='Number of consecutive frames stacked into model input along the channel dimension. '
+             'Only applies to \'nvidia-camera\' and \'nvidia-camera-winter\' modalities.'
+    )
+
+    argparser.add_argument(
+        '--temporal-stride',
+        type=int,
+        default=1,
+        help='Number of metadata rows between stacked frames, used with --temporal-frames.'
+    )
+
+    args = argparser.parse_args()
+    shard_crops = SHARD_CACHE_CROPS.get(args.input_modality, [])
+    if args.shard_cache and not shard_crops:
+        argparser.error(f"argument --shard-cache: not supported with '{args.input_modality}' modality")
+    if args.shard_cache and args.shard_cache not in shard_crops:
+        argparser.error(f"argument --shard-cache: '{args.shard_cache}' can't be used with '{args.input_modality}' "
+                        f"modality, choose from {', '.join(shard_crops)}")
+    return args
 
 
 class WeighedL1Loss(L1Loss):
@@ -256,6 +396,7 @@ class TrainingConfig:
         self.camera_name = args.camera_name
         self.output_modality = args.output_modality
         self.n_waypoints = args.num_waypoints
+        self.waypoint_spacing = args.waypoint_spacing
         self.learning_rate = args.learning_rate
         self.learning_rate_patience = args.learning_rate_patience
         self.weight_decay = args.weight_decay
@@ -266,13 +407,41 @@ class TrainingConfig:
         self.batch_sampler = args.batch_sampler
         self.side_camera_weight = args.side_camera_weight
         self.turn_sampling_weight = args.turn_sampling_weight
+        self.stratify_by = args.stratify_by
         self.num_workers = args.num_workers
+        self.sampler_block_size = args.sampler_block_size
+        self.sampler_buffer_size = args.sampler_buffer_size
         self.wandb_project = args.wandb_project
         self.loss = args.loss
         self.loss_discount_rate = args.loss_discount_rate
         self.metadata_file = args.metadata_file
-
-        self.n_input_channels = 1 if self.lidar_channel else 3
+        self.shard_cache = args.shard_cache
+        self.frame_cache_bytes = int(args.frame_cache_gb * 1024 ** 3)
+        self.read_ahead = args.read_ahead
+        self.metadata_cache_dir = args.metadata_cache_dir
+        self.mixture_ratios = args.mixture_ratios
+        self.batched_fetch = args.batched_fetch
+        self.uint8_images = args.uint8_images
+        self.device_prefetch = args.device_prefetch
+        # uint8 camera images can only be augmented after normalization on the device, lidar images are not augmented
+        # and are only normalized on the device
+        if args.batch_augment and self.input_modality == "ouster-lidar":
+            print("Batch augmentation is not supported with ouster-lidar modality")
+            sys.exit()
+        self.batch_augment = args.batch_augment or (args.uint8_images and self.input_modality != "ouster-lidar")
+
+        self.temporal_frames = args.temporal_frames
+        self.temporal_stride = args.temporal_stride
+        if self.temporal_frames > 1:
+            if self.input_modality not in ["nvidia-camera", "nvidia-camera-winter"]:
+                print(f"Temporal frames are not supported with {self.input_modality} modality")
+                sys.exit()
+            if self.batch_augment:
+                # batch color jitter expects RGB images
+                print("Temporal frames are not supported with batch augmentation")
+                sys.exit()
+
+        self.n_input_channels = (1 if self.lidar_channel else 3) * self.temporal_frames
         if self.output_modality == "waypoints":
             self.n_outputs = 2 * self.n_waypoints
         elif self.output_modality == "steering_angle":
@@ -294,7 +463,9 @@ def train_model(model_name, train_conf, augment_conf):
     print('train_conf: ', train_conf.__dict__)
     print('augment_conf: ', augment_conf.__dict__)
 
-    train_loader, valid_loader = load_data(train_conf, augment_conf)
+    # images are augmented by trainer instead of dataset
+    dataset_augment_conf = AugmentationConfig() if train_conf.batch_augment else augment_conf
+    train_loader, valid_loader = load_data(train_conf, dataset_augment_conf)
 
     # TODO: model and trainer should be combined
     if train_conf.model_type == "pilotnet":
@@ -315,6 +486,10 @@ def train_model(model_name, train_conf, augment_conf):
         print(f"Uknown output model type {train_conf.model_type}")
         sys.exit()
 
+    if train_conf.batch_augment:
+        trainer.batch_augment = BatchAugmentImage(augment_conf)
+    trainer.device_prefetch = train_conf.device_prefetch
+
     #summary(model, input_size=(3, 660, 172), device="cpu")
     #summary(model, input_size=(3, 264, 68), device="cpu")
 
@@ -379,90 +554,156 @@ def load_data(train_conf, augment_conf):
                                       n_waypoints=train_conf.n_waypoints,
                                       camera=train_conf.camera_name,
                                       augment_conf=augment_conf,
-                                      metadata_file=train_conf.metadata_file)
+                                      metadata_file=train_conf.metadata_file,
+                                      shard_cache=train_conf.shard_cache,
+                                      frame_cache_bytes=train_conf.frame_cache_bytes,
+                                      read_ahead=train_conf.read_ahead,
+                                      metadata_cache_dir=train_conf.metadata_cache_dir,
+                                      waypoint_spacing=train_conf.waypoint_spacing,
+                                      normalize=not train_conf.uint8_images)
         validset = NvidiaValidationDataset(dataset_path, train_conf.output_modality, train_conf.n_branches,
                                            n_waypoints=train_conf.n_waypoints,
-                                           metadata_file=train_conf.metadata_file)
+                                           metadata_file=train_conf.metadata_file,
+                                           shard_cache=train_conf.shard_cache,
+                                           frame_cache_bytes=train_conf.frame_cache_bytes,
+                                           read_ahead=train_conf.read_ahead,
+                                           metadata_cache_dir=train_conf.metadata_cache_dir,
+                                           waypoint_spacing=train_conf.waypoint_spacing,
+                                           normalize=not train_conf.uint8_images)
     elif train_conf.input_modality == "nvidia-camera-winter":
         trainset = NvidiaWinterTrainDataset(dataset_path, train_conf.output_modality,
                                             train_conf.n_branches, n_waypoints=train_conf.n_waypoints,
-                                            augment_conf=augment_conf)
+                                            augment_conf=augment_conf,
+                                            metadata_file=train_conf.metadata_file,
+                                            metadata_cache_dir=train_conf.metadata_cache_dir,
+                                            waypoint_spacing=train_conf.waypoint_spacing,
+                                            normalize=not train_conf.uint8_images)
         validset = NvidiaWinterValidationDataset(dataset_path, train_conf.output_modality,
-                                                 train_conf.n_branches, n_waypoints=train_conf.n_waypoints)
+                                                 train_conf.n_branches, n_waypoints=train_conf.n_waypoints,
+                                                 metadata_file=train_conf.metadata_file,
+                                                 metadata_cache_dir=train_conf.metadata_cache_dir,
+                                                 waypoint_spacing=train_conf.waypoint_spacing,
+                                                 normalize=not train_conf.uint8_images)
+    elif train_conf.input_modality == "nvidia-camera-all":
+        summer_trainset = NvidiaTrainDataset(dataset_path, train_conf.output_modality, train_conf.n_branches,
+                                             n_waypoints=train_conf.n_waypoints,
+                                             camera=train_conf.camera_name,
+                                             augment_conf=augment_conf,
+                                             metadata_file=train_conf.metadata_file,
+                                             shard_cache=train_conf.shard_cache,
+                                             frame_cache_bytes=train_conf.frame_cache_bytes,
+                                             read_ahead=train_conf.read_ahead,
+                                             metadata_cache_dir=train_conf.metadata_cache_dir,
+                                             waypoint_spacing=train_conf.waypoint_spacing,
+                                             normalize=not train_conf.uint8_images)
+        winter_trainset = NvidiaWinterTrainDataset(dataset_path, train_conf.output_modality,
+                                                   train_conf.n_branches, n_waypoints=train_conf.n_waypoints,
+                                                   augment_conf=augment_conf,
+                                                   metadata_file=train_conf.metadata_file,
+                                                   metadata_cache_dir=train_conf.metadata_cache_dir,
+                                                   waypoint_spacing=train_conf.waypoint_spacing,
+                                                   normalize=not train_conf.uint8_images)
+        trainset = MixtureDataset([summer_trainset, winter_trainset], ratios=train_conf.mixture_ratios)
+        summer_validset = NvidiaValidationDataset(dataset_path, train_conf.output_modality, train_conf.n_branches,
+                                                  n_waypoints=train_conf.n_waypoints,
+                                                  metadata_file=train_conf.metadata_file,
+                                                  shard_cache=train_conf.shard_cache,
+                                                  frame_cache_bytes=train_conf.frame_cache_bytes,
+                                                  read_ahead=train_conf.read_ahead,
+                                                  metadata_cache_dir=train_conf.metadata_cache_dir,
+                                                  waypoint_spacing=train_conf.waypoint_spacing,
+                                                  normalize=not train_conf.uint8_images)
+        winter_validset = NvidiaWinterValidationDataset(dataset_path, train_conf.output_modality,
+                                                        train_conf.n_branches, n_waypoints=train_conf.n_waypoints,
+                                                        metadata_file=train_conf.metadata_file,
+                                                        metadata_cache_dir=train_conf.metadata_cache_dir,
+                                                        waypoint_spacing=train_conf.waypoint_spacing,
+                                                        normalize=not train_conf.uint8_images)
+        validset = MixtureDataset([summer_validset, winter_validset])
     elif train_conf.input_modality == "ouster-lidar":
-        trainset = OusterTrainDataset(dataset_path, train_conf.output_modality)
-        validset = OusterValidationDataset(dataset_path, train_conf.output_modality)
+        trainset = OusterTrainDataset(dataset_path, train_conf.output_modality,
+                                      channel=train_conf.lidar_channel,
+                                      frame_cache_bytes=train_conf.frame_cache_bytes,
+                                      read_ahead=train_conf.read_ahead,
+                                      normalize=not train_conf.uint8_images,
+                                      shard_cache=train_conf.shard_cache)
+        validset = OusterValidationDataset(dataset_path, train_conf.output_modality,
+                                           channel=train_conf.lidar_channel,
+                                           frame_cache_bytes=train_conf.frame_cache_bytes,
+                                           read_ahead=train_conf.read_ahead,
+                                           normalize=not train_conf.uint8_images,
+                                           shard_cache=train_conf.shard_cache)
     else:
         print(f"Uknown input modality {train_conf.input_modality}")
         sys.exit()
 
-    print(f"Training data has {len(trainset.frames)} frames")
-    print(f"Validation data has {len(validset.frames)} frames")
+    if train_conf.temporal_frames > 1:
+        trainset = TemporalDataset(trainset, train_conf.temporal_frames, train_conf.temporal_stride,
+                                   stack_channels=True)
+        validset = TemporalDataset(validset, train_conf.temporal_frames, train_conf.temporal_stride,
+                                   stack_channels=True)
+
+    print(f"Training data has {len(trainset)} frames")
+    print(f"Validation data has {len(validset)} frames")
     print(f"Creating {train_conf.num_workers} workers with batch size {train_conf.batch_size} using {train_conf.batch_sampler} sampler.")
 
+    strata = None
+    num_samples = train_conf.epoch_size
     if train_conf.batch_sampler == 'weighted':
-        weights = calculate_weights(trainset.frames)
-        sampler = WeightedRandomSampler(weights, num_samples=train_conf.epoch_size, replacement=True)
-
-        train_loader = torch.utils.data.DataLoader(trainset, batch_size=train_conf.batch_size, shuffle=False,
-                                                   sampler=sampler, num_workers=train_conf.num_workers,
-                                                   pin_memory=True, persistent_workers=True)
+        strata = ['steering']
     elif train_conf.batch_sampler == 'old':
-        train_loader = torch.utils.data.DataLoader(trainset, batch_size=train_conf.batch_size, shuffle=True,
-                                                   num_workers=train_conf.num_workers, pin_memory=True,
-                                                   persistent_workers=True)
+        num_samples = None
     elif train_conf.batch_sampler == 'random':
-        sampler = RandomSampler(data_source=trainset, num_samples=train_conf.epoch_size, replacement=True)
-        train_loader = torch.utils.data.DataLoader(trainset, batch_size=train_conf.batch_size, sampler=sampler,
-                                                   num_workers=train_conf.num_workers, pin_memory=True,
-                                                   persistent_workers=True)
+        pass
     elif train_conf.batch_sampler == 'camera-weighted':
-        center_camera_weight = (1-2*train_conf.side_camera_weight)
-        weights = [center_camera_weight if camera_type == Camera.FRONT_WIDE.value
-                   else train_conf.side_camera_weight
-                   for camera_type in trainset.frames["camera_type"].to_numpy()]
-        sampler = WeightedRandomSampler(weights, num_samples=train_conf.epoch_size, replacement=True)
-        train_loader = torch.utils.data.DataLoader(trainset, batch_size=train_conf.batch_size, shuffle=False,
-                                                  sampler=sampler, num_workers=train_conf.num_workers,
-                                                  pin_memory=True, persistent_workers=True)
+        strata = ['camera']
     elif train_conf.batch_sampler == 'turn-weighted':
-        without_turn_weight = (1-2*train_conf.turn_sampling_weight)
-        weights = [without_turn_weight if turn_signal == TurnSignal.STRAIGHT.value
-                   else train_conf.turn_sampling_weight
-                   for turn_signal in trainset.frames["turn_signal"].to_numpy()]
-        sampler = WeightedRandomSampler(weights, num_samples=train_conf.epoch_size, replacement=True)
-        train_loader = torch.utils.data.DataLoader(trainset, batch_size=train_conf.batch_size, shuffle=False,
-                                                  sampler=sampler, num_workers=train_conf.num_workers,
-                                                  pin_memory=True, persistent_workers=True)
+        strata = ['turn']
+    elif train_conf.batch_sampler == 'stratified':
+        strata = train_conf.stratify_by
     else:
         print(f"Unknown batch sampler {train_conf.batch_sampler}")
         sys.exit()
 
-    valid_loader = torch.utils.data.DataLoader(validset, batch_size=train_conf.batch_size, shuffle=False,
-                                               num_workers=train_conf.num_workers, pin_memory=True,
-                                               persistent_workers=True)
+    weights = None
+    if isinstance(trainset, MixtureDataset):
+        # weights are computed for each source separately, so frames of the sources are never concatenated
+        source_weights = None
+        if strata:
+            source_weights = [stratified_weights(dataset.frames, strata, train_conf.side_camera_weight,
+                                                 train_conf.turn_sampling_weight) for dataset in trainset.datasets]
+        weights = trainset.sampling_weights(source_weights)
+        if weights is not None and num_samples is None:
+            num_samples = len(trainset)
+    elif strata:
+        weights = stratified_weights(trainset.frames, strata, train_conf.side_camera_weight,
+                                     train_conf.turn_sampling_weight)
+
+    if train_conf.sampler_block_size:
+        sampler = ChunkedShuffleSampler(folder_ids(trainset.image_paths),
+                                        train_conf.sampler_block_size, train_conf.sampler_buffer_size,
+                                        weights=weights, num_samples=num_samples)
+    elif weights is not None:
+        sampler = AliasSampler(weights, num_samples, batch_size=train_conf.batch_size,
+                               cache_dir=train_conf.metadata_cache_dir)
+    elif num_samples is not None:
+        sampler = RandomSampler(data_source=trainset, num_samples=num_samples, replacement=True)
+    else:
+        sampler = RandomSampler(data_source=trainset)
+
+    train_loader = create_data_loader(trainset, train_conf, sampler)
+    valid_loader = create_data_loader(validset, train_conf)
 
     return train_loader, valid_loader
 
 
-def calculate_weights(df):
-    optimized_bins = np.array([df["steering_angle"].min() - 0.00001, -5.26168, -2.91877, -1.71195, -1.05283, -0.69548,
-                               -0.46468, -0.29645, -0.16921, -0.06559, 0.01271, 0.08248, 0.17921,
-                               0.29897, 0.45133, 0.65823, 0.98126, 1.57150, 2.78337, 5.05328,
-                               df["steering_angle"].max() + 0.00001])
-
-    bin_ranges = pd.cut(df["steering_angle"], optimized_bins, labels=np.arange(1, len(optimized_bins)))
-    df["bins"] = bin_ranges
-    counts = bin_ranges.value_counts(sort=False)
-    widths = np.diff(optimized_bins)
-    weights = (widths / counts) * sum(counts) / sum(widths)
-
-    weights_df = pd.DataFrame(data=weights)
-    weights_df.reset_index(inplace=True)
-    weights_df.columns = ["bins", "weight"]
-    weights_df.set_index('bins', inplace=True)
-    df = df.join(weights_df, on="bins")
-    return df["weight"].to_numpy()
+def create_data_loader(dataset, train_conf, sampler=None):
+    if train_conf.batched_fetch and hasattr(dataset, "get_batch"):
+        return batched_data_loader(dataset, train_conf.batch_size, sampler=sampler,
+                                   num_workers=train_conf.num_workers, pin_memory=True, persistent_workers=True)
+
+    return torch.utils.data.DataLoader(dataset, batch_size=train_conf.batch_size, shuffle=False, sampler=sampler,
+                                       num_workers=train_conf.num_workers, pin_memory=True, persistent_workers=True)
 
 
 if __name__ == "__main__":
@@ -11,6 +11,7 @@ import wandb
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from tqdm.auto import tqdm
 
+from dataloading.batching import DevicePrefetcher, NormalizeBatch
 from metrics.metrics import calculate_open_loop_metrics, calculate_trajectory_open_loop_metrics
 
 
@@ -21,6 +22,12 @@ class Trainer:
         self.target_name = target_name
         self.n_conditional_branches = n_conditional_branches
         self.wandb_logging = False
+        # augmentation applied to whole training batch on the device, see BatchAugmentImage
+        self.batch_augment = None
+        # normalization of uint8 images on the device, models always get normalized images
+        self.normalize = NormalizeBatch()
+        # stage next batches on the device in background thread while current batch is used, see DevicePrefetcher
+        self.device_prefetch = False
 
         if wandb_project:
             self.wandb_logging = True
@@ -34,6 +41,26 @@ class Trainer:
     def force_cpu(self):
         self.device = 'cpu'
 
+    def prefetched(self, loader):
+        if self.device_prefetch:
+            return DevicePrefetcher(loader, self.device, self.stage_batch)
+        return loader
+
+    def stage_batch(self, batch):
+        """Moves inputs and targets used by train_batch to the device, called by DevicePrefetcher."""
+        data, target_values, condition_mask = batch
+        data = dict(data, image=data['image'].to(self.device, non_blocking=True))
+        target_values = target_values.to(self.device, non_blocking=True)
+        if isinstance(condition_mask, torch.Tensor):
+            condition_mask = condition_mask.to(self.device, non_blocking=True)
+        return data, target_values, condition_mask
+
+    def image_input(self, data):
+        images = data['image'].to(self.device, non_blocking=True)
+        if images.dtype == torch.uint8:
+            images = self.normalize(images)
+        return images
+
     def train(self, model, train_loader, valid_loader, optimizer, criterion, n_epoch,
               patience=10, lr_patience=10, fps=30):
         if self.wandb_logging:
@@ -46,11 +73,14 @@ class Trainer:
 
         for epoch in range(n_epoch):
 
+            train_batches = self.prefetched(train_loader)
+            valid_batches = self.prefetched(valid_loader)
+
             progress_bar = tqdm(total=len(train_loader), smoothing=0)
-            train_loss = self.train_epoch(model, train_loader, optimizer, criterion, progress_bar, epoch)
+            train_loss = self.train_epoch(model, train_batches, optimizer, criterion, progress_bar, epoch)
 
             progress_bar.reset(total=len(valid_loader))
-            valid_loss, predictions = self.evaluate(model, valid_loader, criterion, progress_bar, epoch, train_loss)
+            valid_loss, predictions = self.evaluate(model, valid_batches, criterion, progress_bar, epoch, train_loss)
 
             scheduler.step(valid_loss)
 
@@ -95,6 +125,27 @@ class Trainer:
                                              f' | last_whiteness: {last_wp_whiteness:.4f}')
 
 
+            if self.device_prefetch:
+                metrics['train_prefetch_overlap'] = train_batches.overlap()
+                metrics['train_prefetch_wait'] = train_batches.wait_seconds
+                metrics['valid_prefetch_overlap'] = valid_batches.overlap()
+                progress_bar.write(f'epoch {epoch + 1} | prefetch overlap: train {train_batches.overlap():.1%}, '
+                                   f'valid {valid_batches.overlap():.1%} | '
+                                   f'waited for batches {train_batches.wait_seconds:.1f}s')
+
+            for name, loader in [('train', train_loader), ('valid', valid_loader)]:
+                read_stats = getattr(loader.dataset, 'read_stats', None)
+                if read_stats is not None:
+                    reads = read_stats.summary()
+                    metrics[f'{name}_read_p99'] = reads['read_p99']
+                    metrics[f'{name}_read_wait'] = reads['wait_seconds']
+                    metrics[f'{name}_read_queue_depth'] = reads['mean_queue_depth']
+                    progress_bar.write(f'epoch {epoch + 1} | {name} reads: {reads["reads"]}, '
+                                       f'p50 {reads["read_p50"] * 1000:.2f}ms, p99 {reads["read_p99"] * 1000:.2f}ms | '
+                                       f'waited for reads {reads["wait_seconds"]:.1f}s | '
+                                       f'mean queue depth {reads["mean_queue_depth"]:.1f}')
+                    read_stats.reset()
+
             if self.wandb_logging:
                 metrics['epoch'] = epoch + 1
                 metrics['train_loss'] = train_loss
@@ -174,7 +225,7 @@ class Trainer:
             wandb.save(f"{self.save_dir}/last.onnx")
 
     def create_onxx_input(self, data):
-        return data[0]['image'].to(self.device)
+        return self.image_input(data[0])
 
     def train_epoch(self, model, loader, optimizer, criterion, progress_bar, epoch):
         running_loss = 0.0
@@ -184,6 +235,9 @@ class Trainer:
         for i, (data, target_values, condition_mask) in enumerate(loader):
             optimizer.zero_grad()
 
+            if self.batch_augment:
+                data['image'] = self.batch_augment(self.image_input(data))
+
             predictions, loss = self.train_batch(model, data, target_values, condition_mask, criterion)
 
             loss.backward()
@@ -234,7 +288,7 @@ class PilotNetTrainer(Trainer):
             progress_bar = tqdm(total=len(dataloader), smoothing=0)
             progress_bar.set_description("Model predictions")
             for i, (data, target_values, condition_mask) in enumerate(dataloader):
-                inputs = data['image'].to(self.device)
+                inputs = self.image_input(data)
                 predictions = model(inputs)
                 all_predictions.extend(predictions.cpu().squeeze().numpy())
                 progress_bar.update(1)
@@ -242,7 +296,7 @@ class PilotNetTrainer(Trainer):
         return np.array(all_predictions)
 
     def train_batch(self, model, data, target_values, condition_mask, criterion):
-        inputs = data['image'].to(self.device)
+        inputs = self.image_input(data)
         target_values = target_values.to(self.device)
         predictions = model(inputs)
         return predictions, criterion(predictions, target_values)
@@ -258,7 +312,7 @@ class ControlTrainer(Trainer):
             progress_bar = tqdm(total=len(dataloader), smoothing=0)
             progress_bar.set_description("Model predictions")
             for i, (data, target_values, condition_mask) in enumerate(dataloader):
-                inputs = data['image'].to(self.device)
+                inputs = self.image_input(data)
                 turn_signal = data['turn_signal']
                 control = F.one_hot(turn_signal, 3).to(self.device)
                 predictions = model(inputs, control)
@@ -267,17 +321,26 @@ class ControlTrainer(Trainer):
 
         return np.array(all_predictions)
 
+    def stage_batch(self, batch):
+        data, target_values, condition_mask = super().stage_batch(batch)
+        data['control'] = self.control_input(data)
+        return data, target_values, condition_mask
+
+    def control_input(self, data):
+        if 'control' in data:
+            return data['control']
+        return F.one_hot(data['turn_signal'], 3).to(self.device, non_blocking=True)
+
     def train_batch(self, model, data, target_values, condition_mask, criterion):
-        inputs = data['image'].to(self.device)
+        inputs = self.image_input(data)
         target_values = target_values.to(self.device)
-        turn_signal = data['turn_signal']
-        control = F.one_hot(turn_signal, 3).to(self.device)
+        control = self.control_input(data)
 
         predictions = model(inputs, control)
         return predictions, criterion(predictions, target_values)
 
     def create_onxx_input(self, data):
-        image_input = data[0]['image'].to(self.device)
+        image_input = self.image_input(data[0])
         turn_signal = data[0]['turn_signal']
         control = F.one_hot(turn_signal, 3).to(torch.float32).to(self.device)
         return image_input, control
@@ -293,7 +356,7 @@ class ConditionalTrainer(Trainer):
             progress_bar = tqdm(total=len(dataloader), smoothing=0)
             progress_bar.set_description("Model predictions")
             for i, (data, target_values, condition_mask) in enumerate(dataloader):
-                inputs = data['image'].to(self.device)
+                inputs = self.image_input(data)
                 predictions = model(inputs)
                 masked_predictions = predictions[condition_mask == 1]
                 masked_predictions = masked_predictions.reshape(predictions.shape[0], -1)
@@ -303,7 +366,7 @@ class ConditionalTrainer(Trainer):
         return np.array(all_predictions)
 
     def train_batch(self, model, data, target_values, condition_mask, criterion):
-        inputs = data['image'].to(self.device)
+        inputs = self.image_input(data)
         target_values = target_values.to(self.device)
         condition_mask = condition_mask.to(self.device)
 
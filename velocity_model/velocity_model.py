@@ -61,7 +61,9 @@ def create_velocity_model(output_filename, dataset_path):
     ]
 
     dataset = NvidiaDataset(paths, camera="front_wide", transform=None)
-    positions_df = dataset.frames
+    positions_df = dataset.frames.copy()
+    # image paths are not kept in frames, see ImagePaths
+    positions_df["image_path"] = np.asarray(dataset.image_paths, dtype=object)
 
     velocity = 30
     positions_df["position_x2"] = positions_df["position_x"] + (velocity * np.cos(positions_df["yaw"]))